@@ -0,0 +1,82 @@
+"""
+KorQuAD open 추론 시간 제한 벤치마크
+
+QAEngine 으로 dev 질문에 시간 제한 (budget) 을 두고 답하여, 제한마다 문단을 다 읽지 못하고 끊긴 답의 비율, 평균 읽은 문단 수,
+지연 시간과 질문 단위 EM/F1 을 시간 제한이 없을 때와 비교함
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from qa_engine import QAEngine, add_checkpoint_args, load_gold_answers, load_questions, score_answers
+
+
+def answer_with_budget(engine, questions, budget, questions_per_call):
+    """Answers and per call latencies, every question of a call gets the deadline `budget` seconds after its start."""
+    answers, latencies = [], []
+    for start in range(0, len(questions), questions_per_call):
+        chunk = questions[start:start + questions_per_call]
+        start_time = time.monotonic()
+        deadlines = None if budget is None else [start_time + budget] * len(chunk)
+        answers.extend(engine.answer_many(chunk, deadlines))
+        latencies.append(time.monotonic() - start_time)
+    return answers, latencies
+
+
+def budget_report(answers, latencies, gold_answers, strip_particles=False):
+    exact, f1 = score_answers([answer.text for answer in answers], gold_answers, strip_particles)
+    return {
+        "cut_short_rate": float(np.mean([answer.cut_short for answer in answers])),
+        "paragraphs_read": float(np.mean([answer.paragraphs_read for answer in answers])),
+        "p50_ms": float(np.percentile(latencies, 50)) * 1000.0,
+        "p99_ms": float(np.percentile(latencies, 99)) * 1000.0,
+        "exact": exact,
+        "f1": f1,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_checkpoint_args(parser)
+    parser.add_argument("--predict_file", required=True, type=str, help="KorQuAD open json file with the answers.")
+    parser.add_argument("--max_questions", default=None, type=int, help="Only answer the first X questions.")
+    parser.add_argument("--max_paragraphs", default=5, type=int, help="Paragraphs per question without a deadline.")
+    parser.add_argument(
+        "--budgets_ms", default=[50, 100, 200, 400, 800], nargs="+", type=float, help="Deadlines to compare."
+    )
+    parser.add_argument("--questions_per_call", default=16, type=int, help="Questions per answer_many call.")
+    parser.add_argument("--batch_size", default=64, type=int, help="Features per forward pass.")
+    parser.add_argument("--device", default=None, type=str, help="Device of the model, cuda if available.")
+    parser.add_argument("--strip_particles", action="store_true", help="Score like squad_evaluate --strip_particles.")
+    args = parser.parse_args()
+
+    engine = QAEngine.from_checkpoint(
+        args.checkpoint_dir, config_name=args.config_name, device=args.device, batch_size=args.batch_size
+    )
+    questions = load_questions(args.predict_file, args.max_paragraphs)[:args.max_questions]
+    gold_answers = load_gold_answers(args.predict_file)[:len(questions)]
+
+    # Warms up the model so that the first budget is not charged for it
+    engine.answer_many(questions[:args.questions_per_call])
+
+    print("{:>10} {:>9} {:>11} {:>9} {:>9} {:>7} {:>7} {:>8}".format(
+        "budget_ms", "cut_short", "paragraphs", "p50_ms", "p99_ms", "EM", "F1", "F1_delta"))
+    full = None
+    for budget_ms in [None] + sorted(args.budgets_ms):
+        budget = None if budget_ms is None else budget_ms / 1000.0
+        report = budget_report(
+            *answer_with_budget(engine, questions, budget, args.questions_per_call), gold_answers, args.strip_particles
+        )
+        full = full or report
+        print("{:>10} {:>9.1%} {:>11.2f} {:>9.1f} {:>9.1f} {:>7.2f} {:>7.2f} {:>+8.2f}".format(
+            "none" if budget_ms is None else "{:g}".format(budget_ms), report["cut_short_rate"],
+            report["paragraphs_read"], report["p50_ms"], report["p99_ms"], report["exact"], report["f1"],
+            report["f1"] - full["f1"],
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+KorQuAD open 조기 종료 (early exit) 벤치마크
+
+run_squad.py --model_type electra_early_exit 로 학습한 체크포인트를 exit_threshold 별로 QAEngine 에서 실행하여
+특징 하나가 평균 몇 개의 층을 지나는지, 중간에 끝난 특징의 비율, 처리 시간, 질문 단위 EM/F1 을 비교함
+첫 줄 (threshold none) 은 모든 특징이 모든 층을 지나는 기준임
+
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from benchmark_ranker import engine_report
+from modeling_electra import ElectraForEarlyExitQuestionAnswering
+from qa_engine import QAEngine, add_checkpoint_args, load_gold_answers, load_questions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_checkpoint_args(parser, help="Local or NSML early exit checkpoint.")
+    parser.add_argument("--predict_file", required=True, type=str, help="KorQuAD open json file with the answers.")
+    parser.add_argument("--max_questions", default=None, type=int, help="Only answer the first X questions.")
+    parser.add_argument("--max_paragraphs", default=5, type=int, help="Paragraphs per question.")
+    parser.add_argument(
+        "--thresholds",
+        default=[0.5, 0.7, 0.9, 0.95, 0.99],
+        nargs="+",
+        type=float,
+        help="No answer probabilities at which a feature leaves at an exit.",
+    )
+    parser.add_argument("--batch_size", default=64, type=int, help="Features per forward pass.")
+    parser.add_argument("--questions_per_call", default=16, type=int, help="Questions per answer_many call.")
+    parser.add_argument("--device", default=None, type=str, help="Device of the model, cuda if available.")
+    parser.add_argument("--threads", default=None, type=int, help="torch intra-op threads.")
+    parser.add_argument("--strip_particles", action="store_true", help="Score like squad_evaluate --strip_particles.")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    engine = QAEngine.from_checkpoint(
+        args.checkpoint_dir, config_name=args.config_name, model_class=ElectraForEarlyExitQuestionAnswering,
+        device=args.device, batch_size=args.batch_size,
+    )
+    questions = load_questions(args.predict_file, args.max_paragraphs)[:args.max_questions]
+    gold_answers = load_gold_answers(args.predict_file)[:len(questions)]
+
+    model = engine.model
+    num_layers = model.config.num_hidden_layers
+    layers_executed = []
+    model.register_forward_hook(lambda module, inputs, outputs: layers_executed.append(module.layers_executed.cpu()))
+
+    print("exits after layers {} of {}".format(model.exit_layers, num_layers))
+    print("{:>9} {:>10} {:>7} {:>11} {:>7} {:>7} {:>8}".format(
+        "threshold", "avg_layers", "exited", "questions/s", "EM", "F1", "F1_delta"))
+    full_f1 = None
+    for threshold in [None] + sorted(args.thresholds):
+        model.exit_threshold = threshold
+        del layers_executed[:]
+        report = engine_report(engine, questions, gold_answers, args.questions_per_call, args.strip_particles)
+        layers = torch.cat(layers_executed).numpy()
+        full_f1 = report["f1"] if full_f1 is None else full_f1
+        print("{:>9} {:>10.2f} {:>7.1%} {:>11.1f} {:>7.2f} {:>7.2f} {:>+8.2f}".format(
+            "none" if threshold is None else threshold, float(layers.mean()), float(np.mean(layers < num_layers)),
+            report["questions_per_sec"], report["exact"], report["f1"], report["f1"] - full_f1,
+        ))
+
+
+if __name__ == "__main__":
+    main()
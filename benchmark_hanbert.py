@@ -0,0 +1,198 @@
+"""
+HanBert 토크나이저 벤치마크
+
+tokenization_hanbert.py 의 구현 (wordpiece, 문자 정제, 단어 캐시) 을 이전 구현과 비교하여 출력이 같은지 확인하고 처리량을 측정함
+텍스트는 KorQuAD open 형 json (paragraph contents, question) 또는 한 줄에 한 문장인 텍스트 파일을 사용
+
+"""
+
+import argparse
+import json
+import timeit
+import unicodedata
+
+from tokenization_hanbert import (
+    BasicTokenizer,
+    HanBertTokenizer,
+    WordpieceTokenizer,
+    _is_control,
+    _is_punctuation,
+    _is_whitespace,
+    load_vocab,
+    whitespace_tokenize,
+)
+
+
+def load_texts(text_file, max_texts=None):
+    """Reads paragraphs and questions of a KorQuAD open json file, or the lines of a text file."""
+    texts = []
+    with open(text_file, "r", encoding="utf-8") as reader:
+        if text_file.endswith(".json"):
+            for entry in json.load(reader)["data"]:
+                if entry["qa"]["question"]:
+                    texts.append(entry["qa"]["question"])
+                texts.extend(str(paragraph["contents"]) for paragraph in entry["paragraphs"])
+        else:
+            texts = [line.strip() for line in reader if line.strip()]
+    return texts[:max_texts] if max_texts else texts
+
+
+def greedy_wordpiece_tokenize(vocab, text, unk_token="[UNK]", max_input_chars_per_word=200):
+    """Previous WordpieceTokenizer.tokenize: probes the vocab with every shrinking substring."""
+    output_tokens = []
+    for token in whitespace_tokenize(text):
+        chars = list(token)
+        if len(chars) > max_input_chars_per_word:
+            output_tokens.append(unk_token)
+            continue
+
+        is_bad = False
+        start = 0
+        sub_tokens = []
+        while start < len(chars):
+            end = len(chars)
+            cur_substr = None
+            while start < end:
+                substr = "".join(chars[start:end])
+                if start > 0:
+                    substr = "##" + substr
+                if substr in vocab:
+                    cur_substr = substr
+                    break
+                end -= 1
+            if cur_substr is None:
+                is_bad = True
+                break
+            sub_tokens.append(cur_substr)
+            start = end
+
+        if is_bad:
+            output_tokens.append(unk_token)
+        else:
+            output_tokens.extend(sub_tokens)
+    return output_tokens
+
+
+def per_char_normalize(text):
+    """Previous BasicTokenizer._clean_text and _tokenize_chinese_chars: one Python step per character."""
+    output = []
+    for char in text:
+        cp = ord(char)
+        if cp == 0 or cp == 0xfffd or _is_control(char):
+            continue
+        output.append(" " if _is_whitespace(char) else char)
+    text = "".join(output)
+
+    output = []
+    for char in text:
+        if BasicTokenizer._is_chinese_char(None, ord(char)):
+            output.extend((" ", char, " "))
+        else:
+            output.append(char)
+    return "".join(output)
+
+
+def per_char_tokenize_word(token, use_zwj=True):
+    """Previous BasicTokenizer.tokenize_word with the per character _run_strip_accents and _run_split_on_punc."""
+    token = unicodedata.normalize("NFD", token.lower())
+    chars = [char for char in token if unicodedata.category(char) != "Mn"]
+    output = []
+    start_new_word = True
+    for char in chars:
+        if _is_punctuation(char, use_zwj):
+            output.append([char])
+            start_new_word = True
+        else:
+            if start_new_word:
+                output.append([])
+            start_new_word = False
+            output[-1].append(char)
+    return whitespace_tokenize(" ".join("".join(x) for x in output))
+
+
+def per_char_basic_tokenize(text):
+    output_tokens = []
+    for token in whitespace_tokenize(per_char_normalize(text)):
+        output_tokens.extend(per_char_tokenize_word(token))
+    return output_tokens
+
+
+def benchmark(name, fn, texts, repeat):
+    """Runs fn over all texts `repeat` times and prints the best throughput."""
+    num_chars = sum(len(text) for text in texts)
+    best = min(timeit.repeat(lambda: [fn(text) for text in texts], number=1, repeat=repeat))
+    print("{:<24} {:>10.3f} sec {:>12.0f} chars/sec".format(name, best, num_chars / best))
+    return best
+
+
+def benchmark_wordpiece(vocab, texts, repeat):
+    wordpiece_tokenizer = WordpieceTokenizer(vocab=vocab)
+
+    mismatches = sum(
+        greedy_wordpiece_tokenize(vocab, text) != wordpiece_tokenizer.tokenize(text) for text in texts
+    )
+    print("wordpiece: {} texts, {} mismatches".format(len(texts), mismatches))
+
+    greedy_time = benchmark("greedy (previous)", lambda text: greedy_wordpiece_tokenize(vocab, text), texts, repeat)
+    trie_time = benchmark("trie", wordpiece_tokenizer.tokenize, texts, repeat)
+    print("speedup: {:.2f}x".format(greedy_time / trie_time))
+    return mismatches
+
+
+def benchmark_basic(texts, repeat):
+    basic_tokenizer = BasicTokenizer(use_moran=False)
+
+    mismatches = sum(
+        per_char_normalize(text) != basic_tokenizer.normalize(text)
+        or per_char_basic_tokenize(text) != basic_tokenizer.tokenize(text)
+        for text in texts
+    )
+    print("basic: {} texts, {} mismatches".format(len(texts), mismatches))
+
+    per_char_time = benchmark("normalize per char", per_char_normalize, texts, repeat)
+    regex_time = benchmark("normalize regex", basic_tokenizer.normalize, texts, repeat)
+    print("speedup: {:.2f}x".format(per_char_time / regex_time))
+    per_char_time = benchmark("basic per char", per_char_basic_tokenize, texts, repeat)
+    regex_time = benchmark("basic regex", basic_tokenizer.tokenize, texts, repeat)
+    print("speedup: {:.2f}x".format(per_char_time / regex_time))
+    return mismatches
+
+
+def benchmark_word_cache(vocab_file, moran_file, use_moran, texts, repeat):
+    uncached = HanBertTokenizer(vocab_file, moran_file, use_moran=use_moran, word_cache_size=0)
+    cached = HanBertTokenizer(vocab_file, moran_file, use_moran=use_moran)
+
+    mismatches = sum(uncached._tokenize(text) != cached._tokenize(text) for text in texts)
+    print("word cache: {} texts, {} mismatches, {}".format(len(texts), mismatches, cached.word_cache.info()))
+
+    uncached_time = benchmark("_tokenize w/o cache", uncached._tokenize, texts, repeat)
+    cached.word_cache.clear()
+    cached_time = benchmark("_tokenize w/ cache", cached._tokenize, texts, repeat)
+    print("speedup: {:.2f}x".format(uncached_time / cached_time))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_file", default="vocab_54k.txt", type=str, help="HanBert vocabulary file.")
+    parser.add_argument("--moran_file", default="libmoran4dnlp.so", type=str, help="MorAn library.")
+    parser.add_argument("--use_moran", action="store_true", help="Benchmark HanBertTokenizer with MorAn.")
+    parser.add_argument(
+        "--text_file", required=True, type=str, help="KorQuAD open json file or a text file with one text per line."
+    )
+    parser.add_argument("--max_texts", default=None, type=int, help="Only use the first X texts.")
+    parser.add_argument("--repeat", default=3, type=int, help="Number of timing runs, the best one is reported.")
+    args = parser.parse_args()
+
+    vocab = load_vocab(args.vocab_file)
+    texts = load_texts(args.text_file, args.max_texts)
+
+    mismatches = benchmark_wordpiece(vocab, texts, args.repeat)
+    mismatches += benchmark_basic(texts, args.repeat)
+    mismatches += benchmark_word_cache(args.vocab_file, args.moran_file, args.use_moran, texts, args.repeat)
+    if mismatches:
+        raise SystemExit("Output differs from the previous implementation.")
+
+
+if __name__ == "__main__":
+    main()
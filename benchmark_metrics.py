@@ -0,0 +1,162 @@
+"""
+KorQuAD open 평가 점수 계산 벤치마크
+
+open_squad_metrics.get_raw_scores 를 이전 구현과 비교하여 점수가 같은지 확인하고 처리 시간을 측정함
+예측은 --prediction_file (qas_id -> 답) 과 같은 폴더의 qas_metadata_val.json 을 사용하고, 없으면 정답을 무작위로 변형하여 만듦
+
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import re
+import string
+import timeit
+
+from open_squad_metrics import get_raw_scores, normalize_answer
+
+Example = collections.namedtuple("Example", ["qas_id", "answers"])
+
+
+def previous_normalize_answer(s):
+    """Previous normalize_answer: compiles the article regex and the punctuation set on every call."""
+
+    def remove_articles(text):
+        regex = re.compile(r"\b(a|an|the)\b", re.UNICODE)
+        return re.sub(regex, " ", text)
+
+    def white_space_fix(text):
+        return " ".join(text.split())
+
+    def remove_punc(text):
+        exclude = set(string.punctuation)
+        return "".join(ch for ch in text if ch not in exclude)
+
+    return white_space_fix(remove_articles(remove_punc(s.lower())))
+
+
+def previous_get_raw_scores(examples, preds):
+    """Previous get_raw_scores: normalizes each gold answer once per comparison."""
+
+    def get_tokens(s):
+        return previous_normalize_answer(s).split() if s else []
+
+    def compute_f1(a_gold, a_pred):
+        gold_toks = get_tokens(a_gold)
+        pred_toks = get_tokens(a_pred)
+        common = collections.Counter(gold_toks) & collections.Counter(pred_toks)
+        num_same = sum(common.values())
+        if len(gold_toks) == 0 or len(pred_toks) == 0:
+            return int(gold_toks == pred_toks)
+        if num_same == 0:
+            return 0
+        precision = 1.0 * num_same / len(pred_toks)
+        recall = 1.0 * num_same / len(gold_toks)
+        return (2 * precision * recall) / (precision + recall)
+
+    exact_scores, f1_scores = {}, {}
+    for example in examples:
+        gold_answers = [a["text"] for a in example.answers if previous_normalize_answer(a["text"])] or [""]
+        prediction = preds[example.qas_id]
+        exact_scores[example.qas_id] = max(
+            int(previous_normalize_answer(a) == previous_normalize_answer(prediction)) for a in gold_answers
+        )
+        f1_scores[example.qas_id] = max(compute_f1(a, prediction) for a in gold_answers)
+    return exact_scores, f1_scores
+
+
+def load_examples(predict_file):
+    """Examples with the answers of open_squad, one per question and paragraph, keyed by (question_id, pi)."""
+    examples = []
+    with open(predict_file, "r", encoding="utf-8") as reader:
+        for question_id, entry in enumerate(json.load(reader)["data"]):
+            question_text, answer_text = entry["qa"]["question"], entry["qa"]["answer"]
+            if question_text is None or answer_text is None:
+                continue
+            for pi, paragraph in enumerate(entry["paragraphs"]):
+                answers = [{"text": answer_text}] if answer_text in str(paragraph["contents"]) else []
+                examples.append(Example((question_id, pi), answers))
+    return examples
+
+
+def load_predictions(prediction_file, qas_metadata_file):
+    """Predictions of run_squad, re-keyed from the integer qas_id to (question_id, paragraph_index)."""
+    with open(prediction_file, "r", encoding="utf-8") as reader:
+        predictions = json.load(reader)
+    with open(qas_metadata_file, "r", encoding="utf-8") as reader:
+        qas = json.load(reader)["qas"]
+    return {tuple(qas[qas_id]): answer for qas_id, answer in predictions.items()}
+
+
+def perturbed_predictions(examples, seed=42):
+    """A gold answer with words dropped or added, or an empty answer."""
+    rng = random.Random(seed)
+    words = [word for example in examples for answer in example.answers for word in answer["text"].split()] or ["답"]
+    preds = {}
+    for example in examples:
+        tokens = example.answers[0]["text"].split() if example.answers else []
+        if tokens and rng.random() < 0.3:
+            tokens = tokens[: rng.randrange(len(tokens) + 1)]
+        tokens = tokens + [rng.choice(words) for _ in range(rng.randrange(3))]
+        preds[example.qas_id] = " ".join(tokens) if rng.random() > 0.1 else ""
+    return preds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--predict_file", required=True, type=str, help="KorQuAD open json file with the answers.")
+    parser.add_argument("--prediction_file", default=None, type=str, help="Predictions json (qas_id -> answer).")
+    parser.add_argument(
+        "--qas_metadata_file",
+        default=None,
+        type=str,
+        help="qas_metadata json of the predictions, qas_metadata_val.json next to the prediction file by default.",
+    )
+    parser.add_argument("--repeat_examples", default=1, type=int, help="Repeat the examples to score a larger set.")
+    parser.add_argument("--num_workers", default=4, type=int, help="Processes of the parallel get_raw_scores.")
+    parser.add_argument("--repeat", default=3, type=int, help="Number of timing runs, the best one is reported.")
+    args = parser.parse_args()
+
+    examples = load_examples(args.predict_file)
+    if args.prediction_file:
+        qas_metadata_file = args.qas_metadata_file or os.path.join(
+            os.path.dirname(args.prediction_file), "qas_metadata_val.json"
+        )
+        preds = load_predictions(args.prediction_file, qas_metadata_file)
+        examples = [example for example in examples if example.qas_id in preds]
+    else:
+        preds = perturbed_predictions(examples)
+    examples = [
+        Example((i,) + example.qas_id, example.answers)
+        for i in range(args.repeat_examples)
+        for example in examples
+    ]
+    preds = {example.qas_id: preds[example.qas_id[1:]] for example in examples}
+
+    expected = previous_get_raw_scores(examples, preds)
+    mismatches = sum(
+        get_raw_scores(examples, preds, num_workers=num_workers) != expected for num_workers in (1, args.num_workers)
+    )
+    print("{} examples, {} mismatching runs".format(len(examples), mismatches))
+
+    def run(name, fn):
+        # The memoized normalization starts empty for every run
+        best = min(timeit.repeat(lambda: (normalize_answer.cache_clear(), fn()), number=1, repeat=args.repeat))
+        print("{:<28} {:>8.3f} sec".format(name, best))
+        return best
+
+    previous_time = run("previous", lambda: previous_get_raw_scores(examples, preds))
+    serial_time = run("get_raw_scores", lambda: get_raw_scores(examples, preds))
+    parallel_time = run(
+        "get_raw_scores {} workers".format(args.num_workers),
+        lambda: get_raw_scores(examples, preds, num_workers=args.num_workers),
+    )
+    print("speedup: {:.2f}x serial, {:.2f}x parallel".format(previous_time / serial_time, previous_time / parallel_time))
+    if mismatches:
+        raise SystemExit("Scores differ from the previous implementation.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+KorQuAD open 문단 재순위화 벤치마크
+
+dev 질문마다 정답 문자열이 들어 있는 문단이 읽는 k 개의 문단 안에 있는 비율 (recall@k) 을 앞에서부터 k 개를 읽을 때와
+paragraph_ranker.BM25Ranker 의 상위 k 개를 읽을 때 비교하고, 질문당 재순위화 시간을 측정함
+--checkpoint_dir 을 주면 QAEngine 으로 두 방식의 질문 단위 EM/F1 과 처리 시간도 비교함
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from paragraph_ranker import BM25Ranker
+from qa_engine import QAEngine, add_checkpoint_args, load_gold_answers, load_questions, score_answers
+
+
+def load_tokenizer(tokenizer_name=None, tokenizer_file=None):
+    """Tokenizer of a pre-trained Electra model, or a fast HanBert tokenizer of tokenization_hanbert_fast.py."""
+    if tokenizer_file:
+        from tokenizers import Tokenizer
+
+        return Tokenizer.from_file(tokenizer_file)
+    from transformers import ElectraTokenizer
+
+    return ElectraTokenizer.from_pretrained(tokenizer_name, do_lower_case=False, tokenize_chinese_chars=False)
+
+
+def rank_questions(ranker, questions):
+    """Ranking of the paragraphs of each question and the ranking time of each question in seconds."""
+    rankings, times = [], []
+    for question, paragraphs in questions:
+        start_time = time.monotonic()
+        rankings.append(ranker.rank(question, paragraphs))
+        times.append(time.monotonic() - start_time)
+    return rankings, times
+
+
+def recall_at_k(questions, gold_answers, rankings, k):
+    """Fraction of the answered questions with the answer string in one of the k paragraphs read."""
+    hits = [
+        any(gold in paragraphs[i] for i in ranking[:k])
+        for (_, paragraphs), gold, ranking in zip(questions, gold_answers, rankings) if gold
+    ]
+    return float(np.mean(hits))
+
+
+def engine_report(engine, questions, gold_answers, questions_per_call, strip_particles=False):
+    start_time = time.monotonic()
+    answers = []
+    for start in range(0, len(questions), questions_per_call):
+        answers.extend(engine.answer_many(questions[start:start + questions_per_call]))
+    elapsed = time.monotonic() - start_time
+    exact, f1 = score_answers([answer.text for answer in answers], gold_answers, strip_particles)
+    return {
+        "questions_per_sec": len(questions) / elapsed,
+        "paragraphs_read": float(np.mean([answer.paragraphs_read for answer in answers])),
+        "exact": exact,
+        "f1": f1,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--predict_file", required=True, type=str, help="KorQuAD open json file with the answers.")
+    parser.add_argument("--tokenizer_name", default=None, type=str, help="Pre-trained Electra tokenizer name or path.")
+    parser.add_argument("--tokenizer_file", default=None, type=str, help="Fast HanBert tokenizer json instead.")
+    parser.add_argument("--max_questions", default=None, type=int, help="Only rank the first X questions.")
+    parser.add_argument("--top_k", default=[1, 2, 3, 5, 10], nargs="+", type=int, help="Paragraphs read to compare.")
+    add_checkpoint_args(parser, required=False, help="Also compare the answers of this checkpoint at --rerank_top_k.")
+    parser.add_argument("--rerank_top_k", default=5, type=int, help="Paragraphs read per question by the engine.")
+    parser.add_argument("--questions_per_call", default=16, type=int, help="Questions per answer_many call.")
+    parser.add_argument("--batch_size", default=64, type=int, help="Features per forward pass.")
+    parser.add_argument("--device", default=None, type=str, help="Device of the model, cuda if available.")
+    parser.add_argument("--strip_particles", action="store_true", help="Score like squad_evaluate --strip_particles.")
+    args = parser.parse_args()
+
+    questions = load_questions(args.predict_file)[:args.max_questions]
+    gold_answers = load_gold_answers(args.predict_file)[:len(questions)]
+
+    if args.checkpoint_dir:
+        engine = QAEngine.from_checkpoint(
+            args.checkpoint_dir, config_name=args.config_name, device=args.device, batch_size=args.batch_size
+        )
+        tokenizer = engine.tokenizer
+    elif args.tokenizer_name or args.tokenizer_file:
+        engine = None
+        tokenizer = load_tokenizer(args.tokenizer_name, args.tokenizer_file)
+    else:
+        raise SystemExit("Give --tokenizer_name, --tokenizer_file or --checkpoint_dir.")
+
+    ranker = BM25Ranker(tokenizer)
+    rankings, times = rank_questions(ranker, questions)
+    first_paragraphs = [list(range(len(paragraphs))) for _, paragraphs in questions]
+    print("rank_ms: mean {:.2f} p50 {:.2f} p99 {:.2f} (mean {:.1f} paragraphs per question)".format(
+        1000.0 * float(np.mean(times)), 1000.0 * float(np.percentile(times, 50)),
+        1000.0 * float(np.percentile(times, 99)), float(np.mean([len(paragraphs) for _, paragraphs in questions])),
+    ))
+    print("{:>5} {:>8} {:>8} {:>8}".format("k", "first_k", "bm25", "delta"))
+    for k in sorted(args.top_k):
+        first = recall_at_k(questions, gold_answers, first_paragraphs, k)
+        bm25 = recall_at_k(questions, gold_answers, rankings, k)
+        print("{:>5} {:>8.2%} {:>8.2%} {:>+8.2%}".format(k, first, bm25, bm25 - first))
+
+    if engine is not None:
+        first_k = [(question, paragraphs[:args.rerank_top_k]) for question, paragraphs in questions]
+        reports = [("first_k", engine_report(engine, first_k, gold_answers, args.questions_per_call,
+                                             args.strip_particles))]
+        engine.rerank_top_k = args.rerank_top_k
+        engine.paragraph_ranker = ranker
+        reports.append(("bm25", engine_report(engine, questions, gold_answers, args.questions_per_call,
+                                              args.strip_particles)))
+        print("{:>8} {:>11} {:>13} {:>7} {:>7}".format("reader", "paragraphs", "questions/s", "EM", "F1"))
+        for name, report in reports:
+            print("{:>8} {:>11.2f} {:>13.1f} {:>7.2f} {:>7.2f}".format(
+                name, report["paragraphs_read"], report["questions_per_sec"], report["exact"], report["f1"]
+            ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+KorQuAD open 문단 조기 종료 보정
+
+dev 질문의 모든 문단을 한 번 예측한 뒤, 문단을 순서대로 (--paragraphs_per_wave 개씩) 읽다가 고른 답의 확률이 기준을 넘으면 멈추는
+QAEngine 의 조기 종료를 기준마다 재현하여 평균 읽은 문단 수와 질문 단위 EM/F1 을 비교함
+F1 감소가 --max_f1_drop 이하인 가장 낮은 기준을 stop_probability 로 고르고, --verify 이면 실제 QAEngine 으로 같은 답과 속도를 확인함
+
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from qa_engine import (
+    QAEngine,
+    add_checkpoint_args,
+    load_gold_answers,
+    load_questions,
+    replay_early_stopping,
+    score_answers,
+)
+
+
+def paragraph_nbests(engine, questions, questions_per_call):
+    """n-best lists of all (non-empty) paragraphs of each question, in priority order."""
+    question_nbests = []
+    for start in range(0, len(questions), questions_per_call):
+        chunk = questions[start:start + questions_per_call]
+        examples = engine.make_examples(chunk)
+        nbests = engine.predict_nbests(examples) if examples else {}
+        chunk_nbests = [[] for _ in chunk]
+        for example in examples:
+            chunk_nbests[example.question_id].append(nbests[example.qas_id])
+        question_nbests.extend(chunk_nbests)
+    return question_nbests
+
+
+def early_stopping_report(question_nbests, gold_answers, stop_probability, paragraphs_per_wave, strip_particles):
+    texts, paragraphs_read = [], []
+    for nbests in question_nbests:
+        if nbests:
+            _, entry, read = replay_early_stopping(nbests, stop_probability, paragraphs_per_wave)
+            texts.append(entry["text"])
+            paragraphs_read.append(read)
+        else:
+            texts.append("")
+            paragraphs_read.append(0)
+    exact, f1 = score_answers(texts, gold_answers, strip_particles)
+    return {
+        "stop_probability": stop_probability,
+        "paragraphs_read": float(np.mean(paragraphs_read)),
+        "exact": exact,
+        "f1": f1,
+        "texts": texts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_checkpoint_args(parser)
+    parser.add_argument("--predict_file", required=True, type=str, help="KorQuAD open json file with the answers.")
+    parser.add_argument("--max_questions", default=None, type=int, help="Only answer the first X questions.")
+    parser.add_argument("--max_paragraphs", default=5, type=int, help="Paragraphs per question without stopping.")
+    parser.add_argument("--paragraphs_per_wave", default=1, type=int, help="Paragraphs per question and wave.")
+    parser.add_argument(
+        "--thresholds",
+        default=[0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98, 0.99],
+        nargs="+",
+        type=float,
+        help="Candidate stop probabilities.",
+    )
+    parser.add_argument("--max_f1_drop", default=0.2, type=float, help="F1 points the calibrated threshold may lose.")
+    parser.add_argument("--output_file", default=None, type=str, help="Write the calibrated threshold and its report.")
+    parser.add_argument("--verify", action="store_true", help="Check and time the threshold with QAEngine itself.")
+    parser.add_argument("--questions_per_call", default=16, type=int, help="Questions per answer_many call.")
+    parser.add_argument("--batch_size", default=64, type=int, help="Features per forward pass.")
+    parser.add_argument("--device", default=None, type=str, help="Device of the model, cuda if available.")
+    parser.add_argument("--strip_particles", action="store_true", help="Score like squad_evaluate --strip_particles.")
+    args = parser.parse_args()
+
+    engine = QAEngine.from_checkpoint(
+        args.checkpoint_dir, config_name=args.config_name, device=args.device, batch_size=args.batch_size
+    )
+    questions = load_questions(args.predict_file, args.max_paragraphs)[:args.max_questions]
+    gold_answers = load_gold_answers(args.predict_file)[:len(questions)]
+    question_nbests = paragraph_nbests(engine, questions, args.questions_per_call)
+
+    def report(stop_probability):
+        return early_stopping_report(
+            question_nbests, gold_answers, stop_probability, args.paragraphs_per_wave, args.strip_particles
+        )
+
+    full = report(None)
+    reports = [report(threshold) for threshold in sorted(args.thresholds)]
+    print("{:>10} {:>11} {:>7} {:>7} {:>8}".format("threshold", "paragraphs", "EM", "F1", "F1_delta"))
+    for line in [full] + reports:
+        print("{:>10} {:>11.2f} {:>7.2f} {:>7.2f} {:>+8.2f}".format(
+            "none" if line["stop_probability"] is None else "{:g}".format(line["stop_probability"]),
+            line["paragraphs_read"], line["exact"], line["f1"], line["f1"] - full["f1"],
+        ))
+
+    # The lowest threshold within the F1 budget stops earliest
+    calibrated = next((line for line in reports if full["f1"] - line["f1"] <= args.max_f1_drop), None)
+    if calibrated is None:
+        raise SystemExit("No threshold loses at most {} F1 points.".format(args.max_f1_drop))
+    summary = {
+        "stop_probability": calibrated["stop_probability"],
+        "paragraphs_per_wave": args.paragraphs_per_wave,
+        "paragraphs_read": calibrated["paragraphs_read"],
+        "full_paragraphs_read": full["paragraphs_read"],
+        "f1": calibrated["f1"],
+        "f1_delta": calibrated["f1"] - full["f1"],
+        "exact_delta": calibrated["exact"] - full["exact"],
+    }
+
+    if args.verify:
+        times = {}
+        for name, stop_probability in (("full", None), ("early_stopping", calibrated["stop_probability"])):
+            engine.stop_probability = stop_probability
+            engine.paragraphs_per_wave = args.paragraphs_per_wave
+            start_time = time.monotonic()
+            answers = []
+            for start in range(0, len(questions), args.questions_per_call):
+                answers.extend(engine.answer_many(questions[start:start + args.questions_per_call]))
+            times[name] = time.monotonic() - start_time
+        mismatches = sum(answer.text != text for answer, text in zip(answers, calibrated["texts"]))
+        summary.update({"mismatches": mismatches, "speedup": times["full"] / times["early_stopping"]})
+
+    print(json.dumps(summary))
+    if args.output_file:
+        with open(args.output_file, "w") as writer:
+            json.dump(summary, writer, indent=4)
+
+
+if __name__ == "__main__":
+    main()
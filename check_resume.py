@@ -0,0 +1,79 @@
+"""
+KorQuAD open 학습 재개 확인
+
+같은 run_squad.py 인자로 2N 스텝을 끊지 않고 학습하면서 N, 2N 스텝에 로컬 체크포인트를 저장하고,
+N 스텝 체크포인트 (training_state.pt) 에서 학습을 재개하여 2N 스텝까지 학습한 뒤 두 checkpoint-2N 의 가중치와 누적 loss 를 비교함
+데이터 순서, dropout 의 RNG 상태, optimizer 와 scheduler 가 모두 복원되어야 두 학습이 같은 경로를 따름
+
+예) python check_resume.py --resume_step 20 --output_dir resume_check -- --model_type electra ... --do_train
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+import torch
+
+from transformers import WEIGHTS_NAME
+
+
+def run_squad(run_squad_args, model_name_or_path, output_dir, max_steps, save_steps):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_squad.py")]
+    command += run_squad_args + [
+        "--model_name_or_path", model_name_or_path,
+        "--output_dir", output_dir,
+        "--max_steps", str(max_steps),
+        "--save_steps", str(save_steps),
+        "--overwrite_output_dir",
+    ]
+    subprocess.run(command, check=True)
+
+
+def compare_checkpoints(expected_dir, resumed_dir):
+    """Largest absolute weight difference and the accumulated training losses of two local checkpoints."""
+    expected = torch.load(os.path.join(expected_dir, WEIGHTS_NAME), map_location="cpu")
+    resumed = torch.load(os.path.join(resumed_dir, WEIGHTS_NAME), map_location="cpu")
+    max_diff = max(float((expected[name].float() - resumed[name].float()).abs().max()) for name in expected)
+    losses = [
+        torch.load(os.path.join(checkpoint, "training_state.pt"), map_location="cpu")["tr_loss"]
+        for checkpoint in (expected_dir, resumed_dir)
+    ]
+    return max_diff, losses
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume_step", required=True, type=int, help="Global step N the training is resumed at.")
+    parser.add_argument("--output_dir", required=True, type=str, help="Directory of the two trainings.")
+    parser.add_argument("--atol", default=1e-6, type=float, help="Largest weight and loss difference allowed.")
+    args, run_squad_args = parser.parse_known_args()
+    if run_squad_args[:1] == ["--"]:
+        run_squad_args = run_squad_args[1:]
+
+    # --model_name_or_path differs between the two trainings
+    if "--model_name_or_path" not in run_squad_args:
+        raise SystemExit("Give the run_squad.py arguments, with --model_name_or_path and --do_train.")
+    i = run_squad_args.index("--model_name_or_path")
+    model_name_or_path = run_squad_args[i + 1]
+    run_squad_args = run_squad_args[:i] + run_squad_args[i + 2:]
+
+    n = args.resume_step
+    full_dir = os.path.join(args.output_dir, "full")
+    resumed_dir = os.path.join(args.output_dir, "resumed")
+    run_squad(run_squad_args, model_name_or_path, full_dir, 2 * n, n)
+    run_squad(run_squad_args, os.path.join(full_dir, "checkpoint-{}".format(n)), resumed_dir, 2 * n, n)
+
+    checkpoint = "checkpoint-{}".format(2 * n)
+    max_diff, (full_loss, resumed_loss) = compare_checkpoints(
+        os.path.join(full_dir, checkpoint), os.path.join(resumed_dir, checkpoint)
+    )
+    print("step {}: largest weight difference {:.2e}, tr_loss {:.6f} (uninterrupted) vs {:.6f} (resumed at {})".format(
+        2 * n, max_diff, full_loss, resumed_loss, n))
+    if max_diff > args.atol or abs(full_loss - resumed_loss) > args.atol:
+        raise SystemExit("The resumed training left the trajectory of the uninterrupted one.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+체크포인트 백그라운드 저장
+
+save_steps 마다 학습 루프가 직렬화를 기다리지 않도록, CPU로 복사한 state를 별도 스레드에서 저장함
+
+"""
+
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+
+import torch
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+logger.addHandler(handler)
+
+
+def to_cpu(obj):
+    """ Recursively copies the tensors of a state dict (or nested dicts/lists of them) to the CPU """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [to_cpu(v) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(to_cpu(v) for v in obj)
+    return obj
+
+
+def temporary_directory(output_dir):
+    """ Hidden sibling of `output_dir` in which a checkpoint is written before it is moved into place """
+    parent, name = os.path.split(output_dir.rstrip("/"))
+    return os.path.join(parent, ".{}.tmp".format(name))
+
+
+def replace_directory(tmp_dir, output_dir):
+    """ Moves a completely written checkpoint directory to `output_dir`, replacing an older one """
+    output_dir = output_dir.rstrip("/")
+    if not os.path.exists(output_dir):
+        os.rename(tmp_dir, output_dir)
+        return
+
+    parent, name = os.path.split(output_dir)
+    old_dir = os.path.join(parent, ".{}.old".format(name))
+    shutil.rmtree(old_dir, ignore_errors=True)
+    os.rename(output_dir, old_dir)
+    os.rename(tmp_dir, output_dir)
+    shutil.rmtree(old_dir)
+
+
+class CheckpointWriter(object):
+    """
+    Runs checkpoint writes one after another in a background thread.
+
+    The submitted functions must only use CPU copies of the states (see `to_cpu`), since training keeps updating
+    the live ones. At most `max_pending` writes are queued, `submit` blocks beyond that. A failed write is raised
+    again by the next `submit`, `flush` or `close`.
+    """
+
+    def __init__(self, max_pending=2):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs = job
+                fn(*args, **kwargs)
+            except Exception as e:
+                logger.exception("Checkpoint write failed")
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Background checkpoint write failed: {}".format(error))
+
+    def submit(self, fn, *args, **kwargs):
+        self._raise_error()
+        self.jobs.put((fn, args, kwargs))
+
+    def flush(self):
+        """ Waits until every submitted write is on disk """
+        self.jobs.join()
+        self._raise_error()
+
+    def close(self):
+        self.flush()
+        self.jobs.put(None)
+        self.thread.join()
@@ -0,0 +1,284 @@
+"""
+KorQuAD open 형 ELECTRA 질의응답 모델
+
+run_squad.py 의 학습, qa_engine.py 의 추론에서 같이 사용함
+ElectraForMultiheadQuestionAnswering 은 run_squad_multihead.py 의 데이터 출처 (src) 별 출력 층을 가진 모델
+ElectraForEarlyExitQuestionAnswering 은 중간 층의 [CLS] 로 답이 없는 특징을 판별하여 남은 층을 건너뛰는 모델
+NSML 없이 import 할 수 있도록 학습 스크립트에서 분리함
+
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from transformers import ElectraModel, ElectraPreTrainedModel
+
+
+class ElectraForQuestionAnswering(ElectraPreTrainedModel):
+    def __init__(self, config):
+        super(ElectraForQuestionAnswering, self).__init__(config)
+        self.num_labels = config.num_labels
+
+        self.electra = ElectraModel(config)
+        self.qa_outputs = nn.Linear(config.hidden_size, config.num_labels)
+
+        self.init_weights()
+
+    def forward(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        token_type_ids=None,
+        position_ids=None,
+        head_mask=None,
+        inputs_embeds=None,
+        start_positions=None,
+        end_positions=None,
+    ):
+        outputs = self.electra(
+            input_ids, attention_mask, token_type_ids, position_ids, head_mask, inputs_embeds
+        )
+
+        sequence_output = outputs[0]
+
+        logits = self.qa_outputs(sequence_output)
+        start_logits, end_logits = logits.split(1, dim=-1)
+        start_logits = start_logits.squeeze(-1)
+        end_logits = end_logits.squeeze(-1)
+
+        outputs = (start_logits, end_logits,) + outputs[2:]
+        if start_positions is not None and end_positions is not None:
+            # If we are on multi-GPU, split add a dimension
+            if len(start_positions.size()) > 1:
+                start_positions = start_positions.squeeze(-1)
+            if len(end_positions.size()) > 1:
+                end_positions = end_positions.squeeze(-1)
+            # sometimes the start/end positions are outside our model inputs, we ignore these terms
+            ignored_index = start_logits.size(1)
+            start_positions.clamp_(0, ignored_index)
+            end_positions.clamp_(0, ignored_index)
+
+            loss_fct = torch.nn.CrossEntropyLoss(ignore_index=ignored_index)
+            start_loss = loss_fct(start_logits, start_positions)
+            end_loss = loss_fct(end_logits, end_positions)
+            total_loss = (start_loss + end_loss) / 2
+            outputs = (total_loss,) + outputs
+
+        return outputs  # (loss), start_logits, end_logits, (hidden_states), (attentions)
+
+
+class ElectraForMultiheadQuestionAnswering(ElectraPreTrainedModel):
+    def __init__(self, config):
+        super(ElectraForMultiheadQuestionAnswering, self).__init__(config)
+        self.num_labels = config.num_labels
+
+        self.electra = ElectraModel(config)
+        self.qa_outputs_0 = nn.Linear(config.hidden_size, config.num_labels)
+        self.qa_outputs_1 = nn.Linear(config.hidden_size, config.num_labels)
+        self.qa_outputs_2 = nn.Linear(config.hidden_size, config.num_labels)
+        self.qa_outputs_3 = nn.Linear(config.hidden_size, config.num_labels)
+        self.qa_outputs_4 = nn.Linear(config.hidden_size, config.num_labels)
+
+        self.qa_outputs = [self.qa_outputs_0, self.qa_outputs_1, self.qa_outputs_2, self.qa_outputs_3, self.qa_outputs_4]
+
+        self.init_weights()
+
+    def forward(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        token_type_ids=None,
+        position_ids=None,
+        head_mask=None,
+        inputs_embeds=None,
+        start_positions=None,
+        end_positions=None,
+        src=None,
+        flag=True
+    ):
+        outputs = self.electra(
+            input_ids, attention_mask, token_type_ids, position_ids, head_mask, inputs_embeds
+        )
+
+        sequence_output = outputs[0]
+
+        if flag:
+            logits = self.qa_outputs[0](sequence_output)
+        else:
+            logits = []
+            for i in range(src.size(0)):
+                logit = self.qa_outputs[src[i]](sequence_output[i].unsqueeze(0))
+                logits.append(logit)
+            logits = torch.cat(logits, dim=0)
+
+        start_logits, end_logits = logits.split(1, dim=-1)
+        start_logits = start_logits.squeeze(-1)
+        end_logits = end_logits.squeeze(-1)
+
+        outputs = (start_logits, end_logits,) + outputs[1:]
+        if start_positions is not None and end_positions is not None:
+            # If we are on multi-GPU, split add a dimension
+            if len(start_positions.size()) > 1:
+                start_positions = start_positions.squeeze(-1)
+            if len(end_positions.size()) > 1:
+                end_positions = end_positions.squeeze(-1)
+            # sometimes the start/end positions are outside our model inputs, we ignore these terms
+            ignored_index = start_logits.size(1)
+            start_positions.clamp_(0, ignored_index)
+            end_positions.clamp_(0, ignored_index)
+
+            loss_fct = torch.nn.CrossEntropyLoss(ignore_index=ignored_index)
+            start_loss = loss_fct(start_logits, start_positions)
+            end_loss = loss_fct(end_logits, end_positions)
+            total_loss = (start_loss + end_loss) / 2
+            outputs = (total_loss,) + outputs
+
+        return outputs  # (loss), start_logits, end_logits, (hidden_states), (attentions)
+
+
+# Start and end logits of a feature that left at an exit, every position but [CLS]
+NO_ANSWER_LOGIT = -10000.0
+
+
+class ElectraNoAnswerExit(nn.Module):
+    """Logit of "no answer" for each feature, from the [CLS] hidden state of an intermediate layer."""
+
+    def __init__(self, config):
+        super(ElectraNoAnswerExit, self).__init__()
+        self.dense = nn.Linear(config.hidden_size, config.hidden_size)
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.out_proj = nn.Linear(config.hidden_size, 1)
+
+    def forward(self, hidden_states):
+        x = self.dropout(hidden_states[:, 0])
+        x = self.dropout(F.gelu(self.dense(x)))
+        return self.out_proj(x).squeeze(-1)
+
+
+class ElectraForEarlyExitQuestionAnswering(ElectraPreTrainedModel):
+    """
+    ElectraForQuestionAnswering with "no answer" exits after some of its layers, it loads the weights of an
+    ElectraForQuestionAnswering checkpoint and initializes the exits. An exit is trained to predict that a feature
+    has no answer span in it (its start and end positions are [CLS]).
+
+    With `exit_threshold` set, evaluation stops running the layers of a feature once an exit gives it a "no answer"
+    probability of at least exit_threshold. Its logits are then NO_ANSWER_LOGIT but at [CLS], decoded as no answer
+    with version_2_with_negative and as equally improbable spans otherwise. `layers_executed` holds the number of
+    layers run for each feature of the last forward pass.
+
+    Config attributes:
+        exit_layers: Layers (from 1) followed by an exit, by default a quarter, half and three quarters of them
+        exit_threshold: None by default, every feature runs through every layer
+        exit_loss_weight: Weight of the exits' loss added to the QA loss in training, 1.0 by default
+    """
+
+    def __init__(self, config):
+        super(ElectraForEarlyExitQuestionAnswering, self).__init__(config)
+        self.num_labels = config.num_labels
+
+        self.electra = ElectraModel(config)
+        self.qa_outputs = nn.Linear(config.hidden_size, config.num_labels)
+
+        num_layers = config.num_hidden_layers
+        exit_layers = getattr(config, "exit_layers", None) or [num_layers // 4, num_layers // 2, 3 * num_layers // 4]
+        self.exit_layers = sorted(set(layer for layer in exit_layers if 0 < layer < num_layers))
+        self.exits = nn.ModuleList([ElectraNoAnswerExit(config) for _ in self.exit_layers])
+        self.exit_threshold = getattr(config, "exit_threshold", None)
+        self.exit_loss_weight = getattr(config, "exit_loss_weight", 1.0)
+        self.layers_executed = None
+
+        self.init_weights()
+
+    def forward(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        token_type_ids=None,
+        position_ids=None,
+        head_mask=None,
+        inputs_embeds=None,
+        start_positions=None,
+        end_positions=None,
+    ):
+        input_shape = input_ids.size() if input_ids is not None else inputs_embeds.size()[:-1]
+        device = input_ids.device if input_ids is not None else inputs_embeds.device
+        if attention_mask is None:
+            attention_mask = torch.ones(input_shape, device=device)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
+
+        # The layers of ElectraModel.forward, run one by one to look at the exits in between
+        num_layers = self.config.num_hidden_layers
+        extended_attention_mask = self.electra.get_extended_attention_mask(attention_mask, input_shape, device)
+        head_mask = self.electra.get_head_mask(head_mask, num_layers)
+        hidden_states = self.electra.embeddings(
+            input_ids=input_ids, position_ids=position_ids, token_type_ids=token_type_ids, inputs_embeds=inputs_embeds
+        )
+        if hasattr(self.electra, "embeddings_project"):
+            hidden_states = self.electra.embeddings_project(hidden_states)
+
+        early_exit = self.exit_threshold is not None and not self.training and start_positions is None
+        # Positions in the batch of the features still running
+        running = torch.arange(input_shape[0], device=device)
+        layers_executed = torch.full((input_shape[0],), num_layers, dtype=torch.long, device=device)
+        exit_logits = []
+        for i, layer in enumerate(self.electra.encoder.layer):
+            hidden_states = layer(hidden_states, extended_attention_mask, head_mask[i])[0]
+            if i + 1 not in self.exit_layers:
+                continue
+            logits = self.exits[self.exit_layers.index(i + 1)](hidden_states)
+            exit_logits.append(logits)
+            if not early_exit:
+                continue
+            exiting = torch.sigmoid(logits) >= self.exit_threshold
+            if exiting.any():
+                layers_executed[running[exiting]] = i + 1
+                staying = ~exiting
+                running = running[staying]
+                hidden_states = hidden_states[staying]
+                extended_attention_mask = extended_attention_mask[staying]
+                if running.numel() == 0:
+                    break
+        self.layers_executed = layers_executed
+
+        if early_exit:
+            start_logits = hidden_states.new_full(input_shape, NO_ANSWER_LOGIT)
+            start_logits[:, 0] = 0.0
+            end_logits = start_logits.clone()
+            if running.numel():
+                logits = self.qa_outputs(hidden_states)
+                start_logits[running] = logits[..., 0]
+                end_logits[running] = logits[..., 1]
+        else:
+            logits = self.qa_outputs(hidden_states)
+            start_logits, end_logits = logits.split(1, dim=-1)
+            start_logits = start_logits.squeeze(-1)
+            end_logits = end_logits.squeeze(-1)
+
+        outputs = (start_logits, end_logits,)
+        if start_positions is not None and end_positions is not None:
+            # If we are on multi-GPU, split add a dimension
+            if len(start_positions.size()) > 1:
+                start_positions = start_positions.squeeze(-1)
+            if len(end_positions.size()) > 1:
+                end_positions = end_positions.squeeze(-1)
+            # sometimes the start/end positions are outside our model inputs, we ignore these terms
+            ignored_index = start_logits.size(1)
+            start_positions.clamp_(0, ignored_index)
+            end_positions.clamp_(0, ignored_index)
+
+            loss_fct = torch.nn.CrossEntropyLoss(ignore_index=ignored_index)
+            start_loss = loss_fct(start_logits, start_positions)
+            end_loss = loss_fct(end_logits, end_positions)
+            total_loss = (start_loss + end_loss) / 2
+
+            if exit_logits and self.exit_loss_weight:
+                no_answer = ((start_positions == 0) & (end_positions == 0)).to(exit_logits[0].dtype)
+                exit_loss = sum(
+                    F.binary_cross_entropy_with_logits(logits, no_answer) for logits in exit_logits
+                ) / len(exit_logits)
+                total_loss = total_loss + self.exit_loss_weight * exit_loss
+            outputs = (total_loss,) + outputs
+
+        return outputs  # (loss), start_logits, end_logits
@@ -6,9 +6,11 @@ https://github.com/huggingface/transformers/blob/master/src/transformers/data/pr
 
 """
 
+import collections
 import json
 import logging
 import os
+import random
 import sys
 from functools import partial
 from multiprocessing import Pool, cpu_count
@@ -533,7 +535,7 @@ class SquadProcessor(DataProcessor):
             input_data = json.load(reader)["data"]
         return self._create_examples(input_data, "dev")
 
-    def get_test_examples(self, data_dir, filename=None):
+    def get_test_examples(self, data_dir, filename=None, paragraph_ranker=None, top_k=5):
         """
         Returns the evaluation example from the data directory.
 
@@ -541,6 +543,8 @@ class SquadProcessor(DataProcessor):
             data_dir: Directory containing the data files used for training and evaluating.
             filename: None by default, specify this if the evaluation file has a different name than the original one
                 which is `train-v1.1.json` and `train-v2.0.json` for squad versions 1.1 and 2.0 respectively.
+            paragraph_ranker: None by default, the first 5 paragraphs of each question are used. Otherwise a
+                `paragraph_ranker.BM25Ranker` picking the `top_k` paragraphs of each question, in ranking order.
         """
         if data_dir is None:
             data_dir = ""
@@ -552,15 +556,15 @@ class SquadProcessor(DataProcessor):
                 os.path.join(data_dir, self.dev_file if filename is None else filename), "r", encoding="utf-8"
         ) as reader:
             input_data = json.load(reader)["data"]
-        return self._create_examples(input_data, "test")
+        return self._create_examples(input_data, "test", paragraph_ranker=paragraph_ranker, top_k=top_k)
 
-    def _create_examples(self, input_data, set_type, only_wiki = False):
+    def _create_examples(self, input_data, set_type, only_wiki = False, paragraph_ranker=None, top_k=5):
         is_training = set_type == "train"
         examples = []
 
         has_answer_cnt, no_answer_cnt, qa_num = 0, 0, 0
         has_apply, no_apply=0, 0
-        for entry in input_data[:]:
+        for question_id, entry in enumerate(input_data):
             qa = entry['qa']
             question_text = qa["question"]
             answer_text = qa['answer']
@@ -570,13 +574,20 @@ class SquadProcessor(DataProcessor):
             per_qa_ans_paragraph_cnt = 0
             per_qa_unans_paragraph_cnt = 0
             cnt = 0
-            for pi, paragraph in enumerate(entry["paragraphs"]):
+            paragraph_order = range(len(entry["paragraphs"]))
+            if set_type == "test" and paragraph_ranker is not None:
+                paragraph_order = paragraph_ranker.rank(
+                    question_text, [str(paragraph["contents"]) for paragraph in entry["paragraphs"]], top_k
+                )
+            for pi in paragraph_order:
+                paragraph = entry["paragraphs"][pi]
                 title = paragraph["title"]
                 context_text = str(paragraph["contents"])
                 source = paragraph["source"]
                 if context_text is None:
                     continue
-                qas_id = "{}[SEP]{}[SEP]{}".format(question_text, answer_text, pi)
+                # Index of the example in the returned list, the texts are kept once per question (see qas_metadata)
+                qas_id = len(examples)
                 start_position_character = None
                 answers = []
 
@@ -601,10 +612,13 @@ class SquadProcessor(DataProcessor):
                     title=title,
                     is_impossible=is_impossible,
                     answers=answers,
+                    source=source,
+                    question_id=question_id,
+                    paragraph_index=pi,
                 )
                 if set_type == "test":
                     examples.append(example)
-                    if pi >= 4:
+                    if paragraph_ranker is None and pi >= 4:
                         break
                 else:
                     if is_impossible:
@@ -641,6 +655,48 @@ class SquadProcessor(DataProcessor):
         return examples
 
 
+def qas_metadata(examples):
+    """
+    Side table of the integer qas_ids written next to the prediction files: the question and answer of each
+    question_id, and the (question_id, paragraph_index) of each qas_id.
+    """
+    questions = collections.OrderedDict()
+    for example in examples:
+        questions.setdefault(
+            example.question_id, {"question": example.question_text, "answer": example.answer_text}
+        )
+    return {
+        "questions": questions,
+        "qas": {example.qas_id: [example.question_id, example.paragraph_index] for example in examples},
+    }
+
+
+def stratified_question_subset(examples, num_questions, seed=42):
+    """
+    Picks a fixed sample of about `num_questions` questions and returns the indices of all their examples.
+
+    Questions are stratified by the source of their first paragraph and by whether any of their paragraphs
+    contains the answer. Each stratum contributes in proportion to its size, with at least one question.
+    """
+    questions = collections.OrderedDict()
+    for i, example in enumerate(examples):
+        questions.setdefault(example.question_id, []).append(i)
+
+    strata = collections.defaultdict(list)
+    for question, indices in questions.items():
+        has_answer = any(not examples[i].is_impossible for i in indices)
+        strata[(str(examples[indices[0]].source), has_answer)].append(question)
+
+    rng = random.Random(seed)
+    selected = []
+    for stratum in sorted(strata):
+        stratum_questions = strata[stratum]
+        size = max(1, int(round(num_questions * len(stratum_questions) / len(questions))))
+        selected.extend(rng.sample(stratum_questions, min(size, len(stratum_questions))))
+
+    return sorted(i for question in selected for i in questions[question])
+
+
 class SquadV1Processor(SquadProcessor):
     train_file = "train-v1.1.json"
     dev_file = "dev-v1.1.json"
@@ -657,7 +713,7 @@ class SquadExample(object):
     A single training/test example for the Squad dataset, as loaded from disk.
 
     Args:
-        qas_id: The example's unique identifier
+        qas_id: The example's unique identifier, an integer for KorQuAD open files
         question_text: The question string
         context_text: The context string
         answer_text: The answer string
@@ -665,6 +721,10 @@ class SquadExample(object):
         title: The title of the example
         answers: None by default, this is used during evaluation. Holds answers as well as their start positions.
         is_impossible: False by default, set to True if the example has no possible answer.
+        source: None by default, the source of the paragraph (kdc, view, web, kin, nws).
+        question_id: None by default, the index of the question in the KorQuAD open file, shared by the examples of
+            all its paragraphs.
+        paragraph_index: None by default, the index of the paragraph among the question's paragraphs.
     """
 
     def __init__(
@@ -677,6 +737,9 @@ class SquadExample(object):
             title,
             answers=[],
             is_impossible=False,
+            source=None,
+            question_id=None,
+            paragraph_index=None,
     ):
         self.qas_id = qas_id
         self.question_text = question_text
@@ -685,6 +748,9 @@ class SquadExample(object):
         self.title = title
         self.is_impossible = is_impossible
         self.answers = answers
+        self.source = source
+        self.question_id = question_id
+        self.paragraph_index = paragraph_index
 
         self.start_position, self.end_position = 0, 0
 
@@ -8,13 +8,16 @@ https://github.com/huggingface/transformers/blob/master/src/transformers/data/me
 """
 
 import collections
+import functools
 import json
 import logging
 import math
+import multiprocessing
 import re
 import string
 import sys
 
+import numpy as np
 from transformers.tokenization_bert import BasicTokenizer
 
 logger = logging.getLogger(__name__)
@@ -22,44 +25,59 @@ handler = logging.StreamHandler(sys.stdout)
 logger.addHandler(handler)
 
 
-def normalize_answer(s):
-    """Lower text and remove punctuation, articles and extra whitespace."""
+ARTICLES_REGEX = re.compile(r"\b(a|an|the)\b", re.UNICODE)
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
 
-    def remove_articles(text):
-        regex = re.compile(r"\b(a|an|the)\b", re.UNICODE)
-        return re.sub(regex, " ", text)
+# Korean particles (josa) removed from the end of an answer with strip_particles
+KOREAN_PARTICLES = [
+    "에서부터", "으로부터", "에게서", "으로서", "으로써", "이라는", "이라고", "에서", "에게", "께서", "한테", "으로",
+    "부터", "까지", "처럼", "보다", "이다", "라는", "라고", "로서", "로써", "이나", "이며", "은", "는", "이", "가",
+    "을", "를", "의", "에", "로", "와", "과", "도", "만",
+]
+# The leftmost match is the longest particle. Two Hangul syllables must remain in front of it, so that two syllable
+# nouns ending like a particle (사과, 나이, 한도) are kept whole: 서울에서 -> 서울, 나라도 -> 나라, 사과 -> 사과
+PARTICLES_REGEX = re.compile(r"(?<=[가-힣]{{2}})(?:{})$".format("|".join(KOREAN_PARTICLES)))
 
-    def white_space_fix(text):
-        return " ".join(text.split())
 
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return "".join(ch for ch in text if ch not in exclude)
+@functools.lru_cache(maxsize=2 ** 16)
+def normalize_answer(s, strip_particles=False):
+    """Lower text and remove punctuation, articles and extra whitespace.
 
-    def lower(text):
-        return text.lower()
-
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+    With strip_particles, a Korean particle is also removed from the end of the last word ("서울에서" -> "서울"),
+    where an answer span ends with one.
+    Results are memoized, the same answers are normalized for every paragraph of a question.
+    """
+    text = ARTICLES_REGEX.sub(" ", s.lower().translate(PUNCTUATION_TABLE))
+    if strip_particles:
+        tokens = text.split()
+        if tokens:
+            tokens[-1] = PARTICLES_REGEX.sub("", tokens[-1])
+        return " ".join(tokens)
+    return " ".join(text.split())
 
 
-def get_tokens(s):
+def get_tokens(s, strip_particles=False):
     if not s:
         return []
-    return normalize_answer(s).split()
+    return normalize_answer(s, strip_particles).split()
 
 
-def compute_exact(a_gold, a_pred):
-    return int(normalize_answer(a_gold) == normalize_answer(a_pred))
+def compute_exact(a_gold, a_pred, strip_particles=False):
+    return int(normalize_answer(a_gold, strip_particles) == normalize_answer(a_pred, strip_particles))
 
 
-def compute_f1(a_gold, a_pred):
-    gold_toks = get_tokens(a_gold)
-    pred_toks = get_tokens(a_pred)
-    common = collections.Counter(gold_toks) & collections.Counter(pred_toks)
-    num_same = sum(common.values())
+def compute_f1(a_gold, a_pred, strip_particles=False):
+    return f1_from_tokens(get_tokens(a_gold, strip_particles), get_tokens(a_pred, strip_particles))
+
+
+def f1_from_tokens(gold_toks, pred_toks, pred_counter=None):
     if len(gold_toks) == 0 or len(pred_toks) == 0:
         # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
         return int(gold_toks == pred_toks)
+    if pred_counter is None:
+        pred_counter = collections.Counter(pred_toks)
+    common = collections.Counter(gold_toks) & pred_counter
+    num_same = sum(common.values())
     if num_same == 0:
         return 0
     precision = 1.0 * num_same / len(pred_toks)
@@ -68,28 +86,70 @@ def compute_f1(a_gold, a_pred):
     return f1
 
 
-def get_raw_scores(examples, preds):
+def score_prediction(gold_answers, prediction, strip_particles=False):
     """
-    Computes the exact and f1 scores from the examples and the model predictions
+    Exact and f1 scores of a prediction against its best gold answer, each answer is normalized once
     """
-    exact_scores = {}
-    f1_scores = {}
+    gold_toks_list = [toks for toks in (get_tokens(a, strip_particles) for a in gold_answers) if toks]
+    if not gold_toks_list:
+        # For unanswerable questions, only correct answer is empty string
+        gold_toks_list = [[]]
+
+    pred_toks = get_tokens(prediction, strip_particles)
+    pred_counter = collections.Counter(pred_toks)
+    exact = max(int(gold_toks == pred_toks) for gold_toks in gold_toks_list)
+    f1 = max(f1_from_tokens(gold_toks, pred_toks, pred_counter) for gold_toks in gold_toks_list)
+    return exact, f1
 
-    for example in examples:
-        qas_id = example.qas_id
-        gold_answers = [answer["text"] for answer in example.answers if normalize_answer(answer["text"])]
 
-        if not gold_answers:
-            # For unanswerable questions, only correct answer is empty string
-            gold_answers = [""]
+# (qas_id, gold answers, prediction) items of a parallel get_raw_scores, inherited by the forked workers
+_scoring_items = None
 
+
+def _score_predictions(items, strip_particles=False):
+    return [score_prediction(gold_answers, prediction, strip_particles) for _, gold_answers, prediction in items]
+
+
+def _score_prediction_range(start_end, strip_particles=False):
+    start, end = start_end
+    return _score_predictions(_scoring_items[start:end], strip_particles)
+
+
+def get_raw_scores(examples, preds, strip_particles=False, num_workers=1):
+    """
+    Computes the exact and f1 scores from the examples and the model predictions
+
+    With num_workers > 1 the predictions are scored in that many processes, except inside a daemonic worker
+    process (e.g. of --eval_all_checkpoints), which cannot start its own.
+    """
+    items = []
+    for example in examples:
+        qas_id = example.qas_id
         if qas_id not in preds:
             print("Missing prediction for %s" % qas_id)
             continue
+        items.append((qas_id, [answer["text"] for answer in example.answers], preds[qas_id]))
+
+    if num_workers > 1 and len(items) > num_workers and not multiprocessing.current_process().daemon:
+        global _scoring_items
+        # Forked workers see the items, only the index ranges and the scores are sent between processes
+        _scoring_items = items
+        chunk_size = (len(items) + num_workers * 4 - 1) // (num_workers * 4)
+        ranges = [(start, start + chunk_size) for start in range(0, len(items), chunk_size)]
+        try:
+            with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+                score_fn = functools.partial(_score_prediction_range, strip_particles=strip_particles)
+                scores = [score for range_scores in pool.map(score_fn, ranges) for score in range_scores]
+        finally:
+            _scoring_items = None
+    else:
+        scores = _score_predictions(items, strip_particles)
 
-        prediction = preds[qas_id]
-        exact_scores[qas_id] = max(compute_exact(a, prediction) for a in gold_answers)
-        f1_scores[qas_id] = max(compute_f1(a, prediction) for a in gold_answers)
+    exact_scores = {}
+    f1_scores = {}
+    for (qas_id, _, _), (exact, f1) in zip(items, scores):
+        exact_scores[qas_id] = exact
+        f1_scores[qas_id] = f1
 
     return exact_scores, f1_scores
 
@@ -131,43 +191,63 @@ def merge_eval(main_eval, new_eval, prefix):
         main_eval["%s_%s" % (prefix, k)] = new_eval[k]
 
 
-def find_best_thresh_v2(preds, scores, na_probs, qid_to_has_ans):
+def _no_answer_score_gains(preds, score_dicts, na_probs, qid_to_has_ans):
+    """
+    Sorts the scored qids by no-answer probability (stably, like sorted) and returns, in that order, their
+    probabilities, whether they have an answer, and for each score dict the gain of answering instead of abstaining
+    """
+    qids = [qid for qid in na_probs if qid in score_dicts[0]]
+    probs = np.fromiter((na_probs[qid] for qid in qids), dtype=np.float64, count=len(qids))
+    order = np.argsort(probs, kind="stable")
+
+    has_ans = np.fromiter((bool(qid_to_has_ans[qid]) for qid in qids), dtype=bool, count=len(qids))
+    # Answering a question without answer costs one point if the prediction is not empty
+    no_ans_gain = np.fromiter((-1.0 if preds[qid] else 0.0 for qid in qids), dtype=np.float64, count=len(qids))
+    gains = []
+    for scores in score_dicts:
+        qid_scores = np.fromiter((scores[qid] for qid in qids), dtype=np.float64, count=len(qids))
+        gains.append(np.where(has_ans, qid_scores, no_ans_gain)[order])
+    return probs[order], has_ans[order], gains
+
+
+def find_best_thresholds(preds, score_dicts, na_probs, qid_to_has_ans, with_has_ans=False):
+    """
+    Best score and no-answer threshold for each of `score_dicts` (e.g. exact and f1), with a single sort.
+
+    Predicting no answer for every qid above the threshold, the score is the number of questions without answer
+    plus the cumulative gain of answering the qids up to the threshold. The best threshold is the probability of
+    the first qid where the cumulative score peaks, 0.0 if abstaining everywhere is best.
+    With `with_has_ans`, the mean score over the questions with an answer is returned as well.
+    """
     num_no_ans = sum(1 for k in qid_to_has_ans if not qid_to_has_ans[k])
-    cur_score = num_no_ans
-    best_score = cur_score
-    best_thresh = 0.0
-    qid_list = sorted(na_probs, key=lambda k: na_probs[k])
-    for i, qid in enumerate(qid_list):
-        if qid not in scores:
-            continue
-        if qid_to_has_ans[qid]:
-            diff = scores[qid]
-        else:
-            if preds[qid]:
-                diff = -1
-            else:
-                diff = 0
-        cur_score += diff
-        if cur_score > best_score:
-            best_score = cur_score
-            best_thresh = na_probs[qid]
-
-    has_ans_score, has_ans_cnt = 0, 0
-    for qid in qid_list:
-        if not qid_to_has_ans[qid]:
-            continue
-        has_ans_cnt += 1
+    probs, has_ans, gains = _no_answer_score_gains(preds, score_dicts, na_probs, qid_to_has_ans)
+    has_ans_cnt = sum(1 for qid in na_probs if qid_to_has_ans[qid])
+
+    results = []
+    for scores, qid_gains in zip(score_dicts, gains):
+        best_score, best_thresh = num_no_ans, 0.0
+        if len(qid_gains):
+            # Starting the sum at num_no_ans adds the floats in the same order as a running total would
+            cur_scores = np.cumsum(np.concatenate([[num_no_ans], qid_gains]))[1:]
+            best_index = int(np.argmax(cur_scores))
+            if cur_scores[best_index] > num_no_ans:
+                best_score, best_thresh = float(cur_scores[best_index]), float(probs[best_index])
+        result = (100.0 * best_score / len(scores), best_thresh)
+        if with_has_ans:
+            result += (1.0 * sum(qid_gains[has_ans].tolist()) / has_ans_cnt,)
+        results.append(result)
+    return results
 
-        if qid not in scores:
-            continue
-        has_ans_score += scores[qid]
 
-    return 100.0 * best_score / len(scores), best_thresh, 1.0 * has_ans_score / has_ans_cnt
+def find_best_thresh_v2(preds, scores, na_probs, qid_to_has_ans):
+    (result,) = find_best_thresholds(preds, [scores], na_probs, qid_to_has_ans, with_has_ans=True)
+    return result
 
 
 def find_all_best_thresh_v2(main_eval, preds, exact_raw, f1_raw, na_probs, qid_to_has_ans):
-    best_exact, exact_thresh, has_ans_exact = find_best_thresh_v2(preds, exact_raw, na_probs, qid_to_has_ans)
-    best_f1, f1_thresh, has_ans_f1 = find_best_thresh_v2(preds, f1_raw, na_probs, qid_to_has_ans)
+    (best_exact, exact_thresh, has_ans_exact), (best_f1, f1_thresh, has_ans_f1) = find_best_thresholds(
+        preds, [exact_raw, f1_raw], na_probs, qid_to_has_ans, with_has_ans=True
+    )
     main_eval["best_exact"] = best_exact
     main_eval["best_exact_thresh"] = exact_thresh
     main_eval["best_f1"] = best_f1
@@ -177,31 +257,14 @@ def find_all_best_thresh_v2(main_eval, preds, exact_raw, f1_raw, na_probs, qid_t
 
 
 def find_best_thresh(preds, scores, na_probs, qid_to_has_ans):
-    num_no_ans = sum(1 for k in qid_to_has_ans if not qid_to_has_ans[k])
-    cur_score = num_no_ans
-    best_score = cur_score
-    best_thresh = 0.0
-    qid_list = sorted(na_probs, key=lambda k: na_probs[k])
-    for _, qid in enumerate(qid_list):
-        if qid not in scores:
-            continue
-        if qid_to_has_ans[qid]:
-            diff = scores[qid]
-        else:
-            if preds[qid]:
-                diff = -1
-            else:
-                diff = 0
-        cur_score += diff
-        if cur_score > best_score:
-            best_score = cur_score
-            best_thresh = na_probs[qid]
-    return 100.0 * best_score / len(scores), best_thresh
+    (result,) = find_best_thresholds(preds, [scores], na_probs, qid_to_has_ans)
+    return result
 
 
 def find_all_best_thresh(main_eval, preds, exact_raw, f1_raw, na_probs, qid_to_has_ans):
-    best_exact, exact_thresh = find_best_thresh(preds, exact_raw, na_probs, qid_to_has_ans)
-    best_f1, f1_thresh = find_best_thresh(preds, f1_raw, na_probs, qid_to_has_ans)
+    (best_exact, exact_thresh), (best_f1, f1_thresh) = find_best_thresholds(
+        preds, [exact_raw, f1_raw], na_probs, qid_to_has_ans
+    )
 
     main_eval["best_exact"] = best_exact
     main_eval["best_exact_thresh"] = exact_thresh
@@ -209,7 +272,9 @@ def find_all_best_thresh(main_eval, preds, exact_raw, f1_raw, na_probs, qid_to_h
     main_eval["best_f1_thresh"] = f1_thresh
 
 
-def squad_evaluate(examples, preds, no_answer_probs=None, no_answer_probability_threshold=1.0):
+def squad_evaluate(
+    examples, preds, no_answer_probs=None, no_answer_probability_threshold=1.0, strip_particles=False, num_workers=1
+):
     qas_id_to_has_answer = {example.qas_id: bool(example.answers) for example in examples}
     has_answer_qids = [qas_id for qas_id, has_answer in qas_id_to_has_answer.items() if has_answer]
     no_answer_qids = [qas_id for qas_id, has_answer in qas_id_to_has_answer.items() if not has_answer]
@@ -217,7 +282,7 @@ def squad_evaluate(examples, preds, no_answer_probs=None, no_answer_probability_
     if no_answer_probs is None:
         no_answer_probs = {k: 0.0 for k in preds}
 
-    exact, f1 = get_raw_scores(examples, preds)
+    exact, f1 = get_raw_scores(examples, preds, strip_particles=strip_particles, num_workers=num_workers)
 
     exact_threshold = apply_no_ans_threshold(
         exact, no_answer_probs, qas_id_to_has_answer, no_answer_probability_threshold
@@ -240,41 +305,41 @@ def squad_evaluate(examples, preds, no_answer_probs=None, no_answer_probability_
     return evaluation
 
 
-# TODO : incomplete
-def squad_open_evaluate(examples, preds, no_answer_probs=None, no_answer_probability_threshold=1.0):
-    qas_id_to_has_answer = {example.qas_id: bool(example.answers) for example in examples}
-    has_answer_qids = [qas_id for qas_id, has_answer in qas_id_to_has_answer.items() if has_answer]
-    no_answer_qids = [qas_id for qas_id, has_answer in qas_id_to_has_answer.items() if not has_answer]
-
-    open_qas_id_to_has_answer = {'[SEP]'.join(qas_id.split('[SEP]')[:2]): [] for qas_id in qas_id_to_has_answer}
-    for qas_id, has_answer in qas_id_to_has_answer.items():
-        open_qas_id_to_has_answer['[SEP]'.join(qas_id.split('[SEP]')[:2])].append(
-            {'id': qas_id,
-             'has_answer': has_answer}
-        )
+def squad_open_evaluate(examples, all_nbest_json, strip_particles=False):
+    """
+    Question level evaluation of KorQuAD open: the answers of each question's paragraphs are aggregated like the
+    test submission (see `aggregate_question_answers`) and scored against the question's answer.
 
-    if no_answer_probs is None:
-        no_answer_probs = {k: 0.0 for k in preds}
+    HasAns/NoAns split the questions by whether any of their paragraphs contains the answer.
+    """
+    question_answers = aggregate_question_answers(
+        (example.question_id, all_nbest_json[example.qas_id]) for example in examples
+        if example.qas_id in all_nbest_json
+    )
 
-    exact, f1 = get_raw_scores(examples, preds)
+    gold_answers = {}
+    question_has_answer = {}
+    for example in examples:
+        gold_answers[example.question_id] = example.answer_text
+        question_has_answer[example.question_id] = question_has_answer.get(example.question_id, False) or bool(
+            example.answers
+        )
 
-    exact_threshold = apply_no_ans_threshold(
-        exact, no_answer_probs, qas_id_to_has_answer, no_answer_probability_threshold
-    )
-    f1_threshold = apply_no_ans_threshold(f1, no_answer_probs, qas_id_to_has_answer, no_answer_probability_threshold)
+    exact, f1 = {}, {}
+    for question_id, prediction in question_answers.items():
+        exact[question_id], f1[question_id] = score_prediction(
+            [gold_answers[question_id]], prediction, strip_particles
+        )
 
-    evaluation = make_eval_dict(exact_threshold, f1_threshold)
+    evaluation = make_eval_dict(exact, f1)
 
+    has_answer_qids = [qid for qid in question_answers if question_has_answer[qid]]
     if has_answer_qids:
-        has_ans_eval = make_eval_dict(exact_threshold, f1_threshold, qid_list=has_answer_qids)
-        merge_eval(evaluation, has_ans_eval, "HasAns")
+        merge_eval(evaluation, make_eval_dict(exact, f1, qid_list=has_answer_qids), "HasAns")
 
+    no_answer_qids = [qid for qid in question_answers if not question_has_answer[qid]]
     if no_answer_qids:
-        no_ans_eval = make_eval_dict(exact_threshold, f1_threshold, qid_list=no_answer_qids)
-        merge_eval(evaluation, no_ans_eval, "NoAns")
-
-    if no_answer_probs:
-        find_all_best_thresh(evaluation, preds, exact, f1, no_answer_probs, qas_id_to_has_answer)
+        merge_eval(evaluation, make_eval_dict(exact, f1, qid_list=no_answer_qids), "NoAns")
 
     return evaluation
 
@@ -439,8 +504,15 @@ def compute_predictions_logits(
         null_score_diff_threshold,
         tokenizer,
         is_test=False,
+        return_details=False,
 ):
-    """Write final predictions to the json file and log-odds of null if needed."""
+    """Write final predictions to the json file and log-odds of null if needed. Output files that are None are not
+    written.
+
+    With return_details (not for is_test), also returns a dict with the n-best answers ("nbest", for
+    `squad_open_evaluate`), the null score differences ("scores_diff") and the best non-null prediction
+    ("non_null_predictions") of each example, from which `squad_evaluate` can tune null_score_diff_threshold.
+    """
     #logger.info("Writing predictions to: %s" % (output_prediction_file))
     #logger.info("Writing nbest to: %s" % (output_nbest_file))
 
@@ -459,6 +531,7 @@ def compute_predictions_logits(
     all_predictions = collections.OrderedDict()
     all_nbest_json = collections.OrderedDict()
     scores_diff_json = collections.OrderedDict()
+    non_null_predictions = collections.OrderedDict()
 
     for (example_index, example) in enumerate(all_examples):
         features = example_index_to_features[example_index]
@@ -612,6 +685,7 @@ def compute_predictions_logits(
             else:
                 score_diff = score_null
             scores_diff_json[example.qas_id] = score_diff
+            non_null_predictions[example.qas_id] = best_non_null_entry.text if best_non_null_entry else ""
             if score_diff > null_score_diff_threshold or best_non_null_entry is None:
                 all_predictions[example.qas_id] = ""
             else:
@@ -619,39 +693,66 @@ def compute_predictions_logits(
         all_nbest_json[example.qas_id] = nbest_json
 
     if not is_test:
-        with open(output_prediction_file, "w") as writer:
-            writer.write(json.dumps(all_predictions, indent=4) + "\n")
+        if output_prediction_file is not None:
+            with open(output_prediction_file, "w") as writer:
+                writer.write(json.dumps(all_predictions, indent=4) + "\n")
 
-        with open(output_nbest_file, "w") as writer:
-            writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
+        if output_nbest_file is not None:
+            with open(output_nbest_file, "w") as writer:
+                writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
 
-        if version_2_with_negative:
+        if version_2_with_negative and output_null_log_odds_file is not None:
             with open(output_null_log_odds_file, "w") as writer:
                 writer.write(json.dumps(scores_diff_json, indent=4) + "\n")
 
+        if return_details:
+            details = {
+                "nbest": all_nbest_json,
+                "scores_diff": scores_diff_json,
+                "non_null_predictions": non_null_predictions,
+            }
+            return all_predictions, details
         return all_predictions
 
     else:
         # Get best answer among different contexts.
-        best_answer_max_prob = collections.OrderedDict()
-        best_answer_text = collections.OrderedDict()
-        for qas_id, nbest_json in all_nbest_json.items():
-            qa_id_without_s = "[SEP]".join(qas_id.split("[SEP]")[:2])
-            text = nbest_json[0]["text"]
-            prob = nbest_json[0]["probability"]
+        return aggregate_question_answers(
+            (example.question_id, all_nbest_json[example.qas_id]) for example in all_examples
+            if example.qas_id in all_nbest_json
+        )
 
-            if qa_id_without_s not in best_answer_max_prob:
-                best_answer_max_prob[qa_id_without_s] = prob
-                best_answer_text[qa_id_without_s] = text
 
-            else:
-                is_max_prob_updated = prob > best_answer_max_prob[qa_id_without_s]
-                if text =="":
-                    continue
-                if is_max_prob_updated or best_answer_text[qa_id_without_s] == "":
-                    best_answer_max_prob[qa_id_without_s] = prob
-                    best_answer_text[qa_id_without_s] = text
-        return best_answer_text
+def aggregate_question_answers(question_nbests):
+    """
+    Picks the answer of each question among its paragraphs, as submitted for the test set: the most probable
+    non-empty top answer, or an empty answer if no paragraph has another one.
+
+    question_nbests: (question key, n-best list of one paragraph) pairs, in paragraph order
+    """
+    return collections.OrderedDict(
+        (question, entry["text"]) for question, (_, entry) in select_question_answers(question_nbests).items()
+    )
+
+
+def select_question_answers(question_nbests):
+    """
+    `aggregate_question_answers` returning, for each question, the position of the chosen pair in question_nbests
+    and the top n-best entry of that paragraph.
+    """
+    best_answers = collections.OrderedDict()
+    for i, (question, nbest_json) in enumerate(question_nbests):
+        entry = nbest_json[0]
+
+        if question not in best_answers:
+            best_answers[question] = (i, entry)
+
+        else:
+            is_max_prob_updated = entry["probability"] > best_answers[question][1]["probability"]
+            if entry["text"] == "":
+                continue
+            if is_max_prob_updated or best_answers[question][1]["text"] == "":
+                best_answers[question] = (i, entry)
+    return best_answers
 
 
 def compute_predictions_log_probs(
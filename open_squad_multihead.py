@@ -563,7 +563,7 @@ class SquadProcessor(DataProcessor):
 
         has_answer_cnt, no_answer_cnt, qa_num = 0, 0, 0
         has_apply, no_apply=0, 0
-        for entry in input_data[:]:
+        for question_id, entry in enumerate(input_data):
             qa = entry['qa']
             question_text = qa["question"]
             answer_text = qa['answer']
@@ -579,7 +579,7 @@ class SquadProcessor(DataProcessor):
                 source = paragraph["source"]
                 if context_text is None:
                     continue
-                qas_id = "{}[SEP]{}[SEP]{}".format(question_text, answer_text, pi)
+                qas_id = len(examples)
                 start_position_character = None
                 answers = []
 
@@ -605,6 +605,8 @@ class SquadProcessor(DataProcessor):
                     source=src[source],
                     is_impossible=is_impossible,
                     answers=answers,
+                    question_id=question_id,
+                    paragraph_index=pi,
                 )
                 if set_type == "test":
                     examples.append(example)
@@ -655,7 +657,7 @@ class SquadExample(object):
     A single training/test example for the Squad dataset, as loaded from disk.
 
     Args:
-        qas_id: The example's unique identifier
+        qas_id: The example's unique identifier, an integer for KorQuAD open files
         question_text: The question string
         context_text: The context string
         answer_text: The answer string
@@ -663,6 +665,8 @@ class SquadExample(object):
         title: The title of the example
         answers: None by default, this is used during evaluation. Holds answers as well as their start positions.
         is_impossible: False by default, set to True if the example has no possible answer.
+        question_id: None by default, the index of the question in the KorQuAD open file.
+        paragraph_index: None by default, the index of the paragraph among the question's paragraphs.
     """
 
     def __init__(
@@ -676,6 +680,8 @@ class SquadExample(object):
             source,
             answers=[],
             is_impossible=False,
+            question_id=None,
+            paragraph_index=None,
     ):
         self.qas_id = qas_id
         self.question_text = question_text
@@ -687,6 +693,8 @@ class SquadExample(object):
 
         self.start_position, self.end_position = 0, 0
         self.source = source
+        self.question_id = question_id
+        self.paragraph_index = paragraph_index
         doc_tokens = []
         char_to_word_offset = []
         prev_is_whitespace = True
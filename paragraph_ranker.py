@@ -0,0 +1,56 @@
+"""
+KorQuAD open 문단 재순위화
+
+질문마다 후보 문단들로 BM25 색인을 만들어 질문과 겹치는 토큰이 많은 문단부터 순서를 매김
+토큰은 HanBert 나 Electra 토크나이저의 wordpiece 를 사용하고, tokenizers 의 fast 토크나이저 (tokenization_hanbert_fast) 면
+encode_batch 로 질문과 문단을 한 번에 토크나이즈함
+
+"""
+
+import collections
+import math
+
+
+class BM25Ranker(object):
+    """
+    Ranks the candidate paragraphs of a question by BM25, with the document frequencies of the candidates
+    themselves. The index is built per call, so there is nothing to prepare or keep in memory between questions.
+
+    Args:
+        tokenizer: A transformers tokenizer (`tokenize`) or a tokenizers.Tokenizer (`encode_batch`)
+        k1: Term frequency saturation
+        b: Strength of the paragraph length normalization
+    """
+
+    def __init__(self, tokenizer, k1=1.2, b=0.75):
+        self.tokenizer = tokenizer
+        self.k1 = k1
+        self.b = b
+
+    def tokenize_many(self, texts):
+        if hasattr(self.tokenizer, "encode_batch"):
+            return [encoding.tokens for encoding in self.tokenizer.encode_batch(texts, add_special_tokens=False)]
+        return [self.tokenizer.tokenize(text) for text in texts]
+
+    def scores(self, question, paragraphs):
+        """BM25 score of each paragraph for the question."""
+        tokenized = self.tokenize_many([question] + list(paragraphs))
+        term_counts = [collections.Counter(tokens) for tokens in tokenized[1:]]
+        lengths = [len(tokens) for tokens in tokenized[1:]]
+        average_length = (sum(lengths) / len(lengths) if lengths else 0.0) or 1.0
+        length_norms = [self.k1 * (1.0 - self.b + self.b * length / average_length) for length in lengths]
+
+        scores = [0.0] * len(term_counts)
+        for term in set(tokenized[0]):
+            frequencies = [(i, counts[term]) for i, counts in enumerate(term_counts) if term in counts]
+            if not frequencies:
+                continue
+            idf = math.log(1.0 + (len(term_counts) - len(frequencies) + 0.5) / (len(frequencies) + 0.5))
+            for i, frequency in frequencies:
+                scores[i] += idf * frequency * (self.k1 + 1.0) / (frequency + length_norms[i])
+        return scores
+
+    def rank(self, question, paragraphs, top_k=None):
+        """Indices of the paragraphs from the best to the worst (or the top_k best), ties keep the given order."""
+        scores = self.scores(question, paragraphs)
+        return sorted(range(len(scores)), key=lambda i: -scores[i])[:top_k]
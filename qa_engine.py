@@ -0,0 +1,529 @@
+"""
+KorQuAD open 질의응답 엔진
+
+학습된 ElectraForQuestionAnswering 체크포인트와 토크나이저를 한 번 불러와 (질문, 문단들) 의 답을 메모리 안에서 찾음
+argparse, NSML, 파일 입출력 없이 다른 서비스에서 import 하여 사용함
+
+    engine = QAEngine.from_checkpoint("output/checkpoint-best")
+    answers = engine.answer_many([("질문", ["문단 1", "문단 2"])])
+
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+import timeit
+
+import torch
+
+from transformers import ElectraConfig, ElectraTokenizer
+
+from modeling_electra import ElectraForQuestionAnswering
+from open_squad import (
+    SquadExample,
+    SquadResult,
+    squad_convert_example_to_features_sp,
+    squad_convert_examples_to_features,
+)
+from open_squad_metrics import compute_predictions_logits, score_prediction, select_question_answers
+from paragraph_ranker import BM25Ranker
+from qa_quantization import quantize_model
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+# run_squad arguments saved with a checkpoint that the engine uses as its defaults
+CHECKPOINT_ARGS = (
+    "max_seq_length",
+    "doc_stride",
+    "max_query_length",
+    "n_best_size",
+    "max_answer_length",
+    "do_lower_case",
+    "version_2_with_negative",
+    "null_score_diff_threshold",
+)
+
+# paragraphs_read: paragraphs of the question that were read, cut_short: a deadline stopped it before the last one
+QAAnswer = collections.namedtuple(
+    "QAAnswer", ["text", "probability", "paragraph_index", "paragraphs_read", "cut_short"]
+)
+
+
+class QAEngine(object):
+    """
+    In-memory inference of a KorQuAD open model: featurization, batched forward passes and span decoding of
+    (question, paragraphs) pairs. The answer of each question is picked among its paragraphs like the test
+    submission, see `select_question_answers`.
+
+    Args:
+        model: ElectraForQuestionAnswering, or another model returning the start and end logits first
+        tokenizer: The tokenizer the model was trained with
+        device: None by default, then cuda if available
+        batch_size: Number of features per forward pass
+        threads: Processes of squad_convert_examples_to_features
+        stop_probability: None by default. Otherwise the paragraphs are read in waves and a question stops reading
+            once its selected answer is non-empty and at least this probable, see `calibrate_early_stopping.py`
+        paragraphs_per_wave: Paragraphs of each question read per wave
+        rerank_top_k: None by default, the paragraphs are read in the given order. Otherwise only the top k
+            paragraphs of each question by BM25 (`paragraph_ranker.BM25Ranker`) are read, from the best one
+        max_seq_length, doc_stride, max_query_length, n_best_size, max_answer_length, do_lower_case,
+        version_2_with_negative, null_score_diff_threshold: As the run_squad arguments
+    """
+
+    def __init__(
+            self,
+            model,
+            tokenizer,
+            device=None,
+            batch_size=64,
+            threads=1,
+            stop_probability=None,
+            paragraphs_per_wave=1,
+            rerank_top_k=None,
+            max_seq_length=384,
+            doc_stride=128,
+            max_query_length=64,
+            n_best_size=20,
+            max_answer_length=30,
+            do_lower_case=False,
+            version_2_with_negative=False,
+            null_score_diff_threshold=0.0,
+    ):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.model = model.to(self.device)
+        self.model.eval()
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.threads = threads
+        self.stop_probability = stop_probability
+        self.paragraphs_per_wave = paragraphs_per_wave
+        self.rerank_top_k = rerank_top_k
+        self.paragraph_ranker = BM25Ranker(tokenizer) if rerank_top_k is not None else None
+        self.max_seq_length = max_seq_length
+        self.doc_stride = doc_stride
+        self.max_query_length = max_query_length
+        self.n_best_size = n_best_size
+        self.max_answer_length = max_answer_length
+        self.do_lower_case = do_lower_case
+        self.version_2_with_negative = version_2_with_negative
+        self.null_score_diff_threshold = null_score_diff_threshold
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint_dir, config_name=None, model_class=ElectraForQuestionAnswering, **kwargs):
+        """
+        Loads a local run_squad checkpoint (config, weights, tokenizer files and training_args.bin) or a directory
+        written by nsml.save (model.pt, tokenizer and my_args.bin). The config of an NSML checkpoint is read from
+        `config_name`, its config.json if any, or else from the pre-trained model of the training arguments.
+        `model_class` is ElectraForMultiheadQuestionAnswering for run_squad_multihead checkpoints, or
+        ElectraForEarlyExitQuestionAnswering with the exit_layers of the training arguments. A quantized model.pt
+        (qa_quantization.py) is loaded into a model quantized the same way, it only runs on the CPU.
+
+        The other keyword arguments are passed to QAEngine and override the saved training arguments.
+        """
+        if os.path.isfile(os.path.join(checkpoint_dir, "model.pt")):
+            args = torch.load(os.path.join(checkpoint_dir, "my_args.bin"))
+            tokenizer = torch.load(os.path.join(checkpoint_dir, "tokenizer"))
+            if config_name is None and os.path.isfile(os.path.join(checkpoint_dir, "config.json")):
+                config_name = checkpoint_dir
+            config = ElectraConfig.from_pretrained(config_name or args.config_name or args.model_name_or_path)
+            if getattr(args, "exit_layers", None):
+                config.exit_layers = args.exit_layers
+            model = model_class(config)
+            if getattr(args, "quantization", None):
+                quantize_model(model, args.quantization)
+                # The dynamically quantized int8 Linear modules only run on the CPU
+                if kwargs.get("device") is None:
+                    kwargs["device"] = "cpu"
+                elif torch.device(kwargs["device"]).type != "cpu":
+                    raise ValueError(
+                        "A {} quantized checkpoint runs on the CPU, not on {}".format(
+                            args.quantization, kwargs["device"]
+                        )
+                    )
+            model.load_state_dict(torch.load(os.path.join(checkpoint_dir, "model.pt"), map_location="cpu"))
+        else:
+            args = torch.load(os.path.join(checkpoint_dir, "training_args.bin"))
+            tokenizer = ElectraTokenizer.from_pretrained(
+                checkpoint_dir, do_lower_case=args.do_lower_case, tokenize_chinese_chars=False
+            )
+            model = model_class.from_pretrained(checkpoint_dir)
+
+        for name in CHECKPOINT_ARGS:
+            kwargs.setdefault(name, getattr(args, name))
+        logger.info("Loaded %s", checkpoint_dir)
+        return cls(model, tokenizer, **kwargs)
+
+    def make_examples(self, questions):
+        """
+        SquadExamples of (question, paragraphs) pairs, the question_id of an example is the position of its pair and
+        its paragraph_index the position of its paragraph. With rerank_top_k, the examples of a question are its top
+        paragraphs in ranking order.
+        """
+        examples = []
+        for question_id, (question, paragraphs) in enumerate(questions):
+            # An empty paragraph has no features, which would shift the example_index of the following ones
+            paragraph_indices = [i for i, paragraph in enumerate(paragraphs) if paragraph and not paragraph.isspace()]
+            if self.paragraph_ranker is not None and paragraph_indices:
+                ranking = self.paragraph_ranker.rank(
+                    question, [paragraphs[i] for i in paragraph_indices], self.rerank_top_k
+                )
+                paragraph_indices = [paragraph_indices[i] for i in ranking]
+            for paragraph_index in paragraph_indices:
+                paragraph = paragraphs[paragraph_index]
+                examples.append(
+                    SquadExample(
+                        qas_id=len(examples),
+                        question_text=question,
+                        context_text=paragraph,
+                        answer_text=None,
+                        start_position_character=None,
+                        title="",
+                        question_id=question_id,
+                        paragraph_index=paragraph_index,
+                    )
+                )
+        return examples
+
+    def featurize(self, examples):
+        """Features and the TensorDataset of their model inputs."""
+        return squad_convert_examples_to_features(
+            examples=examples,
+            tokenizer=self.tokenizer,
+            max_seq_length=self.max_seq_length,
+            doc_stride=self.doc_stride,
+            max_query_length=self.max_query_length,
+            is_training=False,
+            return_dataset="pt",
+            threads=self.threads,
+        )
+
+    def featurize_example(self, example):
+        """Features of one example, their example_index and unique_id are left to the caller."""
+        return squad_convert_example_to_features_sp(
+            example, self.max_seq_length, self.doc_stride, self.max_query_length, False, self.tokenizer
+        )
+
+    def forward(self, features, dataset=None):
+        """SquadResults with the start and end logits of the features, inputs built from the features if no dataset."""
+        if dataset is None:
+            input_ids, attention_mask, token_type_ids = (
+                torch.tensor([getattr(feature, name) for feature in features], dtype=torch.long)
+                for name in ("input_ids", "attention_mask", "token_type_ids")
+            )
+        else:
+            input_ids, attention_mask, token_type_ids = dataset.tensors[:3]
+        results = []
+        with torch.no_grad():
+            for start in range(0, len(features), self.batch_size):
+                batch = slice(start, start + self.batch_size)
+                outputs = self.model(
+                    input_ids=input_ids[batch].to(self.device),
+                    attention_mask=attention_mask[batch].to(self.device),
+                    token_type_ids=token_type_ids[batch].to(self.device),
+                )
+                start_logits, end_logits = (output.detach().cpu().tolist() for output in outputs[:2])
+                for feature, feature_start_logits, feature_end_logits in zip(
+                        features[batch], start_logits, end_logits
+                ):
+                    results.append(SquadResult(int(feature.unique_id), feature_start_logits, feature_end_logits))
+        return results
+
+    def decode(self, examples, features, results):
+        """n-best answers of every example, by qas_id."""
+        _, details = compute_predictions_logits(
+            examples,
+            features,
+            results,
+            self.n_best_size,
+            self.max_answer_length,
+            self.do_lower_case,
+            None,
+            None,
+            None,
+            False,
+            self.version_2_with_negative,
+            self.null_score_diff_threshold,
+            self.tokenizer,
+            return_details=True,
+        )
+        return details["nbest"]
+
+    def predict_nbests(self, examples):
+        """n-best answers of examples, by qas_id."""
+        features, dataset = self.featurize(examples)
+        return self.decode(examples, features, self.forward(features, dataset))
+
+    def stream_answers(self, examples):
+        """
+        Answers examples grouped by question (consecutive examples with the same question_id) like the test
+        submission. Yields (question_id, example, entry), the example and the top n-best entry of the selected
+        paragraph, as soon as all paragraphs of a question are scored. Only the features and logits of the questions
+        being read are kept, about batch_size features, instead of those of all examples.
+
+        A question whose paragraphs have no features is yielded as (question_id, None, None).
+        """
+        pending = collections.deque()  # (question_id, examples, features, features queued up to its last one)
+        queue = []
+        results = {}
+        num_queued = num_scored = 0
+        unique_id = 1000000000
+
+        def answered():
+            while pending and pending[0][3] <= num_scored:
+                question_id, question_examples, features, _ = pending.popleft()
+                if not question_examples:
+                    yield question_id, None, None
+                    continue
+                nbests = self.decode(
+                    question_examples, features, [results.pop(feature.unique_id) for feature in features]
+                )
+                (i, entry), = select_question_answers(
+                    (question_id, nbests[example.qas_id]) for example in question_examples
+                ).values()
+                yield question_id, question_examples[i], entry
+
+        for question_id, question_examples in itertools.groupby(examples, key=lambda example: example.question_id):
+            question_examples = list(question_examples)
+            kept_examples, features = index_question_features(
+                question_examples, [self.featurize_example(example) for example in question_examples], unique_id
+            )
+            unique_id += len(features)
+            num_queued += len(features)
+            pending.append((question_id, kept_examples, features, num_queued))
+            queue.extend(features)
+
+            while len(queue) >= self.batch_size:
+                batch, queue = queue[:self.batch_size], queue[self.batch_size:]
+                results.update((result.unique_id, result) for result in self.forward(batch))
+                num_scored += len(batch)
+                for answer in answered():
+                    yield answer
+
+        if queue:
+            results.update((result.unique_id, result) for result in self.forward(queue))
+            num_scored += len(queue)
+        for answer in answered():
+            yield answer
+
+    def answer_many(self, questions, deadlines=None):
+        """
+        Answers (question, paragraphs) pairs, one QAAnswer per pair. The paragraphs are strings in priority order, a
+        question without a non-empty paragraph gets an empty answer.
+
+        With deadlines or a stop_probability, the paragraphs are read in waves: the first paragraphs_per_wave
+        paragraphs of every question, then the next ones, ... A question leaves the waves with its best answer so far
+        once its answer is confident enough (`is_confident`), or once the next wave is estimated to end after its
+        deadline. The first wave is always read.
+
+        deadlines: None, or a time.monotonic() deadline (or None) per question.
+        """
+        questions = list(questions)
+        examples = self.make_examples(questions)
+        question_examples = [[] for _ in questions]
+        for example in examples:
+            question_examples[example.question_id].append(example)
+
+        nbests = {}
+        read_examples = []
+        confident = set()
+        if deadlines is None and self.stop_probability is None:
+            if examples:
+                nbests.update(self.predict_nbests(examples))
+                read_examples.extend(examples)
+        else:
+            paragraphs_read = [0] * len(questions)
+            seconds_per_example = 0.0
+            num_paragraphs = max(len(paragraphs) for paragraphs in question_examples) if examples else 0
+            for start in range(0, num_paragraphs, self.paragraphs_per_wave):
+                wave = [
+                    example
+                    for question_id, paragraphs in enumerate(question_examples)
+                    if paragraphs_read[question_id] == start and question_id not in confident
+                    for example in paragraphs[start:start + self.paragraphs_per_wave]
+                ]
+                if start > 0 and deadlines is not None:
+                    end_time = time.monotonic() + seconds_per_example * len(wave)
+                    wave = [
+                        example for example in wave
+                        if deadlines[example.question_id] is None or end_time <= deadlines[example.question_id]
+                    ]
+                if not wave:
+                    break
+
+                start_time = time.monotonic()
+                nbests.update(self.predict_nbests(wave))
+                seconds_per_example = (time.monotonic() - start_time) / len(wave)
+                read_examples.extend(wave)
+                for example in wave:
+                    paragraphs_read[example.question_id] += 1
+
+                if self.stop_probability is not None:
+                    selected = select_question_answers(
+                        (example.question_id, nbests[example.qas_id]) for example in read_examples
+                    )
+                    confident.update(
+                        example.question_id for example in wave
+                        if is_confident(selected[example.question_id][1], self.stop_probability)
+                    )
+
+        answers = [QAAnswer("", 0.0, None, 0, False)] * len(questions)
+        selected = select_question_answers(
+            (example.question_id, nbests[example.qas_id]) for example in read_examples
+        )
+        question_read = collections.Counter(example.question_id for example in read_examples)
+        for question_id, (i, entry) in selected.items():
+            answers[question_id] = QAAnswer(
+                entry["text"],
+                entry["probability"],
+                read_examples[i].paragraph_index,
+                question_read[question_id],
+                question_read[question_id] < len(question_examples[question_id]) and question_id not in confident,
+            )
+        return answers
+
+    def answer(self, question, paragraphs, deadline=None):
+        return self.answer_many([(question, paragraphs)], None if deadline is None else [deadline])[0]
+
+
+def index_question_features(examples, example_features, unique_id):
+    """
+    Numbers the features of the examples of one question (example_index within the question, unique_id from
+    `unique_id`) and returns the examples with features and their features. An example without features would be
+    decoded as the "empty" nonce answer of probability 1.
+    """
+    kept_examples, features = [], []
+    for example, features_of_example in zip(examples, example_features):
+        if not features_of_example:
+            continue
+        for feature in features_of_example:
+            feature.example_index = len(kept_examples)
+            feature.unique_id = unique_id + len(features)
+            features.append(feature)
+        kept_examples.append(example)
+    return kept_examples, features
+
+
+def is_confident(entry, stop_probability):
+    """Whether the selected answer (top n-best entry) of a question lets it stop reading paragraphs."""
+    return entry["text"] != "" and entry["probability"] >= stop_probability
+
+
+def replay_early_stopping(nbests, stop_probability, paragraphs_per_wave=1):
+    """
+    Early stopping of QAEngine replayed on the n-best lists of all paragraphs of one question, in priority order.
+    Returns the position of the paragraph with the selected answer, the selected top n-best entry and the number of
+    paragraphs read.
+    """
+    read = 0
+    while True:
+        read = min(read + paragraphs_per_wave, len(nbests))
+        i, entry = select_question_answers((0, nbest) for nbest in nbests[:read])[0]
+        if read == len(nbests) or (stop_probability is not None and is_confident(entry, stop_probability)):
+            return i, entry, read
+
+
+def load_questions(predict_file, max_paragraphs=None):
+    """(question, paragraphs) pairs of a KorQuAD open json file."""
+    questions = []
+    with open(predict_file, "r", encoding="utf-8") as reader:
+        for entry in json.load(reader)["data"]:
+            paragraphs = [str(paragraph["contents"]) for paragraph in entry["paragraphs"]]
+            questions.append((entry["qa"]["question"] or "", paragraphs[:max_paragraphs]))
+    return questions
+
+
+def load_gold_answers(predict_file):
+    """Answer of each question of a KorQuAD open json file, in the order of `load_questions`."""
+    with open(predict_file, "r", encoding="utf-8") as reader:
+        return [entry["qa"]["answer"] for entry in json.load(reader)["data"]]
+
+
+def score_answers(texts, gold_answers, strip_particles=False):
+    """Question level EM and F1, in percent, of the answer texts of the questions with a gold answer."""
+    scores = [
+        score_prediction([gold], text, strip_particles) for text, gold in zip(texts, gold_answers) if gold is not None
+    ]
+    if not scores:
+        return 0.0, 0.0
+    return 100.0 * sum(exact for exact, _ in scores) / len(scores), 100.0 * sum(f1 for _, f1 in scores) / len(scores)
+
+
+def add_checkpoint_args(parser, required=True, help="Local or NSML checkpoint directory."):
+    """--checkpoint_dir and --config_name of `QAEngine.from_checkpoint`."""
+    parser.add_argument("--checkpoint_dir", required=required, default=None, type=str, help=help)
+    parser.add_argument(
+        "--config_name", default=None, type=str, help="Config of an NSML checkpoint, from its training args if not set."
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_checkpoint_args(parser)
+    parser.add_argument("--predict_file", required=True, type=str, help="KorQuAD open json file to answer.")
+    parser.add_argument("--output_file", default=None, type=str, help="Write the answers (question index -> answer).")
+    parser.add_argument(
+        "--max_paragraphs", default=5, type=int, help="Paragraphs read per question, as in the test prediction."
+    )
+    parser.add_argument("--batch_size", default=64, type=int, help="Features per forward pass.")
+    parser.add_argument(
+        "--stop_probability",
+        default=None,
+        type=float,
+        help="Stop reading a question's paragraphs once its answer is this probable, see calibrate_early_stopping.py.",
+    )
+    parser.add_argument("--paragraphs_per_wave", default=1, type=int, help="Paragraphs per question and wave.")
+    parser.add_argument(
+        "--rerank_top_k", default=None, type=int, help="Only read the BM25 top k of the --max_paragraphs paragraphs."
+    )
+    parser.add_argument("--questions_per_call", default=32, type=int, help="Questions per answer_many call.")
+    parser.add_argument(
+        "--stream", action="store_true", help="Answer all questions with stream_answers instead of answer_many calls."
+    )
+    parser.add_argument("--device", default=None, type=str, help="Device of the model, cuda if available.")
+    args = parser.parse_args()
+
+    engine = QAEngine.from_checkpoint(
+        args.checkpoint_dir,
+        config_name=args.config_name,
+        device=args.device,
+        batch_size=args.batch_size,
+        stop_probability=args.stop_probability,
+        paragraphs_per_wave=args.paragraphs_per_wave,
+        rerank_top_k=args.rerank_top_k,
+    )
+    questions = load_questions(args.predict_file, args.max_paragraphs)
+
+    start_time = timeit.default_timer()
+    texts = []
+    if args.stream:
+        # Questions without a non-empty paragraph have no examples and keep an empty answer
+        texts = [""] * len(questions)
+        for num_answered, (question_id, _, entry) in enumerate(engine.stream_answers(engine.make_examples(questions))):
+            if num_answered == 0:
+                logger.info("First answer after %.3f secs", timeit.default_timer() - start_time)
+            texts[question_id] = entry["text"] if entry is not None else ""
+    else:
+        for start in range(0, len(questions), args.questions_per_call):
+            texts.extend(
+                answer.text for answer in engine.answer_many(questions[start:start + args.questions_per_call])
+            )
+    elapsed = timeit.default_timer() - start_time
+    logger.info("Answered %d questions in %.1f secs (%.1f questions/sec)", len(texts), elapsed, len(texts) / elapsed)
+
+    if args.output_file:
+        with open(args.output_file, "w", encoding="utf-8") as writer:
+            json.dump(dict(enumerate(texts)), writer, ensure_ascii=False, indent=4)
+
+
+if __name__ == "__main__":
+    main()
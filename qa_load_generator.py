@@ -0,0 +1,173 @@
+"""
+KorQuAD open 질의응답 서버 부하 측정
+
+qa_server.py 에 KorQuAD open json 의 질문과 문단을 보내 클라이언트 쪽 처리량과 p50/p99 지연 시간을 측정함
+--rate 를 주면 포아송 도착 (open loop) 으로, 없으면 --concurrency 개의 연결이 응답을 받는 대로 다음 요청을 보냄 (closed loop)
+--timeout_ms 를 주면 요청마다 deadline 을 붙이고, 문단을 다 읽지 못한 답의 비율도 출력함
+끝나면 서버의 /metrics 도 함께 출력함
+
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from qa_engine import load_questions
+from qa_server import latency_summary, read_http_message
+
+
+class HTTPClient(object):
+    """One keep-alive HTTP/1.1 connection to qa_server, over TCP or a Unix socket."""
+
+    def __init__(self, host="127.0.0.1", port=8000, unix_socket=None):
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        if self.unix_socket:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.unix_socket)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method, path, payload=None):
+        if self.writer is None:
+            await self.connect()
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else b""
+        head = "{} {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+            method, path, self.host, len(body)
+        )
+        self.writer.write(head.encode("latin-1") + body)
+        await self.writer.drain()
+        message = await read_http_message(self.reader)
+        if message is None:
+            raise ConnectionError("Connection closed by the server")
+        status_line, _, response_body = message
+        return int(status_line.split(" ")[1]), json.loads(response_body.decode("utf-8"))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class LoadResults(object):
+    """Latencies and outcomes of the requests sent."""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.cut_short = 0
+
+    def summary(self, elapsed):
+        summary = {
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "cut_short_rate": self.cut_short / len(self.latencies) if self.latencies else None,
+            "elapsed_sec": elapsed,
+            "throughput_rps": len(self.latencies) / elapsed,
+        }
+        summary.update(latency_summary(self.latencies))
+        return summary
+
+
+async def send(client, question, paragraphs, results, timeout_ms=None):
+    payload = {"question": question, "paragraphs": paragraphs}
+    if timeout_ms is not None:
+        payload["timeout_ms"] = timeout_ms
+    start_time = time.monotonic()
+    try:
+        status, answer = await client.request("POST", "/answer", payload)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        client.close()
+        status, answer = None, {}
+    results.latencies.append(time.monotonic() - start_time)
+    if status != 200:
+        results.errors += 1
+    results.cut_short += int(bool(answer.get("cut_short")))
+
+
+async def run_closed_loop(questions, connect, concurrency, timeout_ms=None):
+    """`concurrency` connections, each sending its next request as soon as the previous one is answered."""
+    results = LoadResults()
+    remaining = iter(questions)
+
+    async def worker():
+        client = connect()
+        for question, paragraphs in remaining:
+            await send(client, question, paragraphs, results, timeout_ms)
+        client.close()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+
+async def run_open_loop(questions, connect, rate, timeout_ms=None, seed=42):
+    """Requests arriving as a Poisson process of `rate` requests per second, each on a connection of a pool."""
+    results = LoadResults()
+    rng = random.Random(seed)
+    idle_clients = []
+    tasks = []
+
+    async def request(question, paragraphs):
+        client = idle_clients.pop() if idle_clients else connect()
+        await send(client, question, paragraphs, results, timeout_ms)
+        idle_clients.append(client)
+
+    for question, paragraphs in questions:
+        tasks.append(asyncio.ensure_future(request(question, paragraphs)))
+        await asyncio.sleep(rng.expovariate(rate))
+    await asyncio.gather(*tasks)
+    for client in idle_clients:
+        client.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", type=str, help="Address of qa_server.")
+    parser.add_argument("--port", default=8000, type=int, help="Port of qa_server.")
+    parser.add_argument("--unix_socket", default=None, type=str, help="Unix socket of qa_server instead of TCP.")
+    parser.add_argument("--predict_file", required=True, type=str, help="KorQuAD open json file to send.")
+    parser.add_argument("--max_paragraphs", default=5, type=int, help="Paragraphs sent per question.")
+    parser.add_argument("--num_requests", default=1000, type=int, help="Requests to send, questions are repeated.")
+    parser.add_argument("--concurrency", default=16, type=int, help="Connections of the closed loop.")
+    parser.add_argument("--rate", default=None, type=float, help="Requests per second of an open loop.")
+    parser.add_argument("--timeout_ms", default=None, type=float, help="Deadline sent with every request.")
+    parser.add_argument("--seed", default=42, type=int, help="Seed of the question order and the arrivals.")
+    args = parser.parse_args()
+
+    questions = load_questions(args.predict_file, args.max_paragraphs)
+    random.Random(args.seed).shuffle(questions)
+    questions = [questions[i % len(questions)] for i in range(args.num_requests)]
+
+    def connect():
+        return HTTPClient(args.host, args.port, args.unix_socket)
+
+    async def run():
+        start_time = time.monotonic()
+        if args.rate:
+            results = await run_open_loop(questions, connect, args.rate, args.timeout_ms, args.seed)
+        else:
+            results = await run_closed_loop(questions, connect, args.concurrency, args.timeout_ms)
+        elapsed = time.monotonic() - start_time
+
+        client = connect()
+        _, server_metrics = await client.request("GET", "/metrics")
+        client.close()
+        return results, elapsed, server_metrics
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results, elapsed, server_metrics = loop.run_until_complete(run())
+
+    print("client: {}".format(json.dumps(results.summary(elapsed))))
+    print("server: {}".format(json.dumps(server_metrics)))
+
+
+if __name__ == "__main__":
+    main()
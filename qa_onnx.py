@@ -0,0 +1,237 @@
+"""
+KorQuAD open ONNX 변환과 ONNX Runtime 추론
+
+ElectraForQuestionAnswering 을, --multihead 이면 ElectraForMultiheadQuestionAnswering 에 출력 층을 고르는 src 입력을 더하여
+batch, sequence 축이 가변인 ONNX 파일로 저장함
+OnnxQuestionAnswering 은 ONNX Runtime (그래프 최적화 사용) 세션을 PyTorch 모델처럼 호출할 수 있게 감싸므로
+submit.py 의 predict (--onnx_model), submit_ensemble.py (--onnx_dir), QAEngine 에 모델 대신 사용할 수 있음
+변환 후 --parity_file 의 특징으로 PyTorch 와 ONNX Runtime 의 logits 과 답이 같은지 확인하고 forward 시간을 비교함
+
+"""
+
+import argparse
+import inspect
+import logging
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+from modeling_electra import ElectraForMultiheadQuestionAnswering, ElectraForQuestionAnswering
+from qa_engine import CHECKPOINT_ARGS, QAEngine, add_checkpoint_args, load_questions
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+ONNX_INPUTS = ["input_ids", "attention_mask", "token_type_ids"]
+ONNX_OUTPUTS = ["start_logits", "end_logits"]
+
+GRAPH_OPTIMIZATION_LEVELS = ["disable", "basic", "extended", "all"]
+
+
+class QuestionAnsweringExport(nn.Module):
+    """
+    The start and end logits of a QA model from positional inputs, for torch.onnx.export. With `multihead`, the
+    output layer of each feature is picked by its src with tensor ops instead of the per-feature loop of
+    ElectraForMultiheadQuestionAnswering, so that it is traced for any batch.
+    """
+
+    def __init__(self, model, multihead=False):
+        super(QuestionAnsweringExport, self).__init__()
+        self.model = model
+        self.multihead = multihead
+
+    def forward(self, input_ids, attention_mask, token_type_ids, src=None):
+        if not self.multihead:
+            outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+            return outputs[0], outputs[1]
+
+        sequence_output = self.model.electra(input_ids, attention_mask, token_type_ids)[0]
+        # (batch, heads, sequence, 2), then the head of each feature
+        logits = torch.stack([qa_output(sequence_output) for qa_output in self.model.qa_outputs], dim=1)
+        logits = logits[torch.arange(logits.size(0)), src]
+        start_logits, end_logits = logits.split(1, dim=-1)
+        return start_logits.squeeze(-1), end_logits.squeeze(-1)
+
+
+def export_onnx(model, output_file, multihead=False, opset_version=11):
+    """Writes the model to an ONNX file with dynamic batch and sequence axes, it is traced on the CPU."""
+    device = next(model.parameters()).device
+    model.to("cpu")
+    model.eval()
+    input_names = ONNX_INPUTS + (["src"] if multihead else [])
+    dummy_inputs = (
+        torch.ones(2, 16, dtype=torch.long),
+        torch.ones(2, 16, dtype=torch.long),
+        torch.zeros(2, 16, dtype=torch.long),
+    ) + ((torch.zeros(2, dtype=torch.long),) if multihead else ())
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in ONNX_INPUTS + ONNX_OUTPUTS}
+    if multihead:
+        dynamic_axes["src"] = {0: "batch"}
+    export_kwargs = {}
+    # Newer PyTorch exports with dynamo (and onnxscript) by default, the TorchScript exporter handles the dynamic axes
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs["dynamo"] = False
+
+    with torch.no_grad():
+        torch.onnx.export(
+            QuestionAnsweringExport(model, multihead),
+            dummy_inputs,
+            output_file,
+            input_names=input_names,
+            output_names=ONNX_OUTPUTS,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            do_constant_folding=True,
+            **export_kwargs
+        )
+    model.to(device)
+    logger.info("Exported %s", output_file)
+
+
+class OnnxQuestionAnswering(object):
+    """
+    ONNX Runtime session of an exported QA model, called like the PyTorch model: returns the start and end logits
+    of the inputs as cpu tensors. `to` and `eval` do nothing, the session runs on the CPU.
+
+    Args:
+        onnx_file: File written by `export_onnx`
+        threads: None by default, ONNX Runtime's default. Otherwise the intra-op threads of the session
+        optimization_level: Graph optimizations of ONNX Runtime, one of GRAPH_OPTIMIZATION_LEVELS
+    """
+
+    def __init__(self, onnx_file, threads=None, optimization_level="all"):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("Please install onnxruntime to run an ONNX model.")
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = {
+            "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+            "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+        }[optimization_level]
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(onnx_file, options, providers=["CPUExecutionProvider"])
+        self.multihead = "src" in [session_input.name for session_input in self.session.get_inputs()]
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids=None, attention_mask=None, token_type_ids=None, src=None, **kwargs):
+        feeds = {
+            "input_ids": input_ids.cpu().numpy(),
+            "attention_mask": attention_mask.cpu().numpy(),
+            "token_type_ids": token_type_ids.cpu().numpy(),
+        }
+        if self.multihead:
+            # Like ElectraForMultiheadQuestionAnswering, the first output layer without src
+            if not isinstance(src, torch.Tensor):
+                src = torch.full((input_ids.size(0),), src or 0, dtype=torch.long)
+            feeds["src"] = src.cpu().numpy()
+        return tuple(torch.from_numpy(output) for output in self.session.run(ONNX_OUTPUTS, feeds))
+
+
+def load_or_export(model, onnx_file, multihead=False, threads=None):
+    """OnnxQuestionAnswering of onnx_file, exported from the (loaded) PyTorch model first if it does not exist."""
+    if not os.path.exists(onnx_file):
+        export_onnx(model, onnx_file, multihead=multihead)
+    return OnnxQuestionAnswering(onnx_file, threads=threads)
+
+
+def check_parity(model, onnx_model, dataset, batch_size=8, multihead=False, seed=42):
+    """
+    Largest absolute difference between the start/end logits of the PyTorch model and the ONNX model on the
+    features of a TensorDataset, and the forward time of each. Multihead features get random heads.
+    """
+    input_ids, attention_mask, token_type_ids = dataset.tensors[:3]
+    if multihead:
+        generator = torch.Generator().manual_seed(seed)
+        src = torch.randint(len(model.qa_outputs), (input_ids.size(0),), generator=generator)
+    model.eval()
+    max_diff = 0.0
+    times = {"pytorch": 0.0, "onnx": 0.0}
+    for start in range(0, input_ids.size(0), batch_size):
+        inputs = {
+            "input_ids": input_ids[start:start + batch_size],
+            "attention_mask": attention_mask[start:start + batch_size],
+            "token_type_ids": token_type_ids[start:start + batch_size],
+        }
+        if multihead:
+            inputs.update({"src": src[start:start + batch_size], "flag": False})
+        start_time = time.monotonic()
+        with torch.no_grad():
+            expected = model(**inputs)[:2]
+        times["pytorch"] += time.monotonic() - start_time
+        start_time = time.monotonic()
+        outputs = onnx_model(**inputs)
+        times["onnx"] += time.monotonic() - start_time
+        for expected_logits, logits in zip(expected, outputs):
+            max_diff = max(max_diff, float((expected_logits - logits).abs().max()))
+    return max_diff, times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_checkpoint_args(parser)
+    parser.add_argument("--output_file", required=True, type=str, help="ONNX file to write.")
+    parser.add_argument("--multihead", action="store_true", help="Export a run_squad_multihead model with src.")
+    parser.add_argument("--opset_version", default=11, type=int, help="ONNX opset of the export.")
+    parser.add_argument(
+        "--optimization_level",
+        default="all",
+        choices=GRAPH_OPTIMIZATION_LEVELS,
+        help="ONNX Runtime graph optimizations.",
+    )
+    parser.add_argument("--threads", default=None, type=int, help="ONNX Runtime intra-op threads.")
+    parser.add_argument("--parity_file", default=None, type=str, help="KorQuAD open json file to check parity on.")
+    parser.add_argument("--parity_questions", default=20, type=int, help="Questions of --parity_file to check.")
+    parser.add_argument("--atol", default=1e-3, type=float, help="Largest logit difference allowed.")
+    parser.add_argument("--batch_size", default=8, type=int, help="Features per forward pass of the parity check.")
+    args = parser.parse_args()
+
+    model_class = ElectraForMultiheadQuestionAnswering if args.multihead else ElectraForQuestionAnswering
+    engine = QAEngine.from_checkpoint(
+        args.checkpoint_dir, config_name=args.config_name, model_class=model_class, device="cpu",
+        batch_size=args.batch_size,
+    )
+    export_onnx(engine.model, args.output_file, multihead=args.multihead, opset_version=args.opset_version)
+    if not args.parity_file:
+        return
+
+    onnx_model = OnnxQuestionAnswering(args.output_file, args.threads, args.optimization_level)
+    questions = load_questions(args.parity_file, 5)[:args.parity_questions]
+    examples = engine.make_examples(questions)
+    _, dataset = engine.featurize(examples)
+    max_diff, times = check_parity(engine.model, onnx_model, dataset, args.batch_size, args.multihead)
+    logger.info("Largest logit difference %.2e on %d features", max_diff, len(dataset))
+    logger.info("Forward time: pytorch %.2f secs, onnxruntime %.2f secs (%.2fx)", times["pytorch"], times["onnx"],
+                times["pytorch"] / times["onnx"])
+
+    expected_answers = engine.answer_many(questions)
+    onnx_engine = QAEngine(
+        onnx_model,
+        engine.tokenizer,
+        batch_size=args.batch_size,
+        **{name: getattr(engine, name) for name in CHECKPOINT_ARGS}
+    )
+    different = sum(
+        expected.text != answer.text for expected, answer in zip(expected_answers, onnx_engine.answer_many(questions))
+    )
+    logger.info("%d of %d answers differ", different, len(questions))
+    if max_diff > args.atol or different:
+        raise SystemExit("The ONNX model differs from the PyTorch model.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+"""
+KorQuAD open 파이프라인 예측
+
+QAEngine 의 featurize -> forward -> decode 세 단계를 차례로 실행하지 않고, 단계 사이에 크기가 제한된 큐를 두어 동시에 실행함
+featurization 과 decoding 은 각각의 프로세스 풀 (토크나이저를 한 번만 넘기는 initializer 사용) 에서, 모델은 한 스레드에서
+실행되므로 전체 시간이 단계 시간의 합이 아니라 가장 느린 단계의 시간에 가까워짐
+단계마다 사용률 (busy 시간 / 전체 시간 x 작업자 수) 과 큐 깊이를 기록함
+
+    predictor = PipelinedPredictor(QAEngine.from_checkpoint("output/checkpoint-best"), featurize_workers=2)
+    for question_id, example, entry in predictor.stream_answers(examples):
+        ...
+    print(predictor.report())
+
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from multiprocessing import Pool
+
+from open_squad import squad_convert_example_to_features, squad_convert_example_to_features_init
+from open_squad_metrics import compute_predictions_logits, select_question_answers
+from qa_engine import QAEngine, add_checkpoint_args, index_question_features, load_questions
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+# Marks the end of the questions in the queues between stages
+_END = object()
+
+
+class _Failure(object):
+    """An exception of a stage, passed down the queues and raised by stream_answers."""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+    squad_convert_example_to_features_init(tokenizer)
+
+
+def _featurize_question(examples, max_seq_length, doc_stride, max_query_length):
+    """Features of each example of a question, and the time it took."""
+    start_time = time.monotonic()
+    example_features = [
+        squad_convert_example_to_features(example, max_seq_length, doc_stride, max_query_length, False)
+        for example in examples
+    ]
+    return example_features, time.monotonic() - start_time
+
+
+def _decode_question(question_id, examples, features, results, decode_args, tokenizer=None):
+    """Position of the selected paragraph of a question, its top n-best entry, and the time it took."""
+    start_time = time.monotonic()
+    n_best_size, max_answer_length, do_lower_case, version_2_with_negative, null_score_diff_threshold = decode_args
+    _, details = compute_predictions_logits(
+        examples,
+        features,
+        results,
+        n_best_size,
+        max_answer_length,
+        do_lower_case,
+        None,
+        None,
+        None,
+        False,
+        version_2_with_negative,
+        null_score_diff_threshold,
+        tokenizer if tokenizer is not None else _worker_tokenizer,
+        return_details=True,
+    )
+    (i, entry), = select_question_answers(
+        (question_id, details["nbest"][example.qas_id]) for example in examples
+    ).values()
+    return i, entry, time.monotonic() - start_time
+
+
+class StageStats(object):
+    """
+    Busy time of a stage's workers and the depth of its input queue each time it takes an item. The featurization
+    has no input queue, its depth is the number of questions in flight in its pool.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.busy = 0.0
+        self.items = 0
+        self.queue_depths = []
+
+    def summary(self, elapsed):
+        return {
+            "workers": self.workers,
+            "items": self.items,
+            "busy_sec": self.busy,
+            "utilization": self.busy / (elapsed * self.workers) if elapsed > 0 else None,
+            "mean_queue_depth": sum(self.queue_depths) / len(self.queue_depths) if self.queue_depths else 0.0,
+            "max_queue_depth": max(self.queue_depths) if self.queue_depths else 0,
+        }
+
+
+class PipelinedPredictor(object):
+    """
+    Runs QAEngine.stream_answers as three concurrent stages: featurization of each question, forward passes of
+    batch_size features and decoding of each question whose features are all scored. The stages are connected by
+    queues of at most `queue_size` questions, so memory stays bounded when one stage is slower than the others.
+
+    Args:
+        engine: QAEngine with the model, tokenizer and prediction arguments
+        featurize_workers: Processes featurizing questions, 0 to featurize in the stage's thread
+        decode_workers: Processes decoding questions, 0 to decode in the stage's thread
+        queue_size: Maximum questions waiting between two stages, and in flight in each pool
+    """
+
+    def __init__(self, engine, featurize_workers=1, decode_workers=1, queue_size=16):
+        self.engine = engine
+        self.featurize_workers = featurize_workers
+        self.decode_workers = decode_workers
+        self.queue_size = queue_size
+        self.stats = {}
+        self.elapsed = 0.0
+
+    def report(self):
+        """Utilization and input queue depth of each stage of the last stream_answers."""
+        return collections.OrderedDict((name, stats.summary(self.elapsed)) for name, stats in self.stats.items())
+
+    def _pool(self, workers):
+        if workers == 0:
+            return None
+        return Pool(workers, initializer=_init_worker, initargs=(self.engine.tokenizer,))
+
+    def _run_stage(self, stage, output_queue, *args):
+        try:
+            stage(output_queue, *args)
+        except Exception as e:
+            output_queue.put(_Failure(e))
+
+    def _featurize_stage(self, output_queue, examples, pool, stats):
+        engine = self.engine
+        feature_args = (engine.max_seq_length, engine.doc_stride, engine.max_query_length)
+        in_flight = collections.deque()
+        unique_id = 1000000000
+
+        def put_oldest():
+            nonlocal unique_id
+            stats.queue_depths.append(len(in_flight))
+            question_id, question_examples, pending = in_flight.popleft()
+            example_features, busy = pending.get() if pool is not None else pending
+            stats.busy += busy
+            stats.items += 1
+            kept_examples, features = index_question_features(question_examples, example_features, unique_id)
+            unique_id += len(features)
+            output_queue.put((question_id, kept_examples, features))
+
+        for question_id, question_examples in itertools.groupby(examples, key=lambda example: example.question_id):
+            question_examples = list(question_examples)
+            if pool is not None:
+                pending = pool.apply_async(_featurize_question, (question_examples,) + feature_args)
+            else:
+                pending = _featurize_question(question_examples, *feature_args)
+            in_flight.append((question_id, question_examples, pending))
+            if len(in_flight) >= self.queue_size:
+                put_oldest()
+        while in_flight:
+            put_oldest()
+        output_queue.put(_END)
+
+    def _model_stage(self, output_queue, input_queue, stats):
+        pending = collections.deque()  # (question_id, examples, features, features queued up to its last one)
+        batch_queue = []
+        results = {}
+        num_queued = num_scored = 0
+
+        def forward(batch):
+            nonlocal num_scored
+            start_time = time.monotonic()
+            results.update((result.unique_id, result) for result in self.engine.forward(batch))
+            stats.busy += time.monotonic() - start_time
+            num_scored += len(batch)
+            while pending and pending[0][3] <= num_scored:
+                question_id, question_examples, features, _ = pending.popleft()
+                question_results = [results.pop(feature.unique_id) for feature in features]
+                output_queue.put((question_id, question_examples, features, question_results))
+
+        while True:
+            stats.queue_depths.append(input_queue.qsize())
+            item = input_queue.get()
+            if item is _END or isinstance(item, _Failure):
+                break
+            question_id, question_examples, features = item
+            stats.items += 1
+            num_queued += len(features)
+            pending.append((question_id, question_examples, features, num_queued))
+            batch_queue.extend(features)
+            while len(batch_queue) >= self.engine.batch_size:
+                batch, batch_queue = batch_queue[:self.engine.batch_size], batch_queue[self.engine.batch_size:]
+                forward(batch)
+        if isinstance(item, _Failure):
+            output_queue.put(item)
+            return
+        forward(batch_queue)
+        output_queue.put(_END)
+
+    def _decode_stage(self, output_queue, input_queue, pool, stats):
+        engine = self.engine
+        decode_args = (
+            engine.n_best_size,
+            engine.max_answer_length,
+            engine.do_lower_case,
+            engine.version_2_with_negative,
+            engine.null_score_diff_threshold,
+        )
+        in_flight = collections.deque()
+
+        def put_oldest():
+            question_id, question_examples, pending = in_flight.popleft()
+            if not question_examples:
+                output_queue.put((question_id, None, None))
+                return
+            i, entry, busy = pending.get() if pool is not None else pending
+            stats.busy += busy
+            output_queue.put((question_id, question_examples[i], entry))
+
+        while True:
+            stats.queue_depths.append(input_queue.qsize())
+            item = input_queue.get()
+            if item is _END or isinstance(item, _Failure):
+                break
+            question_id, question_examples, features, results = item
+            stats.items += 1
+            pending = None
+            if question_examples and pool is not None:
+                pending = pool.apply_async(
+                    _decode_question, (question_id, question_examples, features, results, decode_args)
+                )
+            elif question_examples:
+                pending = _decode_question(
+                    question_id, question_examples, features, results, decode_args, engine.tokenizer
+                )
+            in_flight.append((question_id, question_examples, pending))
+            if len(in_flight) >= self.queue_size:
+                put_oldest()
+        while in_flight:
+            put_oldest()
+        output_queue.put(item)
+
+    def stream_answers(self, examples):
+        """
+        Same answers as QAEngine.stream_answers, in the same order: yields (question_id, example, entry) for the
+        examples grouped by question. The statistics of the stages are in `report()` once the answers are consumed.
+        """
+        featurized = queue.Queue(self.queue_size)
+        scored = queue.Queue(self.queue_size)
+        answered = queue.Queue(self.queue_size)
+        self.stats = collections.OrderedDict(
+            [
+                ("featurize", StageStats(max(self.featurize_workers, 1))),
+                ("forward", StageStats(1)),
+                ("decode", StageStats(max(self.decode_workers, 1))),
+            ]
+        )
+        featurize_pool = self._pool(self.featurize_workers)
+        decode_pool = self._pool(self.decode_workers)
+        threads = [
+            threading.Thread(
+                target=self._run_stage,
+                args=(self._featurize_stage, featurized, examples, featurize_pool, self.stats["featurize"]),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self._run_stage,
+                args=(self._model_stage, scored, featurized, self.stats["forward"]),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self._run_stage,
+                args=(self._decode_stage, answered, scored, decode_pool, self.stats["decode"]),
+                daemon=True,
+            ),
+        ]
+
+        start_time = time.monotonic()
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = answered.get()
+                if item is _END:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.exception
+                yield item
+            self.elapsed = time.monotonic() - start_time
+        finally:
+            for pool in (featurize_pool, decode_pool):
+                if pool is not None:
+                    pool.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_checkpoint_args(parser)
+    parser.add_argument("--predict_file", required=True, type=str, help="KorQuAD open json file to answer.")
+    parser.add_argument("--output_file", default=None, type=str, help="Write the answers (question index -> answer).")
+    parser.add_argument(
+        "--max_paragraphs", default=5, type=int, help="Paragraphs read per question, as in the test prediction."
+    )
+    parser.add_argument("--max_questions", default=None, type=int, help="Only answer the first X questions.")
+    parser.add_argument("--batch_size", default=64, type=int, help="Features per forward pass.")
+    parser.add_argument("--featurize_workers", default=1, type=int, help="Featurization processes, 0 for none.")
+    parser.add_argument("--decode_workers", default=1, type=int, help="Decoding processes, 0 for none.")
+    parser.add_argument("--queue_size", default=16, type=int, help="Maximum questions waiting between two stages.")
+    parser.add_argument("--compare", action="store_true", help="Also time QAEngine.stream_answers and compare.")
+    parser.add_argument("--device", default=None, type=str, help="Device of the model, cuda if available.")
+    args = parser.parse_args()
+
+    engine = QAEngine.from_checkpoint(
+        args.checkpoint_dir, config_name=args.config_name, device=args.device, batch_size=args.batch_size
+    )
+    questions = load_questions(args.predict_file, args.max_paragraphs)[:args.max_questions]
+    examples = engine.make_examples(questions)
+    predictor = PipelinedPredictor(
+        engine,
+        featurize_workers=args.featurize_workers,
+        decode_workers=args.decode_workers,
+        queue_size=args.queue_size,
+    )
+
+    texts = [""] * len(questions)
+    for question_id, _, entry in predictor.stream_answers(examples):
+        texts[question_id] = entry["text"] if entry is not None else ""
+    logger.info("Pipelined: %d questions in %.1f secs (%.1f questions/sec)", len(questions), predictor.elapsed,
+                len(questions) / predictor.elapsed)
+    report = predictor.report()
+    for name, summary in report.items():
+        logger.info("  %-9s utilization %5.1f%%, queue depth mean %.1f max %d, busy %.1f secs (%d workers)", name,
+                    100.0 * summary["utilization"], summary["mean_queue_depth"], summary["max_queue_depth"],
+                    summary["busy_sec"], summary["workers"])
+
+    if args.compare:
+        start_time = time.monotonic()
+        serial_texts = [""] * len(questions)
+        for question_id, _, entry in engine.stream_answers(examples):
+            serial_texts[question_id] = entry["text"] if entry is not None else ""
+        elapsed = time.monotonic() - start_time
+        logger.info("Serial: %d questions in %.1f secs (%.1f questions/sec), stage time sum %.1f secs",
+                    len(questions), elapsed, len(questions) / elapsed,
+                    sum(summary["busy_sec"] for summary in report.values()))
+        logger.info("Speedup %.2fx, %d different answers", elapsed / predictor.elapsed,
+                    sum(text != serial_text for text, serial_text in zip(texts, serial_texts)))
+
+    if args.output_file:
+        with open(args.output_file, "w", encoding="utf-8") as writer:
+            json.dump(dict(enumerate(texts)), writer, ensure_ascii=False, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+KorQuAD open int8 양자화
+
+CPU 추론을 위해 ElectraForQuestionAnswering 의 Linear 층을 int8 로 양자화함
+dynamic 은 가중치만 미리 양자화하고 입력은 배치마다 양자화하며, static 은 dev 배치로 보정 (calibration) 한 입력 범위로
+Linear 층의 입력도 미리 정한 scale 로 양자화함
+양자화한 모델의 state_dict 는 기존 model.pt 로 저장하고, 저장한 인자 (my_args.bin 의 quantization) 로 같은 구조를 만든 뒤 불러옴
+main 은 fp32 와 양자화 모델의 크기, forward 지연 시간, 질문 단위 EM/F1 을 비교하고, --output_dir 에 양자화 체크포인트를 저장함
+
+"""
+
+import argparse
+import copy
+import io
+import logging
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.quantization import DeQuantStub, QuantStub, convert, get_default_qconfig, prepare, quantize_dynamic
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+QUANTIZATION_MODES = ["dynamic", "static"]
+
+
+class StaticQuantizedLinear(nn.Module):
+    """A Linear layer with its input quantized by calibrated scales, the other layers of the model stay fp32."""
+
+    def __init__(self, linear):
+        super(StaticQuantizedLinear, self).__init__()
+        self.quant = QuantStub()
+        self.linear = linear
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.linear(self.quant(x)))
+
+
+def _wrap_linears(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, StaticQuantizedLinear(child))
+        else:
+            _wrap_linears(child)
+
+
+def _relink_output_layers(model):
+    # ElectraForMultiheadQuestionAnswering keeps its output layers in a plain list as well
+    if isinstance(getattr(model, "qa_outputs", None), list):
+        model.qa_outputs = [getattr(model, "qa_outputs_{}".format(i)) for i in range(len(model.qa_outputs))]
+
+
+def quantize_model(model, mode="dynamic", calibration_batches=None):
+    """
+    Quantizes the Linear layers of a model in place, on the CPU, and sets `model.quantization` to the mode.
+
+    calibration_batches: Input dicts of the model the static input scales are observed on. Without them the static
+        structure is only built, for load_state_dict of a saved quantized model.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError("Unknown quantization mode {}, expected one of {}".format(mode, QUANTIZATION_MODES))
+    model.to("cpu")
+    model.eval()
+    if mode == "dynamic":
+        quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    else:
+        _wrap_linears(model)
+        qconfig = get_default_qconfig(torch.backends.quantized.engine)
+        for module in model.modules():
+            if isinstance(module, StaticQuantizedLinear):
+                module.qconfig = qconfig
+        prepare(model, inplace=True)
+        with torch.no_grad():
+            for inputs in calibration_batches or []:
+                model(**inputs)
+        with warnings.catch_warnings():
+            # Observers that saw no batch warn, their scales are overwritten by load_state_dict
+            warnings.simplefilter("ignore")
+            convert(model, inplace=True)
+    _relink_output_layers(model)
+    model.quantization = mode
+    return model
+
+
+def model_size(model):
+    """Bytes of the saved state_dict of a model, as in model.pt."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def forward_latencies(model, dataset, batch_size):
+    """Seconds of each forward pass over the features of a TensorDataset."""
+    input_ids, attention_mask, token_type_ids = dataset.tensors[:3]
+    latencies = []
+    with torch.no_grad():
+        for start in range(0, input_ids.size(0), batch_size):
+            start_time = time.monotonic()
+            model(
+                input_ids=input_ids[start:start + batch_size],
+                attention_mask=attention_mask[start:start + batch_size],
+                token_type_ids=token_type_ids[start:start + batch_size],
+            )
+            latencies.append(time.monotonic() - start_time)
+    return latencies
+
+
+def main():
+    from qa_engine import (
+        CHECKPOINT_ARGS,
+        QAEngine,
+        add_checkpoint_args,
+        load_gold_answers,
+        load_questions,
+        score_answers,
+    )
+
+    parser = argparse.ArgumentParser()
+    add_checkpoint_args(parser, help="Local or NSML fp32 checkpoint directory.")
+    parser.add_argument(
+        "--modes", default=["dynamic"], nargs="+", choices=QUANTIZATION_MODES, help="Quantizations to compare."
+    )
+    parser.add_argument("--predict_file", required=True, type=str, help="KorQuAD open json file with the answers.")
+    parser.add_argument("--max_questions", default=None, type=int, help="Only answer the first X questions.")
+    parser.add_argument("--max_paragraphs", default=5, type=int, help="Paragraphs per question.")
+    parser.add_argument(
+        "--calibration_questions", default=32, type=int, help="Questions of --predict_file calibrating static scales."
+    )
+    parser.add_argument("--batch_size", default=16, type=int, help="Features per forward pass.")
+    parser.add_argument("--questions_per_call", default=16, type=int, help="Questions per answer_many call.")
+    parser.add_argument("--threads", default=None, type=int, help="torch intra-op threads.")
+    parser.add_argument("--strip_particles", action="store_true", help="Score like squad_evaluate --strip_particles.")
+    parser.add_argument(
+        "--output_dir",
+        default=None,
+        type=str,
+        help="Save the first of --modes as an NSML checkpoint (model.pt, tokenizer, my_args.bin) here.",
+    )
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    engine = QAEngine.from_checkpoint(
+        args.checkpoint_dir, config_name=args.config_name, device="cpu", batch_size=args.batch_size
+    )
+    questions = load_questions(args.predict_file, args.max_paragraphs)[:args.max_questions]
+    gold_answers = load_gold_answers(args.predict_file)[:len(questions)]
+    _, dataset = engine.featurize(engine.make_examples(questions[:args.calibration_questions]))
+    input_ids, attention_mask, token_type_ids = dataset.tensors[:3]
+    calibration_batches = [
+        {
+            "input_ids": input_ids[start:start + args.batch_size],
+            "attention_mask": attention_mask[start:start + args.batch_size],
+            "token_type_ids": token_type_ids[start:start + args.batch_size],
+        }
+        for start in range(0, input_ids.size(0), args.batch_size)
+    ]
+
+    fp32_model = engine.model
+    models = [("fp32", fp32_model)]
+    for mode in args.modes:
+        models.append((mode, quantize_model(copy.deepcopy(fp32_model), mode, calibration_batches)))
+
+    print("{:>8} {:>9} {:>11} {:>11} {:>7} {:>7} {:>8}".format(
+        "model", "size_MB", "batch_p50", "questions/s", "EM", "F1", "F1_delta"))
+    fp32_f1 = None
+    for name, model in models:
+        engine.model = model
+        latencies = forward_latencies(model, dataset, args.batch_size)
+        start_time = time.monotonic()
+        answers = []
+        for start in range(0, len(questions), args.questions_per_call):
+            answers.extend(engine.answer_many(questions[start:start + args.questions_per_call]))
+        elapsed = time.monotonic() - start_time
+        exact, f1 = score_answers([answer.text for answer in answers], gold_answers, args.strip_particles)
+        fp32_f1 = f1 if fp32_f1 is None else fp32_f1
+        print("{:>8} {:>9.1f} {:>9.1f}ms {:>11.1f} {:>7.2f} {:>7.2f} {:>+8.2f}".format(
+            name, model_size(model) / 2 ** 20, 1000.0 * float(np.percentile(latencies, 50)),
+            len(questions) / elapsed, exact, f1, f1 - fp32_f1,
+        ))
+
+    if args.output_dir:
+        mode, model = models[1]
+        if os.path.isfile(os.path.join(args.checkpoint_dir, "my_args.bin")):
+            saved_args = torch.load(os.path.join(args.checkpoint_dir, "my_args.bin"))
+        else:
+            saved_args = torch.load(os.path.join(args.checkpoint_dir, "training_args.bin"))
+        saved_args.quantization = mode
+        for name in CHECKPOINT_ARGS:
+            setattr(saved_args, name, getattr(engine, name))
+        os.makedirs(args.output_dir, exist_ok=True)
+        torch.save(model.state_dict(), os.path.join(args.output_dir, "model.pt"))
+        torch.save(engine.tokenizer, os.path.join(args.output_dir, "tokenizer"))
+        torch.save(saved_args, os.path.join(args.output_dir, "my_args.bin"))
+        fp32_model.config.save_pretrained(args.output_dir)
+        logger.info("Saved the %s quantized checkpoint to %s", mode, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
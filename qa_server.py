@@ -0,0 +1,326 @@
+"""
+KorQuAD open 질의응답 서버
+
+QAEngine 을 asyncio HTTP 서버 (TCP 또는 Unix socket) 로 제공함
+들어온 요청은 큐에 쌓아 최대 배치 크기와 최대 대기 시간 안에서 micro-batch 로 묶고, 모델 실행은 worker thread 에서 함
+
+    POST /answer   {"question": "...", "paragraphs": ["...", ...], "timeout_ms": 200}
+                   -> {"text": "...", "probability": 0.9, "paragraph_index": 0, "paragraphs_read": 3, "cut_short": true}
+    GET  /metrics  처리량, p50/p99 지연 시간, 평균 배치 크기
+
+timeout_ms (없으면 --default_timeout_ms) 가 있으면 요청이 도착한 때부터 그 시간 안에 읽을 수 있는 문단까지만 읽고 답함
+부하 측정은 qa_load_generator.py 를 사용
+
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+def latency_summary(latencies):
+    """p50, p99, mean and max of latencies in seconds, in milliseconds."""
+    if not latencies:
+        return {"p50_ms": None, "p99_ms": None, "mean_ms": None, "max_ms": None}
+    latencies = np.asarray(latencies) * 1000.0
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {"p50_ms": float(p50), "p99_ms": float(p99), "mean_ms": float(latencies.mean()),
+            "max_ms": float(latencies.max())}
+
+
+class ServerMetrics(object):
+    """
+    Request latencies (queueing included) and micro-batch sizes of the last `window` requests and batches. The
+    throughput is given since the server started and over the completion times of the last `window` requests.
+    """
+
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.completion_times = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.batch_times = collections.deque(maxlen=window)
+        self.start_time = time.monotonic()
+        self.completed = 0
+        self.errors = 0
+        self.cut_short = 0
+
+    def record_request(self, latency, error=False, cut_short=False):
+        self.latencies.append(latency)
+        self.completion_times.append(time.monotonic())
+        self.completed += 1
+        self.errors += int(error)
+        self.cut_short += int(cut_short)
+
+    def record_batch(self, size, seconds):
+        self.batch_sizes.append(size)
+        self.batch_times.append(seconds)
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start_time
+        window = self.completion_times[-1] - self.completion_times[0] if len(self.completion_times) > 1 else 0.0
+        summary = {
+            "requests": self.completed,
+            "errors": self.errors,
+            "cut_short_rate": self.cut_short / self.completed if self.completed else None,
+            "uptime_sec": elapsed,
+            "throughput_rps": self.completed / elapsed if elapsed > 0 else 0.0,
+            "recent_throughput_rps": (len(self.completion_times) - 1) / window if window > 0 else None,
+            "batches": len(self.batch_sizes),
+            "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+            "mean_batch_ms": float(np.mean(self.batch_times)) * 1000.0 if self.batch_times else None,
+        }
+        summary.update(latency_summary(list(self.latencies)))
+        return summary
+
+
+class MicroBatcher(object):
+    """
+    Queues (question, paragraphs) requests and answers them in micro-batches of at most `max_batch_size` questions.
+    A batch is closed when it is full or `max_wait_ms` after its first request, and answered by
+    `engine.answer_many` on a worker thread, so the event loop keeps accepting requests meanwhile. Requests with a
+    deadline are answered from the paragraphs the engine can read before it.
+    """
+
+    def __init__(self, engine, max_batch_size=16, max_wait_ms=5.0, metrics=None):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, question, paragraphs, deadline=None):
+        """Answer (QAAnswer) of one question, once its micro-batch is done. deadline: a time.monotonic() time."""
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put(((question, paragraphs), deadline, future))
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            questions = [question for question, _, _ in batch]
+            deadlines = [deadline for _, deadline, _ in batch]
+            if all(deadline is None for deadline in deadlines):
+                deadlines = None
+            start_time = time.monotonic()
+            try:
+                answers = await loop.run_in_executor(self.executor, self.engine.answer_many, questions, deadlines)
+            except Exception as e:
+                logger.exception("Batch of %d questions failed", len(batch))
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.metrics.record_batch(len(batch), time.monotonic() - start_time)
+            for (_, _, future), answer in zip(batch, answers):
+                if not future.done():
+                    future.set_result(answer)
+
+
+async def read_http_message(reader):
+    """
+    Start line, lower-cased headers and body of an HTTP/1.1 request or response, None at the end of the stream.
+    Raises ValueError for a Content-Length that is not a non-negative integer.
+    """
+    start_line = await reader.readline()
+    if not start_line:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        content_length = int(headers.get("content-length", 0))
+    except ValueError:
+        content_length = -1
+    if content_length < 0:
+        raise ValueError("Invalid Content-Length {}".format(headers["content-length"]))
+    body = await reader.readexactly(content_length)
+    return start_line.decode("latin-1").strip(), headers, body
+
+
+def http_response(status, payload, keep_alive=True):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    head = "HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: {}\r\n".format(
+        status, HTTP_REASONS.get(status, ""), len(body)
+    )
+    head += "Connection: {}\r\n\r\n".format("keep-alive" if keep_alive else "close")
+    return head.encode("latin-1") + body
+
+
+class QAServer(object):
+    """HTTP front end of a MicroBatcher, connections are kept alive unless the client asks to close them."""
+
+    def __init__(self, batcher, default_timeout_ms=None):
+        self.batcher = batcher
+        self.metrics = batcher.metrics
+        self.default_timeout_ms = default_timeout_ms
+
+    async def handle(self, method, path, body):
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics.summary()
+        if method != "POST" or path != "/answer":
+            return 404, {"error": "Unknown endpoint {} {}".format(method, path)}
+
+        start_time = time.monotonic()
+        try:
+            request = json.loads(body.decode("utf-8"))
+            question, paragraphs = request["question"], request["paragraphs"]
+            # A bad request would otherwise fail in featurization, with every request batched with it
+            if (
+                    not isinstance(question, str) or not isinstance(paragraphs, list)
+                    or not all(isinstance(paragraph, str) for paragraph in paragraphs)
+            ):
+                raise ValueError("question must be a string and paragraphs a list of strings")
+            timeout_ms = request.get("timeout_ms", self.default_timeout_ms)
+            deadline = start_time + float(timeout_ms) / 1000.0 if timeout_ms is not None else None
+        except (ValueError, TypeError, KeyError) as e:
+            return 400, {"error": str(e)}
+        try:
+            answer = await self.batcher.submit(question, paragraphs, deadline)
+        except Exception as e:
+            self.metrics.record_request(time.monotonic() - start_time, error=True)
+            return 500, {"error": str(e)}
+        self.metrics.record_request(time.monotonic() - start_time, cut_short=answer.cut_short)
+        return 200, answer._asdict()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    message = await read_http_message(reader)
+                except ValueError as e:
+                    # The end of the body is unknown, so the connection can not be reused
+                    writer.write(http_response(400, {"error": str(e)}, keep_alive=False))
+                    await writer.drain()
+                    break
+                if message is None:
+                    break
+                start_line, headers, body = message
+                method, path = (start_line.split(" ") + [""])[:2]
+                status, payload = await self.handle(method, path, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(http_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000, unix_socket=None):
+        self.batcher.start()
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+            logger.info("Serving on unix socket %s", unix_socket)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            logger.info("Serving on http://%s:%d", host, port)
+        try:
+            await server.serve_forever()
+        finally:
+            server.close()
+            await self.batcher.stop()
+
+
+def main():
+    from qa_engine import QAEngine, add_checkpoint_args
+
+    parser = argparse.ArgumentParser()
+    add_checkpoint_args(parser)
+    parser.add_argument("--device", default=None, type=str, help="Device of the model, cuda if available.")
+    parser.add_argument("--host", default="127.0.0.1", type=str, help="Address to listen on.")
+    parser.add_argument("--port", default=8000, type=int, help="Port to listen on.")
+    parser.add_argument("--unix_socket", default=None, type=str, help="Listen on this Unix socket instead of TCP.")
+    parser.add_argument("--max_batch_size", default=16, type=int, help="Maximum questions per micro-batch.")
+    parser.add_argument(
+        "--max_wait_ms", default=5.0, type=float, help="Maximum wait for more requests after the first of a batch."
+    )
+    parser.add_argument("--batch_size", default=64, type=int, help="Features per forward pass.")
+    parser.add_argument(
+        "--stop_probability",
+        default=None,
+        type=float,
+        help="Stop reading a question's paragraphs once its answer is this probable, see calibrate_early_stopping.py.",
+    )
+    parser.add_argument("--paragraphs_per_wave", default=1, type=int, help="Paragraphs per question and wave.")
+    parser.add_argument(
+        "--rerank_top_k", default=None, type=int, help="Only read the BM25 top k paragraphs of each request."
+    )
+    parser.add_argument(
+        "--default_timeout_ms", default=None, type=float, help="Deadline of requests without timeout_ms."
+    )
+    args = parser.parse_args()
+
+    engine = QAEngine.from_checkpoint(
+        args.checkpoint_dir,
+        config_name=args.config_name,
+        device=args.device,
+        batch_size=args.batch_size,
+        stop_probability=args.stop_probability,
+        paragraphs_per_wave=args.paragraphs_per_wave,
+        rerank_top_k=args.rerank_top_k,
+    )
+    server = QAServer(
+        MicroBatcher(engine, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms),
+        default_timeout_ms=args.default_timeout_ms,
+    )
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(server.serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        logger.info("Stopped, %s", json.dumps(server.metrics.summary()))
+
+
+if __name__ == "__main__":
+    main()
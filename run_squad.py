@@ -11,16 +11,23 @@ https://github.com/huggingface/transformers/blob/master/examples/question-answer
 """
 
 import argparse
+import copy
+import glob
+import json
 import logging
 import os
+import queue
 import random
+import re
+import shutil
+import threading
 import timeit
 import sys
 
 import numpy as np
 import torch
-import torch.nn as nn
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, RandomSampler, Sampler, SequentialSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
@@ -45,12 +52,12 @@ from transformers import (
     XLNetForQuestionAnswering,
     XLNetTokenizer,
     get_linear_schedule_with_warmup,
-    ElectraModel,
-    ElectraPreTrainedModel,
     ElectraConfig,
     ElectraTokenizer,
+    WEIGHTS_NAME,
 )
 from open_squad import squad_convert_examples_to_features
+from checkpoint_writer import CheckpointWriter, replace_directory, temporary_directory, to_cpu
 
 
 # ''
@@ -58,63 +65,13 @@ from open_squad import squad_convert_examples_to_features
 from open_squad_metrics import (
     compute_predictions_log_probs,
     compute_predictions_logits,
+    merge_eval,
     squad_evaluate,
+    squad_open_evaluate,
 )
-from open_squad import SquadResult, SquadV1Processor, SquadV2Processor
-
-##########################################3
-class ElectraForQuestionAnswering(ElectraPreTrainedModel):
-    def __init__(self, config):
-        super(ElectraForQuestionAnswering, self).__init__(config)
-        self.num_labels = config.num_labels
-
-        self.electra = ElectraModel(config)
-        self.qa_outputs = nn.Linear(config.hidden_size, config.num_labels)
-
-        self.init_weights()
-
-    def forward(
-        self,
-        input_ids=None,
-        attention_mask=None,
-        token_type_ids=None,
-        position_ids=None,
-        head_mask=None,
-        inputs_embeds=None,
-        start_positions=None,
-        end_positions=None,
-    ):
-        outputs = self.electra(
-            input_ids, attention_mask, token_type_ids, position_ids, head_mask, inputs_embeds
-        )
-
-        sequence_output = outputs[0]
-
-        logits = self.qa_outputs(sequence_output)
-        start_logits, end_logits = logits.split(1, dim=-1)
-        start_logits = start_logits.squeeze(-1)
-        end_logits = end_logits.squeeze(-1)
-
-        outputs = (start_logits, end_logits,) + outputs[2:]
-        if start_positions is not None and end_positions is not None:
-            # If we are on multi-GPU, split add a dimension
-            if len(start_positions.size()) > 1:
-                start_positions = start_positions.squeeze(-1)
-            if len(end_positions.size()) > 1:
-                end_positions = end_positions.squeeze(-1)
-            # sometimes the start/end positions are outside our model inputs, we ignore these terms
-            ignored_index = start_logits.size(1)
-            start_positions.clamp_(0, ignored_index)
-            end_positions.clamp_(0, ignored_index)
-
-            loss_fct = torch.nn.CrossEntropyLoss(ignore_index=ignored_index)
-            start_loss = loss_fct(start_logits, start_positions)
-            end_loss = loss_fct(end_logits, end_positions)
-            total_loss = (start_loss + end_loss) / 2
-            outputs = (total_loss,) + outputs
-
-        return outputs  # (loss), start_logits, end_logits, (hidden_states), (attentions)
-
+from open_squad import SquadResult, SquadV1Processor, SquadV2Processor, qas_metadata, stratified_question_subset
+from paragraph_ranker import BM25Ranker
+from modeling_electra import ElectraForEarlyExitQuestionAnswering, ElectraForQuestionAnswering
 
 
 import nsml
@@ -134,7 +91,8 @@ MODEL_CLASSES = {
     "xlm": (XLMConfig, XLMForQuestionAnswering, XLMTokenizer),
     "distilbert": (DistilBertConfig, DistilBertForQuestionAnswering, DistilBertTokenizer),
     "albert": (AlbertConfig, AlbertForQuestionAnswering, AlbertTokenizer),
-    "electra": (ElectraConfig, ElectraForQuestionAnswering, ElectraTokenizer)
+    "electra": (ElectraConfig, ElectraForQuestionAnswering, ElectraTokenizer),
+    "electra_early_exit": (ElectraConfig, ElectraForEarlyExitQuestionAnswering, ElectraTokenizer),
 }
 
 
@@ -149,8 +107,81 @@ def set_seed(args):
 def to_list(tensor):
     return tensor.detach().cpu().tolist()
 
+
+class ResumableRandomSampler(Sampler):
+    """
+    Random sampler with a fixed permutation per (seed, epoch), so that a resumed run can start directly at the
+    saved position of an epoch instead of iterating over and discarding the batches already trained on.
+    """
+
+    def __init__(self, data_source, seed=42):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.data_source), generator=generator).tolist()
+        return iter(indices[self.start_index:])
+
+    def __len__(self):
+        return len(self.data_source) - self.start_index
+
+
+def get_training_state(args, optimizer, scheduler, global_step, epoch, batch_in_epoch, best_f1, tr_loss,
+                       logging_loss):
+    """ Everything besides the model weights that is needed to resume training on the same trajectory """
+    state = {
+        "optimizer": optimizer.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "global_step": global_step,
+        "epoch": epoch,
+        "batch_in_epoch": batch_in_epoch,
+        "best_f1": best_f1,
+        "tr_loss": tr_loss,
+        "logging_loss": logging_loss,
+        "rng": {
+            "python": random.getstate(),
+            "numpy": np.random.get_state(),
+            "torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        },
+    }
+    if args.fp16:
+        from apex import amp
+
+        state["amp"] = amp.state_dict()
+    return state
+
+
+def set_rng_state(rng):
+    random.setstate(rng["python"])
+    np.random.set_state(rng["numpy"])
+    torch.set_rng_state(rng["torch"])
+    if rng["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng["cuda"])
+
+
+def snapshot_state_dict(model):
+    """ Returns a CPU copy of the model weights which stays valid while training keeps updating the model """
+    model_to_save = model.module if hasattr(model, "module") else model
+    return {k: v.detach().cpu().clone() for k, v in model_to_save.state_dict().items()}
+
 # NSML functions
 
+# Extra state for the next nsml.save: "model" replaces the live weights (snapshots evaluated asynchronously),
+# "training_state" is stored next to them to allow resuming, "args" replaces the bound args (the best checkpoint's
+# tuned null threshold)
+_nsml_save_state = {}
+# Training state found by the last nsml.load, consumed by train()
+_nsml_loaded_state = {}
+
 
 def _infer(model, tokenizer, my_args, root_path):
     my_args.data_dir = root_path
@@ -164,9 +195,14 @@ def bind_nsml(model, tokenizer, my_args):
     def save(dir_name, *args, **kwargs):
         os.makedirs(dir_name, exist_ok=True)
 
-        torch.save(model.state_dict(), os.path.join(dir_name, 'model.pt'))
+        state = _nsml_save_state.pop("model", None)
+        torch.save(state if state is not None else model.state_dict(), os.path.join(dir_name, 'model.pt'))
         torch.save(tokenizer, os.path.join(dir_name, 'tokenizer'))
-        torch.save(my_args, os.path.join(dir_name, "my_args.bin"))
+        torch.save(_nsml_save_state.pop("args", my_args), os.path.join(dir_name, "my_args.bin"))
+
+        training_state = _nsml_save_state.pop("training_state", None)
+        if training_state is not None:
+            torch.save(training_state, os.path.join(dir_name, "training_state.pt"))
 
         logger.info("Save model & tokenizer & args at {}".format(dir_name))
 
@@ -180,6 +216,11 @@ def bind_nsml(model, tokenizer, my_args):
         temp_tokenizer = torch.load(os.path.join(dir_name, 'tokenizer'))
         nsml.copy(temp_tokenizer, tokenizer)
 
+        if os.path.isfile(os.path.join(dir_name, "training_state.pt")):
+            _nsml_loaded_state["training_state"] = torch.load(
+                os.path.join(dir_name, "training_state.pt"), map_location="cpu"
+            )
+
         logger.info("Load model & tokenizer & args from {}".format(dir_name))
 
     def infer(root_path):
@@ -191,11 +232,286 @@ def bind_nsml(model, tokenizer, my_args):
     nsml.bind(save=save, load=load, infer=infer)
 
 
+def _nsml_save(name, state=None, training_state=None, args=None):
+    if state is not None:
+        _nsml_save_state["model"] = state
+    if training_state is not None:
+        _nsml_save_state["training_state"] = training_state
+    if args is not None:
+        _nsml_save_state["args"] = args
+    nsml.save(name)
+
+
+def write_checkpoint(args, output_dir, config, state, tokenizer, training_state=None):
+    """ Writes a local checkpoint into a temporary directory and moves it to `output_dir` once complete """
+    tmp_dir = temporary_directory(output_dir)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    config.save_pretrained(tmp_dir)
+    torch.save(state, os.path.join(tmp_dir, WEIGHTS_NAME))
+    tokenizer.save_pretrained(tmp_dir)
+    torch.save(args, os.path.join(tmp_dir, "training_args.bin"))
+    if training_state is not None:
+        torch.save(training_state, os.path.join(tmp_dir, "training_state.pt"))
+
+    replace_directory(tmp_dir, output_dir)
+    logger.info("Saving model checkpoint to %s", output_dir)
+
+
+def save_checkpoint(args, model, tokenizer, name, state=None, training_state=None, writer=None):
+    """
+    Saves the model (or the snapshot `state` of it) with nsml.save, or locally to output_dir/<name>.
+
+    With a `writer`, the weights and the training state are copied to the CPU and serialized in the background.
+    """
+    model_to_save = model.module if hasattr(model, "module") else model
+    if writer is not None:
+        state = snapshot_state_dict(model) if state is None else state
+        training_state = to_cpu(training_state)
+
+    if IS_ON_NSML:
+        fn, fn_args = _nsml_save, (name, state, training_state, copy.copy(args))
+    else:
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+        fn, fn_args = write_checkpoint, (
+            copy.copy(args),
+            os.path.join(args.output_dir, name),
+            model_to_save.config,
+            model_to_save.state_dict() if state is None else state,
+            tokenizer,
+            training_state,
+        )
+
+    if writer is None:
+        fn(*fn_args)
+    else:
+        writer.submit(fn, *fn_args)
+
+
+def save_best_checkpoint(args, model, tokenizer, state=None, writer=None):
+    """ Saves the best model so far, either the live model or an evaluated snapshot of it """
+    # checkpoint-best is the local stand-in for the NSML best checkpoint
+    name = args.model_type + "_best" if IS_ON_NSML else "checkpoint-best"
+    save_checkpoint(args, model, tokenizer, name, state=state, writer=writer)
+
+
+def report_evaluation(args, model, tokenizer, result, global_step, loss, best_f1, state=None, full=True,
+                      writer=None):
+    """ Logs/reports one dev evaluation and saves the best checkpoint. Returns the updated best f1. """
+    if not full:
+        # Subset results are only indicative, the best checkpoint is selected on the full dev set
+        logger.info(
+            "f1_subset_val = {}, exact_subset_val = {}, loss = {}, global_step = {}".format(
+                result["f1"], result["exact"], loss, global_step))
+        if IS_ON_NSML:
+            nsml.report(summary=True, step=global_step, f1_subset=result["f1"], exact_subset=result["exact"],
+                        loss=loss)
+        return best_f1
+
+    _f1, _exact = result["f1"], result["exact"]
+    # With a tuned null threshold every evaluation is compared at its own best threshold, f1 is at the
+    # --null_score_diff_threshold of the command line
+    selection_f1 = result["best_f1"] if "null_score_diff_threshold" in result else _f1
+    is_best = selection_f1 > best_f1
+    best_f1 = max(selection_f1, best_f1)
+
+    logger.info(
+        "best_f1_val = {}, f1_val = {}, exact_val = {}, loss = {}, global_step = {}, " \
+        .format(best_f1, _f1, _exact, loss, global_step))
+    if "open_f1" in result:
+        logger.info("open_f1_val = {}, open_exact_val = {} (per question, as submitted)".format(
+            result["open_f1"], result["open_exact"]))
+    if IS_ON_NSML:
+        open_scores = {"open_f1": result["open_f1"], "open_exact": result["open_exact"]} if "open_f1" in result else {}
+        nsml.report(summary=True, step=global_step, f1=_f1, exact=_exact, loss=loss, **open_scores)
+    if is_best:
+        checkpoint_args = args
+        if "null_score_diff_threshold" in result:
+            # The tuned threshold goes into the args saved with this checkpoint only, and so into inference with it
+            checkpoint_args = copy.copy(args)
+            checkpoint_args.null_score_diff_threshold = result["null_score_diff_threshold"]
+            logger.info("null_score_diff_threshold = {} (best_f1 = {})".format(
+                checkpoint_args.null_score_diff_threshold, result["best_f1"]))
+        save_best_checkpoint(checkpoint_args, model, tokenizer, state=state, writer=writer)
+
+    return best_f1
+
+
+def _async_evaluate_worker(args, config, tokenizer, request_queue, result_queue):
+    """ Background evaluator process: featurizes the dev set once, then evaluates each submitted snapshot """
+    _, model_class, _ = MODEL_CLASSES[args.model_type]
+    args.device = torch.device(args.async_eval_device) if args.async_eval_device else args.device
+    args.n_gpu = 1 if args.device.type == "cuda" else 0
+
+    model = model_class(config)
+    model.to(args.device)
+    eval_data = load_and_cache_examples(args, tokenizer, evaluate=True, output_examples=True)
+    open_eval_data = load_and_cache_examples(args, tokenizer, evaluate=True, output_examples=True, val_or_test="open")
+
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+        global_step, state = request
+        model.load_state_dict(state)
+        result = evaluate(
+            args, model, tokenizer, prefix="gs{}".format(global_step), eval_data=eval_data,
+            open_eval_data=open_eval_data,
+        )
+        result_queue.put((global_step, result))
+
+
+def subset_eval_data(eval_data, example_indices):
+    """ Restricts featurized dev data (dataset, examples, features) to the given examples without re-featurizing """
+    dataset, examples, features = eval_data
+    new_example_index = {old: new for new, old in enumerate(example_indices)}
+
+    subset_features, feature_indices = [], []
+    for i, feature in enumerate(features):
+        if feature.example_index in new_example_index:
+            feature = copy.copy(feature)
+            feature.example_index = new_example_index[feature.example_index]
+            subset_features.append(feature)
+            feature_indices.append(i)
+
+    feature_indices = torch.tensor(feature_indices, dtype=torch.long)
+    tensors = [tensor[feature_indices] for tensor in dataset.tensors]
+    # Position 3 of an evaluation dataset indexes into the feature list
+    tensors[3] = torch.arange(len(subset_features), dtype=torch.long)
+
+    return TensorDataset(*tensors), [examples[i] for i in example_indices], subset_features
+
+
+class SubsetEvaluator(object):
+    """
+    Evaluates on a fixed, stratified sample of dev questions and only runs the full dev set every
+    `full_eval_every` evaluations, when the subset f1 reaches a new high, or when forced (at epoch end).
+    Full results carry the subset metrics of the same weights, which are used to report how well the subset
+    tracks the full dev set.
+    """
+
+    def __init__(self, eval_data, num_questions, full_eval_every, seed=42, open_eval_data=None):
+        self.eval_data = eval_data
+        self.open_eval_data = open_eval_data
+        example_indices = stratified_question_subset(eval_data[1], num_questions, seed=seed)
+        self.subset_data = subset_eval_data(eval_data, example_indices)
+        self.subset_open_data = None
+        if open_eval_data is not None:
+            # The same questions, with the paragraphs the submission reads
+            question_ids = set(eval_data[1][i].question_id for i in example_indices)
+            open_indices = [i for i, example in enumerate(open_eval_data[1]) if example.question_id in question_ids]
+            self.subset_open_data = subset_eval_data(open_eval_data, open_indices)
+        self.full_eval_every = full_eval_every
+        self.num_evals = 0
+        self.best_subset_f1 = -1
+        self.tracking = []
+
+        logger.info("  Fast evaluation on %d of %d dev examples", len(example_indices), len(eval_data[1]))
+
+    def evaluate(self, args, model, tokenizer, prefix="", force_full=False):
+        """ Returns (result, is_full) """
+        self.num_evals += 1
+        subset_result = evaluate(
+            args, model, tokenizer, prefix=prefix, eval_data=self.subset_data, open_eval_data=self.subset_open_data
+        )
+        is_subset_best = subset_result["f1"] > self.best_subset_f1
+        self.best_subset_f1 = max(subset_result["f1"], self.best_subset_f1)
+
+        run_full = (
+            force_full
+            or is_subset_best
+            or (self.full_eval_every > 0 and self.num_evals % self.full_eval_every == 0)
+        )
+        if not run_full:
+            return subset_result, False
+
+        result = evaluate(
+            args, model, tokenizer, prefix=prefix, eval_data=self.eval_data, open_eval_data=self.open_eval_data
+        )
+        result["subset_f1"], result["subset_exact"] = subset_result["f1"], subset_result["exact"]
+        self.tracking.append((subset_result["f1"], result["f1"]))
+        logger.info(self.tracking_summary())
+        return result, True
+
+    def tracking_summary(self):
+        subset_f1, full_f1 = np.array(self.tracking).T
+        summary = "subset vs full dev f1 over {} evaluations: mean |diff| = {:.2f}".format(
+            len(self.tracking), np.abs(subset_f1 - full_f1).mean())
+        if len(self.tracking) > 1 and subset_f1.std() > 0 and full_f1.std() > 0:
+            summary += ", pearson r = {:.3f}".format(np.corrcoef(subset_f1, full_f1)[0, 1])
+        return summary
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluates training snapshots in a background process so that train() does not stall on dev prediction.
+
+    Each snapshot is kept on the CPU until its result comes back, so that a "best" save stores the weights that
+    were actually evaluated. At most `max_pending` snapshots are in flight, a further submission waits for the
+    oldest one, so every snapshot is evaluated and the best one does not depend on timing.
+    """
+
+    def __init__(self, args, config, tokenizer, max_pending=1):
+        # CUDA can not be re-initialized in a forked child
+        ctx = mp.get_context("spawn")
+        self.request_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.max_pending = max_pending
+        self.pending = {}
+        self.process = ctx.Process(
+            target=_async_evaluate_worker,
+            args=(args, config, tokenizer, self.request_queue, self.result_queue),
+            daemon=True,
+        )
+        self.process.start()
+
+    def submit(self, global_step, model, loss):
+        """ Queues a snapshot, first waiting while `max_pending` are in flight. Returns the finished evaluations """
+        finished = self.poll(block=True, max_pending=self.max_pending - 1)
+        state = snapshot_state_dict(model)
+        self.pending[global_step] = (loss, state)
+        self.request_queue.put((global_step, state))
+        return finished
+
+    def poll(self, block=False, max_pending=0):
+        """
+        Returns finished evaluations as (global_step, loss, result, state) tuples. With block, waits until at most
+        `max_pending` snapshots are in flight.
+        """
+        finished = []
+        while self.pending:
+            wait = block and len(self.pending) > max_pending
+            try:
+                global_step, result = self.result_queue.get(block=wait, timeout=60 if wait else None)
+            except queue.Empty:
+                if wait and self.process.is_alive():
+                    continue
+                if not self.process.is_alive():
+                    raise RuntimeError("Async evaluator exited with code {}".format(self.process.exitcode))
+                break
+            loss, state = self.pending.pop(global_step)
+            finished.append((global_step, loss, result, state))
+        return finished
+
+    def close(self):
+        """ Waits for the in-flight snapshots and stops the evaluator """
+        finished = self.poll(block=True)
+        self.request_queue.put(None)
+        self.process.join()
+        return finished
+
+
 def train(args, train_dataset, model, tokenizer):
     """ Train the model """
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+    train_sampler = (
+        ResumableRandomSampler(train_dataset, seed=args.seed)
+        if args.local_rank == -1
+        else DistributedSampler(train_dataset)
+    )
     train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
 
     if args.max_steps > 0:
@@ -204,22 +520,50 @@ def train(args, train_dataset, model, tokenizer):
     else:
         t_total = len(train_dataloader) // args.gradient_accumulation_steps * args.num_train_epochs
 
+    # Schedule of the "no answer" exits of an early exit model
+    early_exit = isinstance(model, ElectraForEarlyExitQuestionAnswering)
+    exit_training = getattr(args, "exit_training", "joint")
+    exit_start_step = 0
+    # A frozen exit training starts from the reader's weights, not from its optimizer state or global step
+    resume_local = not (early_exit and exit_training == "frozen")
+    if early_exit and exit_training == "frozen":
+        # Only the exits learn, on top of the fine-tuned reader of model_name_or_path
+        for name, parameter in model.named_parameters():
+            parameter.requires_grad = name.startswith("exits.")
+    elif early_exit:
+        exit_start_step = int(getattr(args, "exit_start_ratio", 0.0) * t_total)
+
     # Prepare optimizer and schedule (linear warmup and decay)
     no_decay = ["bias", "LayerNorm.weight"]
     optimizer_grouped_parameters = [
         {
-            "params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
+            "params": [
+                p for n, p in model.named_parameters() if p.requires_grad and not any(nd in n for nd in no_decay)
+            ],
             "weight_decay": args.weight_decay,
         },
-        {"params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], "weight_decay": 0.0},
+        {
+            "params": [p for n, p in model.named_parameters() if p.requires_grad and any(nd in n for nd in no_decay)],
+            "weight_decay": 0.0,
+        },
     ]
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = get_linear_schedule_with_warmup(
         optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total
     )
 
-    # Check if saved optimizer or scheduler states exist
-    if os.path.isfile(os.path.join(args.model_name_or_path, "optimizer.pt")) and os.path.isfile(
+    # Check if a saved training state (nsml.load or local checkpoint) exists
+    training_state = _nsml_loaded_state.pop("training_state", None)
+    if (
+            training_state is None and resume_local
+            and os.path.isfile(os.path.join(args.model_name_or_path, "training_state.pt"))
+    ):
+        training_state = torch.load(os.path.join(args.model_name_or_path, "training_state.pt"), map_location="cpu")
+
+    if training_state is not None:
+        optimizer.load_state_dict(training_state["optimizer"])
+        scheduler.load_state_dict(training_state["scheduler"])
+    elif resume_local and os.path.isfile(os.path.join(args.model_name_or_path, "optimizer.pt")) and os.path.isfile(
             os.path.join(args.model_name_or_path, "scheduler.pt")
     ):
         # Load in optimizer and scheduler states
@@ -233,6 +577,8 @@ def train(args, train_dataset, model, tokenizer):
             raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
 
         model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16_opt_level)
+        if training_state is not None and "amp" in training_state:
+            amp.load_state_dict(training_state["amp"])
 
     # multi-gpu training (should be after apex fp16 initialization)
     if args.n_gpu > 1:
@@ -243,6 +589,7 @@ def train(args, train_dataset, model, tokenizer):
         model = torch.nn.parallel.DistributedDataParallel(
             model, device_ids=[args.local_rank], output_device=args.local_rank, find_unused_parameters=True
         )
+    model_to_train = model.module if hasattr(model, "module") else model
 
     # Train!
     logger.info("***** Running training *****")
@@ -257,12 +604,33 @@ def train(args, train_dataset, model, tokenizer):
     )
     logger.info("  Gradient Accumulation steps = %d", args.gradient_accumulation_steps)
     logger.info("  Total optimization steps = %d", t_total)
+    if early_exit:
+        logger.info("  Exits after layers %s, %s training", model_to_train.exit_layers, exit_training)
+        logger.info("  Exit loss weight %s from global step %d", getattr(args, "exit_loss_weight", 1.0),
+                    exit_start_step)
 
     global_step = 1
     epochs_trained = 0
     steps_trained_in_current_epoch = 0
+    batches_trained_in_current_epoch = 0
+    tr_loss, logging_loss = 0.0, 0.0
+    best_f1, best_exact = -1, -1
     # Check if continuing training from a checkpoint
-    if os.path.exists(args.model_name_or_path):
+    if training_state is not None:
+        global_step = training_state["global_step"]
+        epochs_trained = training_state["epoch"]
+        batches_trained_in_current_epoch = training_state["batch_in_epoch"]
+        if batches_trained_in_current_epoch >= len(train_dataloader):
+            epochs_trained += 1
+            batches_trained_in_current_epoch = 0
+        best_f1 = training_state["best_f1"]
+        tr_loss, logging_loss = training_state["tr_loss"], training_state["logging_loss"]
+
+        logger.info("  Continuing training from saved training state")
+        logger.info("  Continuing training from epoch %d", epochs_trained)
+        logger.info("  Continuing training from global step %d", global_step)
+        logger.info("  Will start at batch %d of the first epoch", batches_trained_in_current_epoch)
+    elif resume_local and os.path.exists(args.model_name_or_path):
         try:
             # set global_step to global_step of last saved checkpoint from model path
             checkpoint_suffix = args.model_name_or_path.split("-")[-1].split("/")[0]
@@ -277,7 +645,6 @@ def train(args, train_dataset, model, tokenizer):
         except ValueError:
             logger.info("  Starting fine-tuning.")
 
-    tr_loss, logging_loss = 0.0, 0.0
     model.zero_grad()
     train_iterator = trange(
         epochs_trained, int(args.num_train_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0]
@@ -285,11 +652,59 @@ def train(args, train_dataset, model, tokenizer):
     # Added here for reproducibility
     set_seed(args)
 
-    best_f1, best_exact = -1, -1
+    async_evaluator = None
+    if args.async_eval and args.evaluate_during_training and args.local_rank in [-1, 0]:
+        model_to_eval = model.module if hasattr(model, "module") else model
+        async_evaluator = AsyncEvaluator(
+            args, model_to_eval.config, tokenizer, max_pending=args.async_eval_max_pending
+        )
 
+    checkpoint_writer = None
+    if args.background_save and args.local_rank in [-1, 0]:
+        checkpoint_writer = CheckpointWriter(max_pending=args.save_queue_size)
+
+    # Featurize the dev set once for all the evaluations during training
+    eval_data, open_eval_data, subset_evaluator = None, None, None
+    if args.evaluate_during_training and async_evaluator is None and args.local_rank in [-1, 0]:
+        eval_data = load_and_cache_examples(args, tokenizer, evaluate=True, output_examples=True)
+        open_eval_data = load_and_cache_examples(
+            args, tokenizer, evaluate=True, output_examples=True, val_or_test="open"
+        )
+        if args.fast_eval_questions > 0:
+            subset_evaluator = SubsetEvaluator(
+                eval_data, args.fast_eval_questions, args.full_eval_every, seed=args.seed,
+                open_eval_data=open_eval_data,
+            )
+    current_loss = 0.0
+
+    resume_rng = None
+    if training_state is not None:
+        resume_rng = training_state["rng"]
+        del training_state
+        if batches_trained_in_current_epoch == 0:
+            # Saved at the end of an epoch, before the next epoch iterator was created
+            set_rng_state(resume_rng)
+            resume_rng = None
+
+    epoch, step = epochs_trained, batches_trained_in_current_epoch - 1
     for epoch in train_iterator:
-        epoch_iterator = train_dataloader
-        for step, batch in enumerate(epoch_iterator):
+        first_batch = batches_trained_in_current_epoch
+        if isinstance(train_sampler, ResumableRandomSampler):
+            # Jump directly to the saved position instead of skipping batches one by one
+            train_sampler.set_epoch(epoch, start_index=batches_trained_in_current_epoch * args.train_batch_size)
+        else:
+            # DistributedSampler shuffles per epoch and always starts at the first batch, the batches already
+            # trained on in a resumed epoch are skipped
+            train_sampler.set_epoch(epoch)
+            steps_trained_in_current_epoch = max(steps_trained_in_current_epoch, batches_trained_in_current_epoch)
+            first_batch = 0
+        epoch_iterator = iter(train_dataloader)
+        if resume_rng is not None:
+            # Creating the iterator draws the DataLoader's base seed from the global RNG. The run that was saved
+            # mid-epoch drew it before the saved state, so the state is restored after the draw
+            set_rng_state(resume_rng)
+            resume_rng = None
+        for step, batch in enumerate(epoch_iterator, start=first_batch):
 
             # Skip past any already trained steps if resuming training
             if steps_trained_in_current_epoch > 0:
@@ -298,6 +713,11 @@ def train(args, train_dataset, model, tokenizer):
 
             model.train()
             batch = tuple(t.to(args.device) for t in batch)
+            if early_exit:
+                # Before exit_start_step the exits do not pull on the layers that are still learning the task
+                model_to_train.exit_loss_weight = (
+                    getattr(args, "exit_loss_weight", 1.0) if global_step > exit_start_step else 0.0
+                )
 
             inputs = {
                 "input_ids": batch[0],
@@ -342,72 +762,149 @@ def train(args, train_dataset, model, tokenizer):
                 model.zero_grad()
                 global_step += 1
 
+                if async_evaluator is not None:
+                    for eval_step, eval_loss, result, state in async_evaluator.poll():
+                        best_f1 = report_evaluation(
+                            args, model, tokenizer, result, eval_step, eval_loss, best_f1, state=state,
+                            writer=checkpoint_writer,
+                        )
+
                 # Log metrics
                 if args.local_rank in [-1, 0] and args.logging_steps > 0 and global_step % args.logging_steps == 0:
                     # Only evaluate when single GPU otherwise metrics may not average well
                     if args.evaluate_during_training:
-                        logger.info("Validation start for epoch {} global_step {}".format(epoch, global_step))
-                        result = evaluate(args, model, tokenizer, prefix=epoch)
-                        _f1, _exact = result["f1"], result["exact"]
-                        is_best = _f1 > best_f1
-                        best_f1 = max(_f1, best_f1)
-
                         current_loss = (tr_loss - logging_loss) / args.logging_steps
                         logging_loss = tr_loss
 
-                        logger.info(
-                            "best_f1_val = {}, f1_val = {}, exact_val = {}, loss = {}, global_step = {}, " \
-                            .format(best_f1, _f1, _exact, current_loss, global_step))
-                        if IS_ON_NSML:
-                            nsml.report(summary=True, step=global_step, f1=_f1, exact=_exact, loss=current_loss)
-                            if is_best:
-                                nsml.save(args.model_type + "_best")
+                        if async_evaluator is not None:
+                            for eval_step, eval_loss, result, state in async_evaluator.submit(
+                                    global_step, model, current_loss
+                            ):
+                                best_f1 = report_evaluation(
+                                    args, model, tokenizer, result, eval_step, eval_loss, best_f1, state=state,
+                                    writer=checkpoint_writer,
+                                )
+                        elif subset_evaluator is not None:
+                            logger.info("Validation start for epoch {} global_step {}".format(epoch, global_step))
+                            result, is_full = subset_evaluator.evaluate(args, model, tokenizer, prefix=epoch)
+                            best_f1 = report_evaluation(
+                                args, model, tokenizer, result, global_step, current_loss, best_f1, full=is_full,
+                                writer=checkpoint_writer,
+                            )
+                        else:
+                            logger.info("Validation start for epoch {} global_step {}".format(epoch, global_step))
+                            result = evaluate(
+                                args, model, tokenizer, prefix=epoch, eval_data=eval_data,
+                                open_eval_data=open_eval_data,
+                            )
+                            best_f1 = report_evaluation(
+                                args, model, tokenizer, result, global_step, current_loss, best_f1,
+                                writer=checkpoint_writer,
+                            )
 
                 if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
+                    training_state = get_training_state(
+                        args, optimizer, scheduler, global_step, epoch, step + 1, best_f1, tr_loss, logging_loss
+                    )
                     if IS_ON_NSML:
-                        nsml.save(args.model_type + "_gs{}_e{}".format(global_step, epoch))
+                        checkpoint_name = args.model_type + "_gs{}_e{}".format(global_step, epoch)
                     else:
-                        output_dir = os.path.join(args.output_dir, "checkpoint-{}".format(global_step))
-                        if not os.path.exists(output_dir):
-                            os.makedirs(output_dir)
-                        # Take care of distributed/parallel training
-                        model_to_save = model.module if hasattr(model, "module") else model
-                        model_to_save.save_pretrained(output_dir)
-                        tokenizer.save_pretrained(output_dir)
-
-                        torch.save(args, os.path.join(output_dir, "training_args.bin"))
-                        logger.info("Saving model checkpoint to %s", output_dir)
-
-                        torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt"))
-                        torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
-                        logger.info("Saving optimizer and scheduler states to %s", output_dir)
+                        checkpoint_name = "checkpoint-{}".format(global_step)
+                    save_checkpoint(
+                        args, model, tokenizer, checkpoint_name, training_state=training_state,
+                        writer=checkpoint_writer,
+                    )
+                    del training_state
 
             if 0 < args.max_steps < global_step:
-                epoch_iterator.close()
                 break
 
+        batches_trained_in_current_epoch = 0
+
+        if subset_evaluator is not None:
+            logger.info("Full validation at the end of epoch {}".format(epoch))
+            result, _ = subset_evaluator.evaluate(args, model, tokenizer, prefix=epoch, force_full=True)
+            best_f1 = report_evaluation(
+                args, model, tokenizer, result, global_step, current_loss, best_f1, writer=checkpoint_writer
+            )
+
         if 0 < args.max_steps < global_step:
             train_iterator.close()
             break
 
+    if async_evaluator is not None:
+        for eval_step, eval_loss, result, state in async_evaluator.close():
+            best_f1 = report_evaluation(
+                args, model, tokenizer, result, eval_step, eval_loss, best_f1, state=state, writer=checkpoint_writer
+            )
+
     if IS_ON_NSML:
-        nsml.save(args.model_type + "_last")
+        training_state = get_training_state(
+            args, optimizer, scheduler, global_step, epoch, step + 1, best_f1, tr_loss, logging_loss
+        )
+        save_checkpoint(
+            args, model, tokenizer, args.model_type + "_last", training_state=training_state, writer=checkpoint_writer
+        )
+
+    if checkpoint_writer is not None:
+        # Make sure every checkpoint is on disk before returning
+        checkpoint_writer.close()
 
     return global_step, tr_loss / global_step
 
 
-def evaluate(args, model, tokenizer, prefix="", val_or_test="val"):
-    examples, predictions = predict(args, model, tokenizer, prefix=prefix, val_or_test=val_or_test)
+def evaluate(args, model, tokenizer, prefix="", val_or_test="val", eval_data=None, open_eval_data=None):
+    """
+    Paragraph level scores of the dev examples, whose paragraphs are picked with the answer, and the question level
+    "open" scores of the answers aggregated over the paragraphs the submission reads (`open_eval_data`, loaded
+    if not given).
+    """
+    examples, predictions, details = predict(
+        args, model, tokenizer, prefix=prefix, val_or_test=val_or_test, eval_data=eval_data, return_details=True
+    )
     # Compute the F1 and exact scores.
-    results = squad_evaluate(examples, predictions)
+    if details is not None and args.tune_null_threshold and args.version_2_with_negative:
+        # Scoring the best non-null answers against their null score differences gives the scores at the current
+        # threshold, and as best_f1_thresh the threshold that maximizes f1
+        results = squad_evaluate(
+            examples,
+            details["non_null_predictions"],
+            no_answer_probs=details["scores_diff"],
+            no_answer_probability_threshold=args.null_score_diff_threshold,
+            strip_particles=args.strip_particles,
+            num_workers=args.scoring_workers,
+        )
+        results["null_score_diff_threshold"] = results["best_f1_thresh"]
+    else:
+        results = squad_evaluate(
+            examples, predictions, strip_particles=args.strip_particles, num_workers=args.scoring_workers
+        )
+
+    if details is not None:
+        # Question level scores of the answers aggregated over the paragraphs, as in the submission
+        if open_eval_data is None:
+            open_eval_data = load_and_cache_examples(
+                args, tokenizer, evaluate=True, output_examples=True, val_or_test="open"
+            )
+        open_examples, _, open_details = predict(
+            args, model, tokenizer, prefix="{}_open".format(prefix), eval_data=open_eval_data, return_details=True
+        )
+        open_results = squad_open_evaluate(open_examples, open_details["nbest"], strip_particles=args.strip_particles)
+        merge_eval(results, open_results, "open")
     return results
 
 
-def predict(args, model, tokenizer, prefix="", val_or_test="val"):
-    dataset, examples, features = load_and_cache_examples(
-        args, tokenizer, evaluate=True, output_examples=True,
-        val_or_test=val_or_test,
-    )
+def predict(args, model, tokenizer, prefix="", val_or_test="val", eval_data=None, return_details=False):
+    """
+    Predicts the answers of the dev (or test) set. With return_details, also returns the details dict of
+    compute_predictions_logits (n-best answers, null score differences), None for XLNet and XLM.
+    """
+    if eval_data is None:
+        eval_data = load_and_cache_examples(
+            args, tokenizer, evaluate=True, output_examples=True,
+            val_or_test=val_or_test,
+        )
+    dataset, examples, features = eval_data
 
     if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
         os.makedirs(args.output_dir)
@@ -494,6 +991,7 @@ def predict(args, model, tokenizer, prefix="", val_or_test="val"):
     else:
         output_null_log_odds_file = None
 
+    details = None
     # XLNet and XLM use a more complex post-processing procedure
     if args.model_type in ["xlnet", "xlm"]:
         start_n_top = model.config.start_n_top if hasattr(model, "config") else model.module.config.start_n_top
@@ -530,11 +1028,132 @@ def predict(args, model, tokenizer, prefix="", val_or_test="val"):
             args.null_score_diff_threshold,
             tokenizer,
             is_test=(val_or_test == "test"),
+            return_details=return_details and val_or_test != "test",
         )
+        if return_details and val_or_test != "test":
+            predictions, details = predictions
 
+    if return_details:
+        return examples, predictions, details
     return examples, predictions
 
 
+def checkpoint_global_step(checkpoint):
+    """ Parses the global step out of a local (checkpoint-1000) or NSML (electra_gs1000_e0) checkpoint name """
+    match = re.search(r"(?:checkpoint-|_gs)(\d+)", os.path.basename(checkpoint.rstrip("/")))
+    return int(match.group(1)) if match else None
+
+
+def _prefetch_checkpoints(checkpoints, max_prefetch=1):
+    """ Yields (checkpoint, state_dict), reading the next checkpoint from disk while the current one is evaluated """
+    loaded = queue.Queue(maxsize=max_prefetch)
+
+    def load():
+        for checkpoint in checkpoints:
+            loaded.put((checkpoint, torch.load(os.path.join(checkpoint, WEIGHTS_NAME), map_location="cpu")))
+        loaded.put(None)
+
+    threading.Thread(target=load, daemon=True).start()
+    while True:
+        item = loaded.get()
+        if item is None:
+            return
+        yield item
+
+
+def eval_checkpoint_worker_init(args_for_eval, tokenizer_for_eval, eval_data_for_eval, open_eval_data_for_eval,
+                                device_queue):
+    global eval_worker_args, eval_worker_tokenizer, eval_worker_data, eval_worker_open_data
+    eval_worker_args = copy.copy(args_for_eval)
+    eval_worker_args.device = torch.device(device_queue.get())
+    eval_worker_args.n_gpu = 1 if eval_worker_args.device.type == "cuda" else 0
+    eval_worker_tokenizer = tokenizer_for_eval
+    eval_worker_data = eval_data_for_eval
+    eval_worker_open_data = open_eval_data_for_eval
+
+
+def eval_checkpoint_worker(checkpoint):
+    _, model_class, _ = MODEL_CLASSES[eval_worker_args.model_type]
+    model = model_class.from_pretrained(checkpoint)
+    model.to(eval_worker_args.device)
+    prefix = os.path.basename(checkpoint.rstrip("/"))
+    result = evaluate(
+        eval_worker_args, model, eval_worker_tokenizer, prefix=prefix, eval_data=eval_worker_data,
+        open_eval_data=eval_worker_open_data,
+    )
+    return checkpoint, result
+
+
+def evaluate_all_checkpoints(args, model, tokenizer):
+    """
+    Evaluates every checkpoint-* directory under output_dir (or the NSML checkpoints in
+    --eval_checkpoint_names) on a dev set featurized only once, and logs one f1/exact table per global step.
+    """
+    eval_data = load_and_cache_examples(args, tokenizer, evaluate=True, output_examples=True)
+    open_eval_data = load_and_cache_examples(args, tokenizer, evaluate=True, output_examples=True, val_or_test="open")
+    results = {}
+
+    if args.eval_checkpoint_names:
+        # NSML checkpoints can only be loaded into the bound model, one at a time
+        cli_args = copy.copy(args)
+        for checkpoint in cli_args.eval_checkpoint_names.split(","):
+            if cli_args.eval_session:
+                nsml.load(checkpoint=checkpoint, session=cli_args.eval_session)
+            else:
+                nsml.load(checkpoint=checkpoint)
+            # nsml.load copied the training args saved with the checkpoint into the bound args
+            vars(args).clear()
+            vars(args).update(vars(cli_args))
+            results[checkpoint] = evaluate(
+                args, model, tokenizer, prefix=checkpoint, eval_data=eval_data, open_eval_data=open_eval_data
+            )
+    else:
+        checkpoints = sorted(
+            (c for c in glob.glob(os.path.join(args.output_dir, "checkpoint-*")) if os.path.isdir(c)),
+            key=lambda c: (checkpoint_global_step(c) is None, checkpoint_global_step(c) or 0, c),
+        )
+        logger.info("Evaluate the following checkpoints: %s", checkpoints)
+
+        if args.eval_workers > 1:
+            ctx = mp.get_context("spawn")
+            device_queue = ctx.Queue()
+            for i in range(args.eval_workers):
+                device_queue.put("cuda:{}".format(i % args.n_gpu) if args.n_gpu > 0 else "cpu")
+            with ctx.Pool(
+                    args.eval_workers,
+                    initializer=eval_checkpoint_worker_init,
+                    initargs=(args, tokenizer, eval_data, open_eval_data, device_queue),
+            ) as p:
+                for checkpoint, result in p.imap_unordered(eval_checkpoint_worker, checkpoints):
+                    results[checkpoint] = result
+        else:
+            for checkpoint, state in _prefetch_checkpoints(checkpoints):
+                model.load_state_dict(state)
+                prefix = os.path.basename(checkpoint.rstrip("/"))
+                results[checkpoint] = evaluate(
+                    args, model, tokenizer, prefix=prefix, eval_data=eval_data, open_eval_data=open_eval_data
+                )
+
+    rows = sorted(
+        ((checkpoint_global_step(c), os.path.basename(c.rstrip("/")), r) for c, r in results.items()),
+        key=lambda row: (row[0] is None, row[0] or 0, row[1]),
+    )
+    logger.info("***** Results for all checkpoints *****")
+    logger.info("%12s  %-28s  %8s  %8s", "global_step", "checkpoint", "exact", "f1")
+    for global_step, name, result in rows:
+        logger.info("%12s  %-28s  %8.2f  %8.2f",
+                    "-" if global_step is None else global_step, name, result["exact"], result["f1"])
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    with open(os.path.join(args.output_dir, "eval_all_checkpoints.json"), "w") as writer:
+        writer.write(json.dumps(
+            [{"global_step": step, "checkpoint": name, "exact": r["exact"], "f1": r["f1"]} for step, name, r in rows],
+            indent=4) + "\n")
+
+    return results
+
+
 def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=False, val_or_test="val"):
     if args.local_rank not in [-1, 0] and not evaluate:
         # Make sure only the first process in distributed training process the dataset,
@@ -543,10 +1162,20 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
 
     # Load data features from cache or dataset file
     input_dir = args.data_dir if args.data_dir else "."
+    rerank_paragraphs = evaluate and val_or_test == "open" and getattr(args, "rerank_paragraphs", False)
+    if not evaluate:
+        split = "train"
+    elif val_or_test != "open":
+        split = "dev"
+    elif rerank_paragraphs:
+        # The reranked features only hold the top paragraphs of each question
+        split = "dev_open_rerank{}".format(getattr(args, "rerank_top_k", 5))
+    else:
+        split = "dev_open"
     cached_features_file = os.path.join(
         input_dir,
         "cached_{}_{}_{}".format(
-            "dev" if evaluate else "train",
+            split,
             list(filter(None, args.model_name_or_path.split("/"))).pop(),
             str(args.max_seq_length),
         ),
@@ -577,11 +1206,19 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
             examples = SquadV1Processor().get_examples_from_dataset(tfds_examples, evaluate=evaluate)
         else:
             processor = SquadV2Processor() if args.version_2_with_negative else SquadV1Processor()
-            if evaluate:
-                filename = args.predict_file if val_or_test == "val" else "test_data/korquad_open_test.json"
-                examples = processor.get_eval_examples(args.data_dir, filename=filename)
-            else:
+            if not evaluate:
                 examples = processor.get_train_examples(args.data_dir, only_wiki=args.only_wiki, filename=args.train_file)
+            else:
+                if val_or_test == "open":
+                    # The dev questions with the paragraphs the submission reads, chosen without the answer
+                    paragraph_ranker = BM25Ranker(tokenizer) if rerank_paragraphs else None
+                    examples = processor.get_test_examples(
+                        args.data_dir, filename=args.predict_file, paragraph_ranker=paragraph_ranker,
+                        top_k=getattr(args, "rerank_top_k", 5),
+                    )
+                else:
+                    filename = args.predict_file if val_or_test == "val" else "test_data/korquad_open_test.json"
+                    examples = processor.get_eval_examples(args.data_dir, filename=filename)
 
         print("Starting squad_convert_examples_to_features")
         features, dataset = squad_convert_examples_to_features(
@@ -600,6 +1237,13 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
         #    logger.info("Saving features into cached file %s", cached_features_file)
         #    torch.save({"features": features, "dataset": dataset, "examples": examples}, cached_features_file)
 
+    if evaluate and (args.data_dir or args.predict_file) and args.local_rank in [-1, 0]:
+        # Prediction files are keyed by the integer qas_id, their texts are written here for the examples in use,
+        # also when they come from the cache
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "qas_metadata_{}.json".format(val_or_test)), "w") as writer:
+            writer.write(json.dumps(qas_metadata(examples), ensure_ascii=False) + "\n")
+
     if args.local_rank == 0 and not evaluate:
         # Make sure only the first process in distributed training process the dataset,
         # and the others will use the cache.
@@ -689,6 +1333,12 @@ def main():
         default=0.0,
         help="If null_score - best_non_null is greater than the threshold predict null.",
     )
+    parser.add_argument(
+        "--tune_null_threshold",
+        action="store_true",
+        help="With --version_2_with_negative: tune null_score_diff_threshold on the dev set at every evaluation. "
+             "Checkpoints are selected on the f1 at their own best threshold, which is saved with the best one.",
+    )
 
     parser.add_argument(
         "--max_seq_length",
@@ -716,6 +1366,37 @@ def main():
         "--evaluate_during_training", default=True,
         action="store_true", help="Run evaluation during training at each logging step."
     )
+    parser.add_argument(
+        "--async_eval",
+        action="store_true",
+        help="Evaluate weight snapshots in a background process instead of blocking training at each logging step.",
+    )
+    parser.add_argument(
+        "--async_eval_device",
+        default=None,
+        type=str,
+        help="Device for the background evaluator (e.g. cpu, cuda:1). Defaults to the training device.",
+    )
+    parser.add_argument(
+        "--async_eval_max_pending",
+        default=1,
+        type=int,
+        help="Maximum number of snapshots waiting for the background evaluator. Training waits for a free slot.",
+    )
+    parser.add_argument(
+        "--fast_eval_questions",
+        default=0,
+        type=int,
+        help="If > 0: evaluate on a fixed, stratified sample of this many dev questions at each logging step "
+             "(not used with --async_eval).",
+    )
+    parser.add_argument(
+        "--full_eval_every",
+        default=10,
+        type=int,
+        help="With --fast_eval_questions: also evaluate on the full dev set every X evaluations. "
+             "The full dev set is always evaluated at epoch end and to confirm a new best.",
+    )
     parser.add_argument(
         "--do_lower_case", action="store_true", help="Set this flag if you are using an uncased model."
     )
@@ -744,6 +1425,30 @@ def main():
         help="If > 0: set total number of training steps to perform. Override num_train_epochs.",
     )
     parser.add_argument("--warmup_steps", default=0, type=int, help="Linear warmup over warmup_steps.")
+    parser.add_argument(
+        "--exit_layers",
+        default=None,
+        type=int,
+        nargs="+",
+        help="With --model_type electra_early_exit: layers followed by a no answer exit. "
+             "A quarter, half and three quarters of the layers if not set.",
+    )
+    parser.add_argument(
+        "--exit_training",
+        default="joint",
+        choices=["joint", "frozen"],
+        help="With --model_type electra_early_exit: train the exits with the reader (joint), or only the exits "
+             "on a fine-tuned reader given as --model_name_or_path (frozen).",
+    )
+    parser.add_argument(
+        "--exit_loss_weight", default=1.0, type=float, help="Weight of the exits' loss added to the QA loss."
+    )
+    parser.add_argument(
+        "--exit_start_ratio",
+        default=0.0,
+        type=float,
+        help="With --exit_training joint: fraction of the optimization steps trained before the exits' loss is added.",
+    )
     parser.add_argument(
         "--n_best_size",
         default=20,
@@ -766,10 +1471,55 @@ def main():
 
     parser.add_argument("--logging_steps", type=int, default=100, help="Log every X updates steps.")
     parser.add_argument("--save_steps", type=int, default=1000, help="Save checkpoint every X updates steps.")
+    parser.add_argument(
+        "--background_save",
+        action="store_true",
+        help="Write checkpoints from a CPU copy in a background thread instead of stalling the training step.",
+    )
+    parser.add_argument(
+        "--save_queue_size",
+        type=int,
+        default=2,
+        help="With --background_save: maximum number of checkpoints waiting to be written before training blocks.",
+    )
     parser.add_argument(
         "--eval_all_checkpoints",
         action="store_true",
-        help="Evaluate all checkpoints starting with the same prefix as model_name ending and ending with step number",
+        help="Evaluate every checkpoint-* directory under output_dir, or the NSML checkpoints of "
+             "--eval_checkpoint_names (in --eval_session), and log one f1/exact table by global step.",
+    )
+    parser.add_argument(
+        "--eval_checkpoint_names",
+        default="",
+        type=str,
+        help="With --eval_all_checkpoints: comma separated NSML checkpoint names to evaluate instead of "
+             "the checkpoint-* directories under output_dir.",
+    )
+    parser.add_argument(
+        "--eval_session", default="", type=str, help="NSML session of --eval_checkpoint_names, if not this one."
+    )
+    parser.add_argument(
+        "--eval_workers",
+        default=1,
+        type=int,
+        help="With --eval_all_checkpoints: number of worker processes evaluating local checkpoints in parallel.",
+    )
+    parser.add_argument(
+        "--strip_particles",
+        action="store_true",
+        help="Remove a Korean particle from the end of the answers before comparing them in exact and f1.",
+    )
+    parser.add_argument(
+        "--scoring_workers", default=1, type=int, help="Number of processes scoring the predictions of an evaluation."
+    )
+    parser.add_argument(
+        "--resume_checkpoint",
+        default="",
+        type=str,
+        help="NSML checkpoint to resume training from (e.g. electra_gs4000_e1).",
+    )
+    parser.add_argument(
+        "--resume_session", default="", type=str, help="NSML session of --resume_checkpoint, if not this one."
     )
     parser.add_argument("--no_cuda", action="store_true", help="Whether not to use CUDA when available")
     parser.add_argument(
@@ -797,6 +1547,15 @@ def main():
     parser.add_argument("--server_port", type=str, default="", help="Can be used for distant debugging.")
 
     parser.add_argument("--threads", type=int, default=1, help="multiple threads for converting example to features")
+    parser.add_argument(
+        "--rerank_paragraphs",
+        action="store_true",
+        help="Score the open (question level) dev metrics on the BM25 top paragraphs of each question instead of "
+             "the first 5, like submit.py --rerank_paragraphs.",
+    )
+    parser.add_argument(
+        "--rerank_top_k", type=int, default=5, help="Paragraphs per question with --rerank_paragraphs."
+    )
 
     ### DO NOT MODIFY THIS BLOCK ###
     # arguments for nsml
@@ -871,6 +1630,8 @@ def main():
         args.config_name if args.config_name else args.model_name_or_path,
         cache_dir=args.cache_dir if args.cache_dir else None,
     )
+    if args.exit_layers:
+        config.exit_layers = args.exit_layers
     tokenizer = tokenizer_class.from_pretrained(
         args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
         do_lower_case=args.do_lower_case,
@@ -897,6 +1658,13 @@ def main():
             nsml.paused(scope=locals())
     ################################
 
+    if IS_ON_NSML and args.resume_checkpoint:
+        # Restores the weights here and leaves the training state for train()
+        if args.resume_session:
+            nsml.load(checkpoint=args.resume_checkpoint, session=args.resume_session)
+        else:
+            nsml.load(checkpoint=args.resume_checkpoint)
+
     logger.info("Training/evaluation parameters %s", args)
 
     # Before we do anything with models, we want to ensure that we get fp16 execution of torch.einsum if args.fp16 is
@@ -916,6 +1684,10 @@ def main():
         global_step, tr_loss = train(args, train_dataset, model, tokenizer)
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
+    # Evaluation
+    if args.eval_all_checkpoints and args.local_rank in [-1, 0]:
+        evaluate_all_checkpoints(args, model, tokenizer)
+
 
 if __name__ == "__main__":
     main()
@@ -19,7 +19,6 @@ import sys
 
 import numpy as np
 import torch
-import torch.nn as nn
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
@@ -45,8 +44,6 @@ from transformers import (
     XLNetForQuestionAnswering,
     XLNetTokenizer,
     get_linear_schedule_with_warmup,
-    ElectraModel,
-    ElectraPreTrainedModel,
     ElectraConfig,
     ElectraTokenizer,
 )
@@ -62,75 +59,7 @@ from open_squad_metrics import (
 )
 from open_squad_multihead import SquadResult, SquadV1Processor, SquadV2Processor
 
-##########################################3
-class ElectraForQuestionAnswering(ElectraPreTrainedModel):
-    def __init__(self, config):
-        super(ElectraForQuestionAnswering, self).__init__(config)
-        self.num_labels = config.num_labels
-
-        self.electra = ElectraModel(config)
-        self.qa_outputs_0 = nn.Linear(config.hidden_size, config.num_labels)
-        self.qa_outputs_1 = nn.Linear(config.hidden_size, config.num_labels)
-        self.qa_outputs_2 = nn.Linear(config.hidden_size, config.num_labels)
-        self.qa_outputs_3 = nn.Linear(config.hidden_size, config.num_labels)
-        self.qa_outputs_4 = nn.Linear(config.hidden_size, config.num_labels)
-
-        self.qa_outputs = [self.qa_outputs_0, self.qa_outputs_1, self.qa_outputs_2, self.qa_outputs_3, self.qa_outputs_4]
-
-        self.init_weights()
-
-    def forward(
-        self,
-        input_ids=None,
-        attention_mask=None,
-        token_type_ids=None,
-        position_ids=None,
-        head_mask=None,
-        inputs_embeds=None,
-        start_positions=None,
-        end_positions=None,
-        src=None,
-        flag=True
-    ):
-        outputs = self.electra(
-            input_ids, attention_mask, token_type_ids, position_ids, head_mask, inputs_embeds
-        )
-
-        sequence_output = outputs[0]
-
-        if flag:
-            logits = self.qa_outputs[0](sequence_output)
-        else:
-            logits = []
-            for i in range(src.size(0)):
-                logit = self.qa_outputs[src[i]](sequence_output[i].unsqueeze(0))
-                logits.append(logit)
-            #print(logits)
-            logits = torch.cat(logits, dim=0)
-
-        start_logits, end_logits = logits.split(1, dim=-1)
-        start_logits = start_logits.squeeze(-1)
-        end_logits = end_logits.squeeze(-1)
-
-        outputs = (start_logits, end_logits,) + outputs[1:]
-        if start_positions is not None and end_positions is not None:
-            # If we are on multi-GPU, split add a dimension
-            if len(start_positions.size()) > 1:
-                start_positions = start_positions.squeeze(-1)
-            if len(end_positions.size()) > 1:
-                end_positions = end_positions.squeeze(-1)
-            # sometimes the start/end positions are outside our model inputs, we ignore these terms
-            ignored_index = start_logits.size(1)
-            start_positions.clamp_(0, ignored_index)
-            end_positions.clamp_(0, ignored_index)
-
-            loss_fct = torch.nn.CrossEntropyLoss(ignore_index=ignored_index)
-            start_loss = loss_fct(start_logits, start_positions)
-            end_loss = loss_fct(end_logits, end_positions)
-            total_loss = (start_loss + end_loss) / 2
-            outputs = (total_loss,) + outputs
-
-        return outputs  # (loss), start_logits, end_logits, (hidden_states), (attentions)
+from modeling_electra import ElectraForMultiheadQuestionAnswering
 
 
 
@@ -151,7 +80,7 @@ MODEL_CLASSES = {
     "xlm": (XLMConfig, XLMForQuestionAnswering, XLMTokenizer),
     "distilbert": (DistilBertConfig, DistilBertForQuestionAnswering, DistilBertTokenizer),
     "albert": (AlbertConfig, AlbertForQuestionAnswering, AlbertTokenizer),
-    "electra": (ElectraConfig, ElectraForQuestionAnswering, ElectraTokenizer)
+    "electra": (ElectraConfig, ElectraForMultiheadQuestionAnswering, ElectraTokenizer)
 }
 
 
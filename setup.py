@@ -6,7 +6,7 @@ setup(
     name='kaist-korquad-test',
     version='1.0',
     install_requires=[
-        'boto3', 'regex', 'sacremoses', 'filelock', 'tokenizers',
+        'boto3', 'regex', 'sacremoses', 'filelock', 'tokenizers>=0.13.3',
         'tqdm', 'konlpy', 'sentencepiece', 'dataclasses', 'transformers'
     ]
 )
@@ -11,6 +11,8 @@ https://github.com/huggingface/transformers/blob/master/examples/question-answer
 """
 
 import argparse
+import collections
+import itertools
 import logging
 import os
 import random
@@ -19,7 +21,6 @@ import sys
 
 import numpy as np
 import torch
-import torch.nn as nn
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
@@ -45,8 +46,6 @@ from transformers import (
     XLNetForQuestionAnswering,
     XLNetTokenizer,
     get_linear_schedule_with_warmup,
-    ElectraModel,
-    ElectraPreTrainedModel,
     ElectraConfig,
     ElectraTokenizer,
 )
@@ -68,61 +67,12 @@ from open_squad_metrics import (
     squad_evaluate,
 )
 from open_squad import SquadResult, SquadV1Processor, SquadV2Processor
-
-##########################################3
-class ElectraForQuestionAnswering(ElectraPreTrainedModel):
-    def __init__(self, config):
-        super(ElectraForQuestionAnswering, self).__init__(config)
-        self.num_labels = config.num_labels
-
-        self.electra = ElectraModel(config)
-        self.qa_outputs = nn.Linear(config.hidden_size, config.num_labels)
-
-        self.init_weights()
-
-    def forward(
-        self,
-        input_ids=None,
-        attention_mask=None,
-        token_type_ids=None,
-        position_ids=None,
-        head_mask=None,
-        inputs_embeds=None,
-        start_positions=None,
-        end_positions=None,
-    ):
-        outputs = self.electra(
-            input_ids, attention_mask, token_type_ids, position_ids, head_mask, inputs_embeds
-        )
-
-        sequence_output = outputs[0]
-
-        logits = self.qa_outputs(sequence_output)
-        start_logits, end_logits = logits.split(1, dim=-1)
-        start_logits = start_logits.squeeze(-1)
-        end_logits = end_logits.squeeze(-1)
-
-        outputs = (start_logits, end_logits,) + outputs[2:]
-        if start_positions is not None and end_positions is not None:
-            # If we are on multi-GPU, split add a dimension
-            if len(start_positions.size()) > 1:
-                start_positions = start_positions.squeeze(-1)
-            if len(end_positions.size()) > 1:
-                end_positions = end_positions.squeeze(-1)
-            # sometimes the start/end positions are outside our model inputs, we ignore these terms
-            ignored_index = start_logits.size(1)
-            start_positions.clamp_(0, ignored_index)
-            end_positions.clamp_(0, ignored_index)
-
-            loss_fct = torch.nn.CrossEntropyLoss(ignore_index=ignored_index)
-            start_loss = loss_fct(start_logits, start_positions)
-            end_loss = loss_fct(end_logits, end_positions)
-            total_loss = (start_loss + end_loss) / 2
-            outputs = (total_loss,) + outputs
-
-        return outputs  # (loss), start_logits, end_logits, (hidden_states), (attentions)
-
-
+from modeling_electra import ElectraForEarlyExitQuestionAnswering, ElectraForQuestionAnswering
+from paragraph_ranker import BM25Ranker
+from qa_engine import CHECKPOINT_ARGS, QAEngine
+from qa_onnx import OnnxQuestionAnswering, load_or_export
+from qa_pipeline import PipelinedPredictor
+from qa_quantization import QUANTIZATION_MODES, quantize_model
 
 import nsml
 from nsml import DATASET_PATH, IS_ON_NSML
@@ -141,7 +91,8 @@ MODEL_CLASSES = {
     "xlm": (XLMConfig, XLMForQuestionAnswering, XLMTokenizer),
     "distilbert": (DistilBertConfig, DistilBertForQuestionAnswering, DistilBertTokenizer),
     "albert": (AlbertConfig, AlbertForQuestionAnswering, AlbertTokenizer),
-    "electra": (ElectraConfig, ElectraForQuestionAnswering, ElectraTokenizer)
+    "electra": (ElectraConfig, ElectraForQuestionAnswering, ElectraTokenizer),
+    "electra_early_exit": (ElectraConfig, ElectraForEarlyExitQuestionAnswering, ElectraTokenizer),
 }
 
 
@@ -178,12 +129,16 @@ def bind_nsml(model, tokenizer, my_args):
         logger.info("Save model & tokenizer & args at {}".format(dir_name))
 
     def load(dir_name, *args, **kwargs):
-        state = torch.load(os.path.join(dir_name, 'model.pt'))
-        model.load_state_dict(state)
-
         temp_my_args = torch.load(os.path.join(dir_name, "my_args.bin"))
         nsml.copy(temp_my_args, my_args)
 
+        # A quantized model.pt only loads into a model quantized the same way
+        quantization = getattr(temp_my_args, "quantization", None)
+        if quantization and getattr(model, "quantization", None) != quantization:
+            quantize_model(model, quantization)
+        state = torch.load(os.path.join(dir_name, 'model.pt'))
+        model.load_state_dict(state)
+
         temp_tokenizer = torch.load(os.path.join(dir_name, 'tokenizer'))
         nsml.copy(temp_tokenizer, tokenizer)
 
@@ -200,7 +155,75 @@ def bind_nsml(model, tokenizer, my_args):
 
 
 
+def predict_streaming(args, model, tokenizer):
+    """
+    Test predictions of `predict` streamed by question (QAEngine.stream_answers): the answer of a question is
+    decoded as soon as its paragraphs are scored, and only about one batch of features and logits is kept.
+    With --pipeline_predictions, the featurization, forward passes and decoding run concurrently (PipelinedPredictor).
+    """
+    examples = load_examples(args, tokenizer, evaluate=True, val_or_test="test")
+
+    args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+    if args.n_gpu > 1 and not isinstance(model, (torch.nn.DataParallel, OnnxQuestionAnswering)):
+        model = torch.nn.DataParallel(model)
+    engine = QAEngine(
+        model,
+        tokenizer,
+        device=args.device,
+        batch_size=args.eval_batch_size,
+        **{name: getattr(args, name) for name in CHECKPOINT_ARGS}
+    )
+
+    predictor = None
+    if getattr(args, "pipeline_predictions", False):
+        predictor = PipelinedPredictor(
+            engine, featurize_workers=args.threads, decode_workers=getattr(args, "decode_workers", 1)
+        )
+
+    logger.info("***** Running {} prediction *****".format("pipelined" if predictor else "streaming"))
+    logger.info("  Num examples = %d", len(examples))
+    logger.info("  Batch size = %d", args.eval_batch_size)
+
+    predictions = collections.OrderedDict()
+    start_time = timeit.default_timer()
+    for question_id, _, entry in (predictor or engine).stream_answers(examples):
+        if not predictions:
+            logger.info("  First answer after %f secs", timeit.default_timer() - start_time)
+        predictions[question_id] = entry["text"] if entry is not None else ""
+
+    evalTime = timeit.default_timer() - start_time
+    logger.info("  Prediction done in total %f secs (%f sec per question)", evalTime,
+                evalTime / max(len(predictions), 1))
+    if predictor is not None:
+        for name, summary in predictor.report().items():
+            logger.info("  %s: utilization %f, queue depth mean %f max %d", name, summary["utilization"],
+                        summary["mean_queue_depth"], summary["max_queue_depth"])
+    return examples, predictions
+
+
+def calibration_batches(args, tokenizer, num_batches):
+    """Input dicts of the first dev batches, to calibrate a static quantization."""
+    dataset, _, _ = load_and_cache_examples(args, tokenizer, evaluate=True, output_examples=True, val_or_test="val")
+    eval_dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=args.per_gpu_eval_batch_size)
+    return [
+        {"input_ids": batch[0], "attention_mask": batch[1], "token_type_ids": batch[2]}
+        for batch in itertools.islice(eval_dataloader, num_batches)
+    ]
+
+
 def predict(args, model, tokenizer, prefix="", val_or_test="val"):
+    if getattr(model, "quantization", None):
+        # Quantized models run on the CPU
+        args.device = torch.device("cpu")
+        args.n_gpu = 0
+
+    if getattr(args, "onnx_model", None):
+        model = load_or_export(model, args.onnx_model, threads=getattr(args, "onnx_threads", None))
+
+    streaming = getattr(args, "stream_predictions", False) or getattr(args, "pipeline_predictions", False)
+    if val_or_test == "test" and streaming and args.model_type not in ["xlnet", "xlm"]:
+        return predict_streaming(args, model, tokenizer)
+
     dataset, examples, features = load_and_cache_examples(
         args, tokenizer, evaluate=True, output_examples=True,
         val_or_test=val_or_test,
@@ -216,7 +239,7 @@ def predict(args, model, tokenizer, prefix="", val_or_test="val"):
     eval_dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
     # multi-gpu evaluate
-    if args.n_gpu > 1 and not isinstance(model, torch.nn.DataParallel):
+    if args.n_gpu > 1 and not isinstance(model, (torch.nn.DataParallel, OnnxQuestionAnswering)):
         model = torch.nn.DataParallel(model)
 
     # Eval!
@@ -332,6 +355,21 @@ def predict(args, model, tokenizer, prefix="", val_or_test="val"):
     return examples, predictions
 
 
+def load_examples(args, tokenizer, evaluate=False, val_or_test="val"):
+    processor = SquadV2Processor() if args.version_2_with_negative else SquadV1Processor()
+    if not evaluate:
+        return processor.get_train_examples(args.data_dir, filename=args.train_file)
+
+    filename = args.predict_file if val_or_test == "val" else "test_data/korquad_open_test.json"
+    paragraph_ranker = BM25Ranker(tokenizer) if getattr(args, "rerank_paragraphs", False) else None
+    return processor.get_test_examples(
+        args.data_dir,
+        filename=filename,
+        paragraph_ranker=paragraph_ranker,
+        top_k=getattr(args, "rerank_top_k", 5),
+    )
+
+
 def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=False, val_or_test="val"):
     if args.local_rank not in [-1, 0] and not evaluate:
         # Make sure only the first process in distributed training process the dataset,
@@ -373,12 +411,7 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
             tfds_examples = tfds.load("squad")
             examples = SquadV1Processor().get_examples_from_dataset(tfds_examples, evaluate=evaluate)
         else:
-            processor = SquadV2Processor() if args.version_2_with_negative else SquadV1Processor()
-            if evaluate:
-                filename = args.predict_file if val_or_test == "val" else "test_data/korquad_open_test.json"
-                examples = processor.get_test_examples(args.data_dir, filename=filename)
-            else:
-                examples = processor.get_train_examples(args.data_dir, filename=args.train_file)
+            examples = load_examples(args, tokenizer, evaluate=evaluate, val_or_test=val_or_test)
 
         print("Starting squad_convert_examples_to_features")
         features, dataset = squad_convert_examples_to_features(
@@ -590,6 +623,53 @@ def main():
     parser.add_argument("--server_port", type=str, default="", help="Can be used for distant debugging.")
 
     parser.add_argument("--threads", type=int, default=1, help="multiple threads for converting example to features")
+    parser.add_argument(
+        "--rerank_paragraphs",
+        action="store_true",
+        help="Read the BM25 top paragraphs of each question instead of the first 5, see paragraph_ranker.py",
+    )
+    parser.add_argument("--rerank_top_k", type=int, default=5, help="Paragraphs per question with --rerank_paragraphs")
+    parser.add_argument(
+        "--stream_predictions",
+        action="store_true",
+        help="Predict the test set question by question, keeping only about one batch of features in memory",
+    )
+    parser.add_argument(
+        "--pipeline_predictions",
+        action="store_true",
+        help="Stream the test predictions with concurrent featurization (--threads processes), model and decoding",
+    )
+    parser.add_argument("--decode_workers", type=int, default=1, help="Decoding processes with --pipeline_predictions")
+    parser.add_argument(
+        "--onnx_model",
+        type=str,
+        default=None,
+        help="Predict with ONNX Runtime from this file, exported from the loaded model if it does not exist",
+    )
+    parser.add_argument("--onnx_threads", type=int, default=None, help="ONNX Runtime intra-op threads")
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        default=None,
+        choices=QUANTIZATION_MODES,
+        help="Quantize the Linear layers to int8 for CPU inference before saving the loaded checkpoint",
+    )
+    parser.add_argument(
+        "--calibration_batches", type=int, default=32, help="Dev batches calibrating --quantization static"
+    )
+    parser.add_argument(
+        "--exit_layers",
+        type=int,
+        default=None,
+        nargs="+",
+        help="With --model_type electra_early_exit: the --exit_layers the checkpoint was trained with",
+    )
+    parser.add_argument(
+        "--exit_threshold",
+        type=float,
+        default=None,
+        help="With --model_type electra_early_exit: no answer probability at which a feature skips its other layers",
+    )
     parser.add_argument('--checkpoint', type=str, default='electra_best')
     parser.add_argument('--session', type=str, default='kaist_12/korquad-open-ldbd/184')
     ### DO NOT MODIFY THIS BLOCK ###
@@ -665,6 +745,9 @@ def main():
         args.config_name if args.config_name else args.model_name_or_path,
         cache_dir=args.cache_dir if args.cache_dir else None,
     )
+    if args.exit_layers:
+        config.exit_layers = args.exit_layers
+    config.exit_threshold = args.exit_threshold
     tokenizer = tokenizer_class.from_pretrained(
         args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
         do_lower_case=args.do_lower_case,
@@ -692,7 +775,13 @@ def main():
 
     logger.info("Training/evaluation parameters %s", args)
     print("load our best checkpoint...")
+    quantization, num_calibration_batches = args.quantization, args.calibration_batches
     nsml.load(checkpoint=args.checkpoint, session=args.session)
+    if quantization and not getattr(model, "quantization", None):
+        batches = calibration_batches(args, tokenizer, num_calibration_batches) if quantization == "static" else None
+        quantize_model(model, quantization, batches)
+        args.quantization = quantization
+        logger.info("Quantized the model (%s)", quantization)
     nsml.save('best')
     print("complete.")
 
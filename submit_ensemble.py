@@ -68,6 +68,7 @@ from open_squad_metrics import (
     squad_evaluate,
 )
 from open_squad import SquadResult, SquadV1Processor, SquadV2Processor
+from qa_onnx import load_or_export
 
 ##########################################3
 class ElectraForQuestionAnswering(ElectraPreTrainedModel):
@@ -231,6 +232,15 @@ def load_nsml(model_1, checkpoint, session, use_gpu, args):
     return model_1
 
 def predict(args, model, tokenizer, prefix="", val_or_test="val"):
+    use_onnx = bool(getattr(args, "onnx_dir", None))
+    if use_onnx:
+        os.makedirs(args.onnx_dir, exist_ok=True)
+        onnx_threads = getattr(args, "onnx_threads", None)
+        model = EnsembleModule(*[
+            load_or_export(member, os.path.join(args.onnx_dir, "model_{}.onnx".format(i + 1)), threads=onnx_threads)
+            for i, member in enumerate((model.model_1, model.model_2, model.model_3))
+        ])
+
     dataset, examples, features = load_and_cache_examples(
         args, tokenizer, evaluate=True, output_examples=True,
         val_or_test=val_or_test,
@@ -246,7 +256,7 @@ def predict(args, model, tokenizer, prefix="", val_or_test="val"):
     eval_dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
     # multi-gpu evaluate
-    if args.n_gpu > 1 and not isinstance(model, torch.nn.DataParallel):
+    if args.n_gpu > 1 and not use_onnx and not isinstance(model, torch.nn.DataParallel):
         model = torch.nn.DataParallel(model)
 
     # Eval!
@@ -600,6 +610,13 @@ def main():
     parser.add_argument("--server_port", type=str, default="", help="Can be used for distant debugging.")
 
     parser.add_argument("--threads", type=int, default=1, help="multiple threads for converting example to features")
+    parser.add_argument(
+        "--onnx_dir",
+        type=str,
+        default=None,
+        help="Predict with ONNX Runtime from model_{1,2,3}.onnx here, exported from the loaded models if missing",
+    )
+    parser.add_argument("--onnx_threads", type=int, default=None, help="ONNX Runtime intra-op threads")
 
     parser.add_argument('--checkpoint1', type=str, default="electra_gs8000_e1")
     parser.add_argument('--session1', type=str, default="kaist_12/korquad-open-ldbd/451")
@@ -22,9 +22,14 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import collections
+import hashlib
 import re
+import sqlite3
+import sys
+import threading
 import unicodedata
 import six
+from concurrent.futures import ProcessPoolExecutor
 from ctypes import *
 
 import logging
@@ -48,38 +53,199 @@ PRETRAINED_INIT_CONFIGURATION = {
 
 
 class MorAn16(object):
-    def __init__(self, moran_file='libmoran4dnlp.so'):
-        self.moran = CDLL(moran_file)
+    """MorAn morphological analyzer.
+
+    The input/output buffers grow for long paragraphs instead of truncating them. The C library is not known to be
+    reentrant, so the calls of one process are serialized by a lock and `run_batch` analyzes texts in parallel
+    worker processes, each with its own copy of the library.
+    """
+
+    # Initial output buffer size per input byte, the analysis is longer than the text
+    output_bytes_per_input_byte = 8
+
+    def __init__(self, moran_file='libmoran4dnlp.so', buffer_size=102400, num_threads=1):
+        self.moran_file = moran_file
+        self.buffer_size = buffer_size
+        self.num_threads = num_threads
+        self._open()
+
+    def _open(self):
+        self.moran = CDLL(self.moran_file)
         self.moran.Moran4dnlp.restype = c_char_p
         self.moran.Moran4dnlp.argtypes = [c_char_p, c_char_p, c_int]
 
         self.moran.Moran4match.restype = c_char_p
         self.moran.Moran4match.argtypes = [c_char_p, c_char_p, c_char_p, c_int]
 
-        self.moran_input = create_string_buffer(102400)
-        self.moran_input2 = create_string_buffer(102400)
-        self.moran_output = create_string_buffer(102400)
+        self.buffers = threading.local()
+        self.lock = threading.Lock()
+        self.executor, self.executor_workers = None, 0
         self.moran.MorAn16_open_dbs()
 
+    def __getstate__(self):
+        # The library handle, the buffers and the worker processes are re-created on unpickling
+        return {"moran_file": self.moran_file, "buffer_size": self.buffer_size, "num_threads": self.num_threads}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
     def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor, self.executor_workers = None, 0
         self.moran.MorAn_close_dbs()
 
+    def _buffer(self, name, size):
+        """Returns this thread's buffer `name`, grown to hold at least `size` bytes."""
+        buffer = getattr(self.buffers, name, None)
+        if buffer is None or len(buffer) < size:
+            buffer = create_string_buffer(max(size, self.buffer_size))
+            setattr(self.buffers, name, buffer)
+        return buffer
+
+    def _call(self, function, *texts):
+        inputs = []
+        for i, text in enumerate(texts):
+            data = text.encode()
+            buffer = self._buffer("input{}".format(i), len(data) + 1)
+            buffer.value = data
+            inputs.append(buffer)
+
+        output_size = self.output_bytes_per_input_byte * sum(len(buffer.value) for buffer in inputs)
+        while True:
+            output = self._buffer("output", output_size)
+            with self.lock:
+                result = function(*inputs, output, len(output))
+            if result is None:
+                return ""
+            # A result filling the whole buffer may have been cut off, retry with a larger one
+            if len(result) < len(output) - 1:
+                return result.decode()
+            output_size = 2 * len(output)
+
     def run(self, text):
-        result = list()
-        self.moran_input.value = text.encode()
-        x = self.moran.Moran4dnlp(self.moran_input, self.moran_output, 102400)
-        y = x.decode()
-        result = y.split()
-        return result
+        return self._call(self.moran.Moran4dnlp, text).split()
+
+    def run_batch(self, texts, num_threads=None):
+        """
+        Analyzes a list of texts, in `num_threads` worker processes (default: the number given at construction).
+        The worker processes are kept for the next batches until `close`.
+        """
+        num_threads = num_threads or self.num_threads
+        if num_threads <= 1 or len(texts) <= 1:
+            return [self.run(text) for text in texts]
+        if self.executor_workers != num_threads:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.executor, self.executor_workers = ProcessPoolExecutor(max_workers=num_threads), num_threads
+        # A few chunks per worker balance the long and short texts without pickling every text on its own
+        chunk_size = max(1, -(-len(texts) // (4 * num_threads)))
+        chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+        state = self.__getstate__()
+        analyses = []
+        for chunk_analyses in self.executor.map(_run_moran_worker, [state] * len(chunks), chunks):
+            analyses.extend(chunk_analyses)
+        return analyses
 
     def match(self, text, tokens):
-        result = list()
-        self.moran_input.value = text.encode()
-        self.moran_input2.value = tokens.encode()
-        x = self.moran.Moran4match(self.moran_input, self.moran_input2, self.moran_output, 102400)
-        y = x.decode()
-        result = y.split()
-        return result
+        return self._call(self.moran.Moran4match, text, tokens).split()
+
+
+# MorAn16 of each library file in a worker process of `MorAn16.run_batch`
+_worker_morans = {}
+
+
+def _run_moran_worker(state, texts):
+    moran = _worker_morans.get(state["moran_file"])
+    if moran is None:
+        moran = MorAn16(**state)
+        _worker_morans[state["moran_file"]] = moran
+    return [moran.run(text) for text in texts]
+
+
+class MorAnCache(object):
+    """On-disk cache of MorAn analyses, an SQLite table keyed by the SHA-1 of the normalized text.
+
+    Every thread and process opens its own connection, so the cache can be shared by featurization workers and
+    several runs. Once more than `max_entries` analyses are stored, the oldest ones are deleted.
+    """
+
+    # Number of stored analyses after which the entry count is checked against max_entries
+    trim_every = 10000
+
+    def __init__(self, cache_file, max_entries=1000000):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.connections = threading.local()
+        self.num_puts = 0
+        self._connection()
+
+    def __getstate__(self):
+        return {"cache_file": self.cache_file, "max_entries": self.max_entries}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connection(self):
+        # A connection inherited from a forked parent must not be used, open a new one in the child
+        pid, connection = getattr(self.connections, "connection", (None, None))
+        if pid != os.getpid():
+            connection = sqlite3.connect(self.cache_file, timeout=60)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS moran (key BLOB PRIMARY KEY, tokens TEXT NOT NULL)")
+            connection.commit()
+            self.connections.connection = (os.getpid(), connection)
+        return connection
+
+    @staticmethod
+    def _key(text):
+        return hashlib.sha1(text.encode("utf-8")).digest()
+
+    def get_many(self, texts):
+        """Returns the cached analysis of each text, None for the ones not in the cache."""
+        keys = [self._key(text) for text in texts]
+        connection = self._connection()
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            query = "SELECT key, tokens FROM moran WHERE key IN ({})".format(",".join("?" * len(chunk)))
+            found.update(connection.execute(query, chunk))
+        return [found[key].split() if key in found else None for key in keys]
+
+    def get(self, text):
+        return self.get_many([text])[0]
+
+    def put_many(self, texts, analyses):
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO moran (key, tokens) VALUES (?, ?)",
+                [(self._key(text), " ".join(tokens)) for text, tokens in zip(texts, analyses)],
+            )
+        self.num_puts += len(texts)
+        if self.num_puts >= self.trim_every:
+            self.num_puts = 0
+            self.trim()
+
+    def put(self, text, tokens):
+        self.put_many([text], [tokens])
+
+    def trim(self):
+        """Deletes the oldest analyses beyond max_entries."""
+        connection = self._connection()
+        with connection:
+            (num_entries,) = connection.execute("SELECT COUNT(*) FROM moran").fetchone()
+            if num_entries > self.max_entries:
+                connection.execute(
+                    "DELETE FROM moran WHERE rowid IN (SELECT rowid FROM moran ORDER BY rowid LIMIT ?)",
+                    (num_entries - self.max_entries,),
+                )
+
+    def __len__(self):
+        (num_entries,) = self._connection().execute("SELECT COUNT(*) FROM moran").fetchone()
+        return num_entries
 
 
 def convert_to_unicode(text):
@@ -129,10 +295,12 @@ def whitespace_tokenize(text):
 class BasicTokenizer(object):
     """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
 
-    def __init__(self, use_moran=False, use_zwj=True, moran_file='libmoran4dnlp.so'):
+    def __init__(self, use_moran=False, use_zwj=True, moran_file='libmoran4dnlp.so', moran_threads=1,
+                 moran_cache=None):
         self.moran = None
+        self.moran_cache = moran_cache
         try:
-            self.moran = MorAn16(moran_file)
+            self.moran = MorAn16(moran_file, num_threads=moran_threads)
         except:
             logger.warning("Only ubuntu is supported for HanBertTokenizer!")
 
@@ -141,33 +309,55 @@ class BasicTokenizer(object):
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
+        if self.use_moran:
+            output_tokens = self.analyze([self.normalize(text)])[0]
+            return output_tokens
+
+        # Every step of tokenize_word keeps whitespace in place, so the whole text goes through it at once
+        return self.tokenize_word(self.normalize(text))
+
+    def tokenize_batch(self, texts):
+        """Tokenizes a list of texts. With MorAn, the texts are analyzed in parallel worker processes."""
+        if self.use_moran:
+            return self.analyze([self.normalize(text) for text in texts])
+        return [self.tokenize(text) for text in texts]
+
+    def analyze(self, texts):
+        """MorAn analyses of normalized texts, the ones found in `moran_cache` are not analyzed again."""
+        if self.moran_cache is None:
+            return self.moran.run_batch(texts)
+
+        analyses = self.moran_cache.get_many(texts)
+        missing = [i for i, tokens in enumerate(analyses) if tokens is None]
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            missing_analyses = self.moran.run_batch(missing_texts)
+            self.moran_cache.put_many(missing_texts, missing_analyses)
+            for i, tokens in zip(missing, missing_analyses):
+                analyses[i] = tokens
+        return analyses
+
+    def normalize(self, text):
+        """Cleans a piece of text and puts whitespace around CJK characters."""
         text = convert_to_unicode(text)
         text = self._clean_text(text)
         text = self._tokenize_chinese_chars(text)
+        return text
 
-        if self.use_moran:
-            output_tokens = self.moran.run(text)
-            return output_tokens
-        else:
-            orig_tokens = whitespace_tokenize(text)
-
-        split_tokens = []
-        for token in orig_tokens:
-            token = token.lower()
-            token = self._run_strip_accents(token)
-            split_tokens.extend(self._run_split_on_punc(token))
+    def split_words(self, text):
+        """Splits a piece of text into the whitespace separated words that `tokenize_word` handles one by one."""
+        return whitespace_tokenize(self.normalize(text))
 
-        output_tokens = whitespace_tokenize(" ".join(split_tokens))
-        return output_tokens
+    def tokenize_word(self, token):
+        """Tokenizes one word of `split_words` when MorAn is not used."""
+        token = token.lower()
+        token = self._run_strip_accents(token)
+        return whitespace_tokenize(" ".join(self._run_split_on_punc(token)))
 
     def match(self, text, pattern):
         """Tokenizes a piece of text."""
-        text = convert_to_unicode(text)
-        text = self._clean_text(text)
-        text = self._tokenize_chinese_chars(text)
-        pattern = convert_to_unicode(pattern)
-        pattern = self._clean_text(pattern)
-        pattern = self._tokenize_chinese_chars(pattern)
+        text = self.normalize(text)
+        pattern = self.normalize(pattern)
         positions = self.moran.match(text, pattern)
         start = int(positions[0])
         end = int(positions[1])
@@ -181,46 +371,16 @@ class BasicTokenizer(object):
         # same but different text, which causes a bug.
 
         text = unicodedata.normalize("NFD", text)
-        output = []
-        for char in text:
-            cat = unicodedata.category(char)
-            if cat == "Mn":
-                continue
-            output.append(char)
-        return "".join(output)
+        return _char_patterns()["accent"].sub("", text)
 
     def _run_split_on_punc(self, text):
         """Splits punctuation on a piece of text."""
-        chars = list(text)
-        i = 0
-        start_new_word = True
-        output = []
-        while i < len(chars):
-            char = chars[i]
-            if _is_punctuation(char, self.use_zwj):
-                output.append([char])
-                start_new_word = True
-            else:
-                if start_new_word:
-                    output.append([])
-                start_new_word = False
-                output[-1].append(char)
-            i += 1
-
-        return ["".join(x) for x in output]
+        pattern = _char_patterns()["punctuation_zwj" if self.use_zwj else "punctuation"]
+        return [piece for piece in pattern.split(text) if piece]
 
     def _tokenize_chinese_chars(self, text):
         """Adds whitespace around any CJK character."""
-        output = []
-        for char in text:
-            cp = ord(char)
-            if self._is_chinese_char(cp):
-                output.append(" ")
-                output.append(char)
-                output.append(" ")
-            else:
-                output.append(char)
-        return "".join(output)
+        return _char_patterns()["chinese"].sub(r" \g<0> ", text)
 
     def _is_chinese_char(self, cp):
         """Checks whether CP is the codepoint of a CJK character."""
@@ -232,30 +392,36 @@ class BasicTokenizer(object):
         # as is Japanese Hiragana and Katakana. Those alphabets are used to write
         # space-separated words, so they are not treated specially and handled
         # like the all of the other languages.
-        if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-            (cp >= 0x3400 and cp <= 0x4DBF) or  #
-            (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-            (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-            (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-            (cp >= 0x2B820 and cp <= 0x2CEAF) or
-            (cp >= 0xF900 and cp <= 0xFAFF) or  #
-                (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-            return True
-
-        return False
+        return any(start <= cp <= end for start, end in _CHINESE_CHAR_RANGES)
 
     def _clean_text(self, text):
         """Performs invalid character removal and whitespace cleanup on text."""
-        output = []
-        for char in text:
-            cp = ord(char)
-            if cp == 0 or cp == 0xfffd or _is_control(char):
+        patterns = _char_patterns()
+        text = patterns["invalid"].sub("", text)
+        return patterns["whitespace"].sub(" ", text)
+
+
+# Key of a trie node holding the vocabulary token that ends at this node (characters are never empty)
+_TRIE_TOKEN = ""
+
+
+def build_wordpiece_tries(vocab):
+    """Builds the prefix tries used by WordpieceTokenizer.
+
+    The first trie holds every token as is and is used at the start of a word. The second holds the "##"
+    continuation pieces without their prefix and is used inside a word. Each node maps a character to its child,
+    and `_TRIE_TOKEN` to the full vocabulary token if one ends there.
+    """
+    word_root, continuation_root = {}, {}
+    for token in vocab:
+        for root, chars in ((word_root, token), (continuation_root, token[2:] if token.startswith("##") else "")):
+            if not chars:
                 continue
-            if _is_whitespace(char):
-                output.append(" ")
-            else:
-                output.append(char)
-        return "".join(output)
+            node = root
+            for char in chars:
+                node = node.setdefault(char, {})
+            node[_TRIE_TOKEN] = token
+    return word_root, continuation_root
 
 
 class WordpieceTokenizer(object):
@@ -265,6 +431,7 @@ class WordpieceTokenizer(object):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        self.word_trie, self.continuation_trie = build_wordpiece_tries(vocab)
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
@@ -283,25 +450,24 @@ class WordpieceTokenizer(object):
         text = convert_to_unicode(text)
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
+            if len(token) > self.max_input_chars_per_word:
                 output_tokens.append(self.unk_token)
                 continue
 
+            # The longest match from `start` is the deepest node holding a token on the trie path along the word
             is_bad = False
             start = 0
             sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
+            while start < len(token):
+                node = self.word_trie if start == 0 else self.continuation_trie
                 cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
+                for i in range(start, len(token)):
+                    node = node.get(token[i])
+                    if node is None:
                         break
-                    end -= 1
+                    if _TRIE_TOKEN in node:
+                        cur_substr = node[_TRIE_TOKEN]
+                        end = i + 1
                 if cur_substr is None:
                     is_bad = True
                     break
@@ -315,6 +481,136 @@ class WordpieceTokenizer(object):
         return output_tokens
 
 
+class WordCache(object):
+    """Bounded LRU cache from a word to its sub-tokens, with hit/miss counters.
+
+    It holds no lock, so it can be pickled and used in forked worker processes (each one then has its own copy).
+    Races between threads only cost a cache miss.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, word):
+        try:
+            sub_tokens = self.cache[word]
+            self.cache.move_to_end(word)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return sub_tokens
+
+    def put(self, word, sub_tokens):
+        if self.max_size <= 0:
+            return
+        self.cache[word] = tuple(sub_tokens)
+        try:
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        except KeyError:
+            pass
+
+    def clear(self):
+        self.cache.clear()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def info(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.cache),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+# Codepoint ranges of the CJK Unified Ideographs blocks, see `BasicTokenizer._is_chinese_char`
+_CHINESE_CHAR_RANGES = (
+    (0x4E00, 0x9FFF),
+    (0x3400, 0x4DBF),
+    (0x20000, 0x2A6DF),
+    (0x2A700, 0x2B73F),
+    (0x2B740, 0x2B81F),
+    (0x2B820, 0x2CEAF),
+    (0xF900, 0xFAFF),
+    (0x2F800, 0x2FA1F),
+)
+
+# Character class regexes of BasicTokenizer, built on first use by `_char_patterns`
+_CHAR_PATTERNS = None
+
+
+def _char_class(codepoints):
+    """Regex matching one of the given ascending codepoints.
+
+    re checks a class of Basic Multilingual Plane characters with a bitmap, but scans the ranges one by one as soon as
+    the class has a supplementary plane character. Those rare characters get a second class, only tried after a cheap
+    check that the character is outside the BMP.
+    """
+    def ranges_class(codepoints):
+        ranges = []
+        for cp in codepoints:
+            if ranges and ranges[-1][1] == cp - 1:
+                ranges[-1][1] = cp
+            else:
+                ranges.append([cp, cp])
+        return "[{}]".format("".join(
+            "\\U{:08x}".format(start) if start == end else "\\U{:08x}-\\U{:08x}".format(start, end)
+            for start, end in ranges))
+
+    bmp = [cp for cp in codepoints if cp <= 0xFFFF]
+    supplementary = [cp for cp in codepoints if cp > 0xFFFF]
+    if not bmp or not supplementary:
+        return ranges_class(codepoints)
+    return "(?:{}|(?=[\\U00010000-\\U0010ffff]){})".format(ranges_class(bmp), ranges_class(supplementary))
+
+
+def _char_patterns():
+    """Compiled regexes for the per-character checks of BasicTokenizer.
+
+    One pass over all codepoints sorts them into the classes of `_is_control`, `_is_whitespace`,
+    `_is_punctuation` and `_is_chinese_char`, so the text is then cleaned by a few regex substitutions instead of
+    a Python loop per character. The pass takes a fraction of a second and is done once per process.
+    """
+    global _CHAR_PATTERNS
+    if _CHAR_PATTERNS is None:
+        classes = collections.defaultdict(list)
+        for start, end in _CHINESE_CHAR_RANGES:
+            classes["chinese"].extend(range(start, end + 1))
+        for cp in range(sys.maxunicode + 1):
+            char = chr(cp)
+            cat = unicodedata.category(char)
+            if cp == 0 or cp == 0xfffd or (cat.startswith("C") and char not in "\t\n\r"):
+                classes["invalid"].append(cp)
+            elif char in " \t\n\r" or cat == "Zs":
+                classes["whitespace"].append(cp)
+            if cat == "Mn":
+                classes["accent"].append(cp)
+            if (33 <= cp <= 47 or 58 <= cp <= 64 or 91 <= cp <= 96 or 123 <= cp <= 126) or cat.startswith("P"):
+                classes["punctuation"].append(cp)
+                if char != "~":
+                    classes["punctuation_zwj"].append(cp)
+
+        _CHAR_PATTERNS = {
+            "invalid": re.compile(_char_class(classes["invalid"]) + "+"),
+            "whitespace": re.compile(_char_class(classes["whitespace"])),
+            "accent": re.compile(_char_class(classes["accent"]) + "+"),
+            # Punctuation characters are captured so that re.split keeps them as separate pieces
+            "punctuation": re.compile("({})".format(_char_class(classes["punctuation"]))),
+            "punctuation_zwj": re.compile("({})".format(_char_class(classes["punctuation_zwj"]))),
+            "chinese": re.compile(_char_class(sorted(classes["chinese"]))),
+        }
+    return _CHAR_PATTERNS
+
+
 def _is_whitespace(char):
     """Checks whether `chars` is a whitespace character."""
     # \t, \n, and \r are technically contorl characters but we treat them
@@ -376,7 +672,8 @@ class HanBertTokenizer(PreTrainedTokenizer):
 
     def __init__(self, vocab_file, moran_file, do_lower_case=False, never_split=None, do_basic_tokenize=True, use_moran=True,
                  unk_token="[UNK]", sep_token="[SEP]", pad_token="[PAD]", cls_token="[CLS]",
-                 mask_token="[MASK]", **kwargs):
+                 mask_token="[MASK]", word_cache_size=100000, moran_threads=1, moran_cache_file=None,
+                 moran_cache_size=1000000, **kwargs):
         """Constructs a BertTokenizer.
         Args:
             **vocab_file**: Path to a one-wordpiece-per-line vocabulary file
@@ -392,6 +689,15 @@ class HanBertTokenizer(PreTrainedTokenizer):
                 Whether to tokenize Chinese characters.
                 This should likely be deactivated for Japanese:
                 see: https://github.com/huggingface/pytorch-pretrained-BERT/issues/328
+            **word_cache_size**: (`optional`) int (default 100000)
+                Number of words whose sub-tokens are cached, 0 disables the cache.
+                Without MorAn a word is a whitespace separated word, with MorAn a morpheme.
+            **moran_threads**: (`optional`) int (default 1)
+                Number of worker processes MorAn analyzes the texts of `batch_tokenize` and `warm_word_cache` with.
+            **moran_cache_file**: (`optional`) string (default None)
+                SQLite file caching the MorAn analyses across runs (see `MorAnCache` and warm_moran_cache.py).
+            **moran_cache_size**: (`optional`) int (default 1000000)
+                Maximum number of analyses kept in `moran_cache_file`.
         """
         super(HanBertTokenizer, self).__init__(unk_token=unk_token, sep_token=sep_token,
                                                pad_token=pad_token, cls_token=cls_token,
@@ -410,20 +716,54 @@ class HanBertTokenizer(PreTrainedTokenizer):
         self.do_basic_tokenize = do_basic_tokenize
         self.do_lower_case = do_lower_case
         if do_basic_tokenize:
-            self.basic_tokenizer = BasicTokenizer(use_moran=use_moran, moran_file=moran_file)
+            moran_cache = None
+            if use_moran and moran_cache_file:
+                moran_cache = MorAnCache(moran_cache_file, max_entries=moran_cache_size)
+            self.basic_tokenizer = BasicTokenizer(use_moran=use_moran, moran_file=moran_file,
+                                                  moran_threads=moran_threads, moran_cache=moran_cache)
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab, unk_token=self.unk_token)
+        self.word_cache = WordCache(max_size=word_cache_size)
 
     @property
     def vocab_size(self):
         return len(self.vocab)
 
     def _tokenize(self, text):
+        if self.basic_tokenizer.use_moran:
+            # MorAn analyzes the whole text at once, only the wordpieces of each morpheme can be cached
+            return self._tokenize_words(self.basic_tokenizer.tokenize(text), self.wordpiece_tokenizer.tokenize)
+        return self._tokenize_words(self.basic_tokenizer.split_words(text), self._tokenize_word)
+
+    def batch_tokenize(self, texts):
+        """Same as `_tokenize` on each text, with MorAn the texts are analyzed in `moran_threads` processes."""
+        if not self.basic_tokenizer.use_moran:
+            return [self._tokenize(text) for text in texts]
+        return [
+            self._tokenize_words(words, self.wordpiece_tokenizer.tokenize)
+            for words in self.basic_tokenizer.tokenize_batch(texts)
+        ]
+
+    def _tokenize_words(self, words, tokenize_word):
         split_tokens = []
-        for token in self.basic_tokenizer.tokenize(text):
-            for sub_token in self.wordpiece_tokenizer.tokenize(token):
-                split_tokens.append(sub_token)
+        for word in words:
+            sub_tokens = self.word_cache.get(word)
+            if sub_tokens is None:
+                sub_tokens = tokenize_word(word)
+                self.word_cache.put(word, sub_tokens)
+            split_tokens.extend(sub_tokens)
         return split_tokens
 
+    def _tokenize_word(self, word):
+        split_tokens = []
+        for token in self.basic_tokenizer.tokenize_word(word):
+            split_tokens.extend(self.wordpiece_tokenizer.tokenize(token))
+        return split_tokens
+
+    def warm_word_cache(self, texts):
+        """Tokenizes `texts` to fill the word cache, e.g. before the tokenizer is shipped to worker processes."""
+        self.batch_tokenize(texts)
+        return self.word_cache.info()
+
     def _convert_token_to_id(self, token):
         """ Converts a token (str/unicode) in an id using the vocab. """
         return self.vocab.get(token, self.vocab.get(self.unk_token))
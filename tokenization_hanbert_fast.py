@@ -0,0 +1,167 @@
+"""
+HanBert fast 토크나이저 변환
+
+vocab_54k.txt 로 HanBertTokenizer (MorAn 미사용) 와 같은 토큰을 내는 Rust 기반 tokenizers.Tokenizer 를 만듦
+offset mapping 과 batch encoding 을 지원하여 빠른 featurization 에 사용할 수 있음
+변환 후 vocab 의 토큰을 무작위로 이어 붙인 시퀀스로 두 토크나이저의 디코딩 결과가 같은지 확인하고,
+--text_file 을 주면 같은 텍스트를 두 토크나이저로 토크나이즈하여 토큰, id, 디코딩 결과가 같은지 확인함
+
+"""
+
+import argparse
+import logging
+import random
+import sys
+
+try:
+    from tokenizers import Regex, Tokenizer, decoders, models, normalizers, pre_tokenizers, processors
+except ImportError:
+    Regex = None
+# The Replace, Fuse and Strip decoders are only in tokenizers>=0.13.3, pre_tokenizers.Split in >=0.10.0
+if Regex is None or not all(hasattr(decoders, name) for name in ("Sequence", "Replace", "Fuse", "Strip")):
+    raise ImportError("Please install tokenizers>=0.13.3 to build the fast HanBert tokenizer.")
+
+from tokenization_hanbert import HanBertTokenizer, load_vocab
+
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler(sys.stdout)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+
+# ASCII non-letter/number characters and the Unicode punctuation categories, as in `_is_punctuation`.
+# With use_zwj, "~" (0x7E) marks a joined morpheme and is not split off.
+PUNCTUATION_PATTERN = r"[!-/:-@\[-`{-~\p{P}]"
+PUNCTUATION_PATTERN_ZWJ = r"[!-/:-@\[-`{-}\p{P}]"
+
+
+def convert_hanbert_tokenizer(vocab_file, use_zwj=True, unk_token="[UNK]", max_input_chars_per_word=200):
+    """
+    Builds a tokenizers.Tokenizer equivalent to HanBertTokenizer with use_moran=False.
+
+    - normalizer: BasicTokenizer.normalize (control character removal, whitespace cleanup, spaces around CJK
+      characters) followed by the lower casing and accent stripping of BasicTokenizer.tokenize_word
+    - pre-tokenizer: whitespace split, then every punctuation character as its own word (`_run_split_on_punc`)
+    - model: WordPiece with "##" continuation pieces
+    - decoder: convert_tokens_to_string, the tokens are joined by spaces and then " ##", " ~~" and " ~" removed,
+      so a first token starting with "##" or "~" keeps its prefix
+
+    The character classes come from the Unicode tables of the Rust crate instead of Python's unicodedata, so very
+    rare characters may still be handled differently, `check_parity` counts those on a corpus.
+    """
+    vocab = load_vocab(vocab_file)
+    tokenizer = Tokenizer(
+        models.WordPiece(dict(vocab), unk_token=unk_token, max_input_chars_per_word=max_input_chars_per_word)
+    )
+    tokenizer.normalizer = normalizers.BertNormalizer(
+        clean_text=True, handle_chinese_chars=True, strip_accents=True, lowercase=True
+    )
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence(
+        [
+            pre_tokenizers.WhitespaceSplit(),
+            pre_tokenizers.Split(Regex(PUNCTUATION_PATTERN_ZWJ if use_zwj else PUNCTUATION_PATTERN), "isolated"),
+        ]
+    )
+    tokenizer.post_processor = processors.BertProcessing(
+        ("[SEP]", vocab["[SEP]"]), ("[CLS]", vocab["[CLS]"])
+    )
+    tokenizer.decoder = decoders.Sequence(
+        [
+            decoders.Replace(Regex("^"), " "),
+            decoders.Fuse(),
+            decoders.Strip(" ", 1, 0),
+            decoders.Replace(" ##", ""),
+            decoders.Replace(" ~~", ""),
+            decoders.Replace(" ~", ""),
+        ]
+    )
+    tokenizer.add_special_tokens([token for token in SPECIAL_TOKENS if token in vocab])
+    return tokenizer
+
+
+def check_offsets(text, encoding):
+    """Offsets must point inside the text, in order, and never be empty for a real token."""
+    previous_end = 0
+    for token, (start, end) in zip(encoding.tokens, encoding.offsets):
+        if not (previous_end <= start < end <= len(text)):
+            return False
+        previous_end = end if not token.startswith("##") else previous_end
+    return True
+
+
+def check_parity(slow_tokenizer, fast_tokenizer, texts):
+    """Compares tokens, ids, decoded strings and offsets of both tokenizers, returns the largest mismatch count."""
+    encodings = fast_tokenizer.encode_batch(texts, add_special_tokens=False)
+    mismatches = {"tokens": 0, "ids": 0, "decode": 0, "offsets": 0}
+    for text, encoding in zip(texts, encodings):
+        tokens = slow_tokenizer.tokenize(text)
+        if tokens != encoding.tokens:
+            mismatches["tokens"] += 1
+            if mismatches["tokens"] <= 10:
+                logger.info("Token mismatch for %r:\n  slow %s\n  fast %s", text[:200], tokens[:50], encoding.tokens[:50])
+        if slow_tokenizer.convert_tokens_to_ids(tokens) != encoding.ids:
+            mismatches["ids"] += 1
+        if slow_tokenizer.convert_tokens_to_string(tokens) != fast_tokenizer.decode(
+            slow_tokenizer.convert_tokens_to_ids(tokens), skip_special_tokens=False
+        ):
+            mismatches["decode"] += 1
+        if not check_offsets(text, encoding):
+            mismatches["offsets"] += 1
+
+    logger.info("%d texts, mismatches: %s", len(texts), mismatches)
+    return max(mismatches.values())
+
+
+def check_decode_parity(slow_tokenizer, fast_tokenizer, num_sequences=10000, max_tokens=8, seed=42):
+    """
+    Compares convert_tokens_to_string with the fast decoder on random vocab token sequences, which also start with
+    "##", "~~" and "~" pieces. Returns the number of mismatches.
+    """
+    rng = random.Random(seed)
+    tokens = [token for token in slow_tokenizer.vocab if token not in SPECIAL_TOKENS]
+    pieces = [token for token in tokens if token.startswith(("##", "~"))]
+    mismatches = 0
+    for i in range(num_sequences):
+        sequence = [rng.choice(tokens) for _ in range(rng.randint(1, max_tokens))]
+        if pieces and i % 2:
+            sequence[0] = rng.choice(pieces)
+        slow_text = slow_tokenizer.convert_tokens_to_string(sequence)
+        fast_text = fast_tokenizer.decode(slow_tokenizer.convert_tokens_to_ids(sequence), skip_special_tokens=False)
+        if slow_text != fast_text:
+            mismatches += 1
+            if mismatches <= 10:
+                logger.info("Decode mismatch for %s:\n  slow %r\n  fast %r", sequence, slow_text, fast_text)
+
+    logger.info("%d token sequences, decode mismatches: %d", num_sequences, mismatches)
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_file", default="vocab_54k.txt", type=str, help="HanBert vocabulary file.")
+    parser.add_argument("--output_file", default="hanbert_tokenizer.json", type=str, help="Fast tokenizer to write.")
+    parser.add_argument("--no_zwj", action="store_true", help="Split '~' off like other punctuation.")
+    parser.add_argument(
+        "--text_file", default=None, type=str, help="KorQuAD open json or text file to check the parity on."
+    )
+    parser.add_argument("--max_texts", default=None, type=int, help="Only check the first X texts.")
+    args = parser.parse_args()
+
+    fast_tokenizer = convert_hanbert_tokenizer(args.vocab_file, use_zwj=not args.no_zwj)
+    fast_tokenizer.save(args.output_file)
+    logger.info("Saved fast tokenizer to %s", args.output_file)
+
+    slow_tokenizer = HanBertTokenizer(args.vocab_file, "libmoran4dnlp.so", use_moran=False)
+    slow_tokenizer.basic_tokenizer.use_zwj = not args.no_zwj
+    if check_decode_parity(slow_tokenizer, fast_tokenizer):
+        raise SystemExit("The fast tokenizer decodes differently from HanBertTokenizer.")
+    if args.text_file:
+        from benchmark_hanbert import load_texts
+
+        if check_parity(slow_tokenizer, fast_tokenizer, load_texts(args.text_file, args.max_texts)):
+            raise SystemExit("The fast tokenizer differs from HanBertTokenizer.")
+
+
+if __name__ == "__main__":
+    main()
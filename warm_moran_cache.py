@@ -0,0 +1,76 @@
+"""
+MorAn 분석 캐시 준비
+
+KorQuAD open 형 json 의 질문, 답, 문단 단어를 미리 MorAn 으로 분석하여 SQLite 캐시 파일에 저장함
+HanBertTokenizer 를 같은 파일의 moran_cache_file 로 만들면 학습, dev, submit 에서 다시 분석하지 않음
+
+"""
+
+import argparse
+import json
+import random
+import time
+
+from tokenization_hanbert import BasicTokenizer, MorAnCache, whitespace_tokenize
+
+
+def load_analysis_texts(data_file):
+    """Texts HanBertTokenizer.tokenize is called with while featurizing a KorQuAD open json file."""
+    texts = set()
+    with open(data_file, "r", encoding="utf-8") as reader:
+        for entry in json.load(reader)["data"]:
+            qa = entry["qa"]
+            for text in (qa["question"], qa.get("answer")):
+                if text:
+                    texts.add(text)
+            for paragraph in entry["paragraphs"]:
+                texts.update(whitespace_tokenize(str(paragraph["contents"])))
+    return texts
+
+
+def check_run_batch(moran, texts, num_texts=1000, seed=42):
+    """MorAn analyses of a sample of the texts must be the same in the worker processes as in this process."""
+    sample = random.Random(seed).sample(texts, min(num_texts, len(texts)))
+    expected = [moran.run(text) for text in sample]
+    analyses = moran.run_batch(sample)
+    mismatches = sum(tokens != expected_tokens for tokens, expected_tokens in zip(analyses, expected))
+    print("run_batch of {} texts in {} processes, {} differ from run".format(len(sample), moran.num_threads, mismatches))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data_files", required=True, nargs="+", type=str, help="KorQuAD open json files to pre-analyze."
+    )
+    parser.add_argument("--cache_file", required=True, type=str, help="SQLite file to store the analyses in.")
+    parser.add_argument("--cache_size", default=1000000, type=int, help="Maximum number of cached analyses.")
+    parser.add_argument("--moran_file", default="libmoran4dnlp.so", type=str, help="MorAn library.")
+    parser.add_argument("--threads", default=8, type=int, help="Number of processes running MorAn.")
+    parser.add_argument("--batch_size", default=10000, type=int, help="Texts analyzed and stored per batch.")
+    args = parser.parse_args()
+
+    moran_cache = MorAnCache(args.cache_file, max_entries=args.cache_size)
+    basic_tokenizer = BasicTokenizer(
+        use_moran=True, moran_file=args.moran_file, moran_threads=args.threads, moran_cache=moran_cache
+    )
+    if basic_tokenizer.moran is None:
+        raise SystemExit("Could not load the MorAn library {}".format(args.moran_file))
+
+    texts = sorted(set().union(*(load_analysis_texts(data_file) for data_file in args.data_files)))
+    print("{} unique texts, {} analyses already cached".format(len(texts), len(moran_cache)))
+    if check_run_batch(basic_tokenizer.moran, texts):
+        raise SystemExit("MorAn analyses differ between run_batch and run, use --threads 1")
+
+    start_time = time.time()
+    for start in range(0, len(texts), args.batch_size):
+        basic_tokenizer.tokenize_batch(texts[start:start + args.batch_size])
+        print("{}/{} texts, {:.1f} sec".format(min(start + args.batch_size, len(texts)), len(texts),
+                                               time.time() - start_time))
+    moran_cache.trim()
+    basic_tokenizer.moran.close()
+    print("{} analyses cached in {}".format(len(moran_cache), args.cache_file))
+
+
+if __name__ == "__main__":
+    main()